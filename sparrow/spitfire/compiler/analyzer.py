@@ -32,6 +32,11 @@ class AnalyzerOptions(object):
     self.directly_access_defined_variables = False
 
     self.enable_psyco = False
+
+    # drop parse nodes as soon as they have been analyzed - the parse tree is
+    # not usable after get_ast(), but the parse tree and the ast don't have to
+    # be held in memory at the same time
+    self.release_parse_tree = False
     
     self.__dict__.update(kargs)
   def update(self, **kargs):
@@ -72,7 +77,10 @@ class SemanticAnalyzer(object):
     self.template = None
     
   def get_ast(self):
-    ast_node_list = self.build_ast(self.parse_root)
+    parse_root = self.parse_root
+    if self.options.release_parse_tree:
+      self.parse_root = None
+    ast_node_list = self.build_ast(parse_root)
     if len(ast_node_list) != 1:
       raise SemanticAnalyzerError('ast must have 1 root node')
     self.ast_root = ast_node_list[0]
@@ -106,7 +114,7 @@ class SemanticAnalyzer(object):
   def analyzeTemplateNode(self, pnode):
     self.template = pnode.copy(copy_children=False)
     self.template.classname = self.classname
-    for pn in self.optimize_parsed_nodes(pnode.child_nodes):
+    for pn in self.iter_parsed_nodes(pnode.child_nodes):
       self.template.main_function.extend(self.build_ast(pn))
 
     self.template.main_function = self.build_ast(self.template.main_function)[0]
@@ -119,7 +127,7 @@ class SemanticAnalyzer(object):
       for_node.target_list.extend(self.build_ast(pn))
     for pn in pnode.expression_list.child_nodes:
       for_node.expression_list.extend(self.build_ast(pn))
-    for pn in self.optimize_parsed_nodes(pnode.child_nodes):
+    for pn in self.iter_parsed_nodes(pnode.child_nodes):
       for_node.extend(self.build_ast(pn))
       
     return [for_node]
@@ -137,9 +145,9 @@ class SemanticAnalyzer(object):
   def analyzeIfNode(self, pnode):
     if_node = IfNode()
     if_node.test_expression = self.build_ast(pnode.test_expression)[0]
-    for pn in self.optimize_parsed_nodes(pnode.child_nodes):
+    for pn in self.iter_parsed_nodes(pnode.child_nodes):
       if_node.extend(self.build_ast(pn))
-    for pn in self.optimize_parsed_nodes(pnode.else_):
+    for pn in self.iter_parsed_nodes(pnode.else_):
       if_node.else_.extend(self.build_ast(pn))
     return [if_node]
 
@@ -211,7 +219,7 @@ class SemanticAnalyzer(object):
     function.parameter_list.child_nodes.insert(0,
                                                ParameterNode(name='self'))
     
-    for pn in self.optimize_parsed_nodes(pnode.child_nodes):
+    for pn in self.iter_parsed_nodes(pnode.child_nodes):
       function.extend(self.build_ast(pn))
 
     function = self.build_ast(function)[0]
@@ -300,6 +308,22 @@ class SemanticAnalyzer(object):
     #print "optimized_nodes", node_list, optimized_nodes
     return optimized_nodes
 
+  # iterate over the optimized version of a list of parsed child nodes. if we
+  # are releasing the parse tree, the list is emptied up front and each parse
+  # node is dropped as soon as the caller is done with it.
+  def iter_parsed_nodes(self, node_list):
+    optimized_nodes = self.optimize_parsed_nodes(node_list)
+    if not self.options.release_parse_tree:
+      return optimized_nodes
+    del node_list[:]
+    optimized_nodes.reverse()
+    return _consume_nodes(optimized_nodes)
+
+
+def _consume_nodes(node_list):
+  while node_list:
+    yield node_list.pop()
+
 
 # template objects for certain common subcomponents
 def t_local_vars():
@@ -4,14 +4,26 @@ import copy
 class EatPrevious(object):
   pass
 
+# every node class declares __slots__ so large templates don't carry a
+# __dict__ per node. if you add an attribute to a node (or annotate one in the
+# optimizer), it has to be declared in the __slots__ of the class.
 class ASTNode(object):
+  __slots__ = ('name', 'value', 'parent', 'child_nodes', '_hint_map')
+
   def __init__(self, name=''):
     self.name = name
     self.value = None
     self.parent = None
     self.child_nodes = NodeList()
-    # optimization annotations
-    self.hint_map = {}
+    self._hint_map = None
+
+  # optimization annotations - most nodes never get any, so only allocate the
+  # dict on demand
+  @property
+  def hint_map(self):
+    if self._hint_map is None:
+      self._hint_map = {}
+    return self._hint_map
 
   def __str__(self):
     if self.value:
@@ -70,12 +82,20 @@ class ASTNode(object):
     self.child_nodes.remove(marker_node)
 
   def copy(self, copy_children=True):
-    node = copy.deepcopy(self)
-    if not copy_children:
-      node.child_nodes = NodeList()
-    return node
+    if copy_children:
+      return copy.deepcopy(self)
+    # detach the children while copying, there's no point in duplicating a
+    # whole subtree just to throw it away
+    child_nodes = self.child_nodes
+    self.child_nodes = NodeList()
+    try:
+      return copy.deepcopy(self)
+    finally:
+      self.child_nodes = child_nodes
 
 class NodeList(list):
+  __slots__ = ()
+
   def append(self, node):
     if isinstance(node, list):
       self.extend(node)
@@ -84,6 +104,8 @@ class NodeList(list):
   
 
 class _ListNode(ASTNode):
+  __slots__ = ()
+
   def __init__(self, parg_list=None, karg_list=None):
     ASTNode.__init__(self)
     if parg_list:
@@ -99,9 +121,11 @@ class _ListNode(ASTNode):
                       ', '.join(str(n) for n in self.child_nodes))
 
 class ArgListNode(_ListNode):
-  pass
+  __slots__ = ()
 
 class BinOpNode(ASTNode):
+  __slots__ = ('operator', 'left', 'right')
+
   def __init__(self, operator, left, right):
     ASTNode.__init__(self)
     self.operator = operator
@@ -121,16 +145,20 @@ class BinOpNode(ASTNode):
       self.__class__.__name__, self.left, self.operator, self.right)
 
 class BinOpExpressionNode(BinOpNode):
-  pass
+  __slots__ = ()
 
 class AssignNode(BinOpNode):
+  __slots__ = ()
+
   def __init__(self, left, right):
     BinOpNode.__init__(self, '=', left, right)
 
 class BreakNode(ASTNode):
-  pass
+  __slots__ = ()
 
 class CallFunctionNode(ASTNode):
+  __slots__ = ('expression', 'arg_list')
+
   def __init__(self, expression=None, arg_list=None):
     ASTNode.__init__(self)
     self.expression = expression
@@ -150,12 +178,14 @@ class CallFunctionNode(ASTNode):
       self.__class__.__name__, self.expression, self.arg_list)
 
 class CommentNode(ASTNode):
-  pass
+  __slots__ = ()
 
 class ContinueNode(ASTNode):
-  pass
+  __slots__ = ()
 
 class DefNode(ASTNode):
+  __slots__ = ('parameter_list',)
+
   def __init__(self, *pargs, **kargs):
     ASTNode.__init__(self, *pargs, **kargs)
     self.parameter_list = ParameterListNode()
@@ -165,13 +195,15 @@ class DefNode(ASTNode):
       self.__class__.__name__, self.name, self.parameter_list)
 
 class BlockNode(DefNode):
-  pass
+  __slots__ = ()
 
 class ExpressionListNode(_ListNode):
-  pass
+  __slots__ = ()
 
 
 class ForNode(ASTNode):
+  __slots__ = ('target_list', 'expression_list', 'loop_variant_set')
+
   def __init__(self, target_list=None, expression_list=None):
     ASTNode.__init__(self)
     if target_list:
@@ -189,9 +221,11 @@ class ForNode(ASTNode):
 
 # fixme: why is this necessary?
 class FunctionInitNode(ASTNode):
-  pass
+  __slots__ = ()
 
 class FunctionNode(ASTNode):
+  __slots__ = ('parameter_list', 'aliased_expression_map', 'alias_name_set')
+
   def __init__(self, *pargs, **kargs):
     ASTNode.__init__(self, *pargs, **kargs)
     new_buffer = CallFunctionNode(
@@ -215,6 +249,8 @@ class FunctionNode(ASTNode):
 
 
 class GetAttrNode(ASTNode):
+  __slots__ = ('expression',)
+
   def __init__(self, expression, name):
     ASTNode.__init__(self)
     self.expression = expression
@@ -247,9 +283,11 @@ class GetAttrNode(ASTNode):
       raise Exception("expression doesn't mactch replacement")
 
 class GetUDNNode(GetAttrNode):
-  pass
+  __slots__ = ()
 
 class IdentifierNode(ASTNode):
+  __slots__ = ()
+
   # all subclasses of IdentifierNode should be treated as equivalent
   def __eq__(self, node):
     return bool(isinstance(node, IdentifierNode) and
@@ -259,9 +297,11 @@ class IdentifierNode(ASTNode):
     return hash(self.name)
 
 class AssignIdentifierNode(IdentifierNode):
-  pass
+  __slots__ = ()
 
 class IfNode(ASTNode):
+  __slots__ = ('test_expression', 'else_')
+
   def __init__(self, test_expression=None):
     ASTNode.__init__(self)
     self.test_expression = test_expression
@@ -278,9 +318,11 @@ class IfNode(ASTNode):
       self.__class__.__name__, self.test_expression, self.else_)
 
 class ImplementsNode(ASTNode):
-  pass
+  __slots__ = ()
 
 class ImportNode(ASTNode):
+  __slots__ = ('module_name_list',)
+
   def __init__(self, module_name_list):
     ASTNode.__init__(self)
     self.module_name_list = module_name_list
@@ -291,9 +333,11 @@ class ImportNode(ASTNode):
 
 # alpha break
 class ExtendsNode(ImportNode):
-  pass
+  __slots__ = ()
 
 class FromNode(ImportNode):
+  __slots__ = ('identifier',)
+
   def __init__(self, module_name_list, identifier):
     ImportNode.__init__(self, module_name_list)
     self.identifier = identifier
@@ -304,10 +348,14 @@ class FromNode(ImportNode):
          self.identifier))
 
 class ListLiteralNode(ASTNode):
+  __slots__ = ()
+
   def __str__(self):
     return '%s nodes:%r' % (self.__class__.__name__, self.child_nodes)
 
 class LiteralNode(ASTNode):
+  __slots__ = ()
+
   def __init__(self, value):
     ASTNode.__init__(self)
     self.value = value
@@ -317,6 +365,8 @@ class LiteralNode(ASTNode):
 
 
 class ParameterNode(ASTNode):
+  __slots__ = ('default',)
+
   def __init__(self, name, default=None):
     ASTNode.__init__(self, name)
     self.default = default
@@ -325,15 +375,17 @@ class ParameterNode(ASTNode):
     return '%s %s' % (ASTNode.__str__(self), self.default)
 
 class AttributeNode(ParameterNode):
-  pass
+  __slots__ = ()
 
 class ParameterListNode(_ListNode):
-  pass
+  __slots__ = ()
 
 class PlaceholderNode(ASTNode):
-  pass
+  __slots__ = ()
 
 class PlaceholderSubstitutionNode(ASTNode):
+  __slots__ = ('expression',)
+
   def __init__(self, expression):
     ASTNode.__init__(self)
     self.expression = expression
@@ -342,6 +394,8 @@ class PlaceholderSubstitutionNode(ASTNode):
     return '%s expr:%r' % (self.__class__.__name__, self.expression)
 
 class ReturnNode(ASTNode):
+  __slots__ = ('expression',)
+
   def __init__(self, expression):
     ASTNode.__init__(self)
     self.expression = expression
@@ -350,6 +404,8 @@ class ReturnNode(ASTNode):
     return '%s expr:%r' % (self.__class__.__name__, self.expression)
 
 class SliceNode(ASTNode):
+  __slots__ = ('expression', 'slice_expression')
+
   def __init__(self, expression, slice_expression):
     ASTNode.__init__(self)
     self.expression = expression
@@ -360,12 +416,14 @@ class SliceNode(ASTNode):
             (self.__class__.__name__, self.expression, self.slice_expression))
 
 class TargetNode(IdentifierNode):
-  pass
+  __slots__ = ()
 
 class TargetListNode(_ListNode):
-  pass
+  __slots__ = ('flat_list',)
 
 class TextNode(ASTNode):
+  __slots__ = ()
+
   def __init__(self, value):
     ASTNode.__init__(self)
     self.value = value
@@ -376,19 +434,24 @@ class TextNode(ASTNode):
     self.value += node.value
 
 class NewlineNode(TextNode):
-  pass
+  __slots__ = ()
 
 class WhitespaceNode(TextNode):
+  __slots__ = ()
+
   def make_optional(self):
     return OptionalWhitespaceNode(self.value)
 
 class OptionalWhitespaceNode(TextNode):
-  pass
+  __slots__ = ()
 
 class TemplateNode(ASTNode):
-  library = False
+  __slots__ = ('library', 'classname', 'main_function', 'encoding',
+               'extends_nodes', 'import_nodes', 'from_nodes', 'attr_nodes')
+
   def __init__(self, classname=None, **kargs):
     ASTNode.__init__(self, **kargs)
+    self.library = False
     # fixme: need to get the classname from somewhere else
     self.classname = classname
     self.main_function = FunctionNode(name='main')
@@ -409,9 +472,11 @@ class TemplateNode(ASTNode):
       self.main_function)
   
 class TupleLiteralNode(ASTNode):
-  pass
+  __slots__ = ()
 
 class UnaryOpNode(ASTNode):
+  __slots__ = ('operator', 'expression')
+
   def __init__(self, operator, expression):
     ASTNode.__init__(self)
     self.operator = operator
@@ -24,6 +24,16 @@ class CodeNode(object):
   def __repr__(self):
     return '%s:%s' % (self.__class__.__name__, self.src_line)
 
+
+# ast nodes use __slots__, so vars() doesn't work on them. this lets the
+# string templates below pull attributes straight off the node.
+class NodeAttributeMap(object):
+  def __init__(self, node):
+    self.node = node
+
+  def __getitem__(self, name):
+    return getattr(self.node, name)
+
     
 # perform an in-order traversal of the AST and call the generate methods
 # in this case, we are generating python source code that should be somewhat
@@ -116,7 +126,7 @@ class CodeGenerator(object):
     if self.options and self.options.enable_psyco:
       module_code.append_line('spitfire.runtime.template.enable_psyco(%(classname)s)' % vars())
 
-    module_code.append_line(run_tmpl % vars(node))
+    module_code.append_line(run_tmpl % NodeAttributeMap(node))
 
     return [module_code]
 
@@ -233,7 +243,7 @@ class CodeGenerator(object):
   def codegenASTOptionalWhitespaceNode(self, node):
     #if self.ignore_optional_whitespace:
     #  return []
-    return [CodeNode(ASTOptionalWhitespaceNode_tmpl[0] % vars(node))]
+    return [CodeNode(ASTOptionalWhitespaceNode_tmpl[0] % NodeAttributeMap(node))]
 
   def codegenASTSliceNode(self, node):
     expression = self.generate_python(self.build_code(node.expression)[0])
@@ -288,10 +298,10 @@ class CodeGenerator(object):
   def codegenDefault(self, node):
     v = globals()
     try:
-      return [CodeNode(line % vars(node))
+      return [CodeNode(line % NodeAttributeMap(node))
               for line in v['AST%s_tmpl' % node.__class__.__name__]]
     except KeyError, e:
-      raise CodegenError("no codegen for %s %s" % (type(node), vars(node)))
+      raise CodegenError("no codegen for %s %s" % (type(node), node))
   def codegen(self, node):
     return self.codegenDefault(node)[0]
 
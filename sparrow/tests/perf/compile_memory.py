@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Compiler memory benchmark
+#
+# Objective: measure the peak RSS of compiling a large, generated template.
+# Each configuration is compiled in a forked child so the peaks don't bleed
+# into each other.
+
+import os
+import sys
+import traceback
+
+from optparse import OptionParser
+
+from spitfire.compiler import analyzer
+import spitfire.compiler.util
+
+block_tmpl = """\
+#def section_%(i)s($item)
+<div class="section" id="s%(i)s">
+  <h2>$item.title</h2>
+  #for $row in $item.rows
+  <tr>
+    #for $cell in $row
+    <td class="c%(i)s">$cell</td>
+    #end for
+  </tr>
+  #end for
+  #if $item.footer
+  <p>$item.footer.text $item.footer.author</p>
+  #else
+  <p>no footer for section %(i)s</p>
+  #end if
+</div>
+#end def
+<div>$section_%(i)s($items[%(i)s])</div>
+"""
+
+def make_template(section_count):
+  return ''.join(block_tmpl % {'i': i} for i in xrange(section_count))
+
+def compile_in_child(src_text, options):
+  pid = os.fork()
+  if not pid:
+    try:
+      spitfire.compiler.util.compile_template(
+        src_text, 'compile_memory', options=options)
+    except:
+      traceback.print_exc()
+      os._exit(1)
+    os._exit(0)
+  pid, status, rusage = os.wait4(pid, 0)
+  if status:
+    raise Exception('compile failed: %s' % status)
+  # ru_maxrss is in kilobytes on linux
+  return rusage.ru_maxrss
+
+if __name__ == '__main__':
+  op = OptionParser()
+  op.add_option('--sections', type='int', default=1000)
+  op.add_option('-O', dest='optimizer_level', type='int', default=0)
+  (options, args) = op.parse_args()
+
+  src_text = make_template(options.sections)
+  print 'template: %s sections, %s bytes' % (options.sections, len(src_text))
+  for release_parse_tree in (False, True):
+    opt = analyzer.optimizer_map[options.optimizer_level]
+    opt = analyzer.AnalyzerOptions(**vars(opt))
+    opt.release_parse_tree = release_parse_tree
+    peak_rss = compile_in_child(src_text, opt)
+    print 'release_parse_tree=%-5s peak rss: %s kB' % (
+      release_parse_tree, peak_rss)
@@ -40,9 +40,9 @@ class CounterMap(dict):
     try:
       for key, (value, time_updated) in items:
         self.increment(key, value, time_updated)
-      except TypeError:
-        print "items", items
-        raise
+    except TypeError:
+      print "items", items
+      raise
 
   def get_log_lines(self, concise=False):
     if concise:
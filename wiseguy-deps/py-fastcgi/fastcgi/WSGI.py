@@ -2,7 +2,44 @@ from Server import ThreadedServer, ForkingServer
 import traceback
 
 
+# the most content a single FCGI_STDOUT record can carry
+MAX_RECORD_SIZE = 65535
+
+
+class BufferedWriter(object):
+    """Collect small writes and pass them on to the stream in big pieces.
+
+    Every flush of an fcgi stream ends up as a record and a syscall, so the
+    status line, headers and body chunks are joined up until there is a
+    full record's worth, or the response is done.
+    """
+
+    def __init__(self, stream, buffer_size=MAX_RECORD_SIZE):
+        self._stream = stream
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_bytes = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_bytes += len(data)
+        if self._buffer_bytes >= self._buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._buffer_bytes = 0
+            self._stream.write(data)
+        self._stream.flush()
+
+
 class WSGIMixIn(object):
+    # response bytes collected before they are sent, set to 0 to send every
+    # chunk from the application as soon as it's produced
+    write_buffer_size = MAX_RECORD_SIZE
+
     def handle(self, req):
         environ = req.environ
         environ['wsgi.input'] = req.stdin
@@ -16,20 +53,25 @@ class WSGIMixIn(object):
 
         headers_set = []
         headers_sent = []
+        out = BufferedWriter(req.stdout, self.write_buffer_size)
 
-        def write(data):
+        def buffered_write(data):
             if not headers_set:
                 raise AssertionError("write() before start_response()")
             elif not headers_sent:
                 # Before the first output, send the stored headers
                 status, response_headers = headers_sent[:] = headers_set
-                req.stdout.write('Status: %s\r\n' % status)
-                for header in response_headers:
-                    req.stdout.write('%s: %s\r\n' % header)
-                req.stdout.write('\r\n')
+                out.write('Status: %s\r\n%s\r\n' % (
+                    status, ''.join(['%s: %s\r\n' % header
+                                     for header in response_headers])))
+
+            if data:
+                out.write(data)
 
-            req.stdout.write(data)
-            req.stdout.flush()
+        def write(data):
+            # the application asked for this to go out now
+            buffered_write(data)
+            out.flush()
 
         def start_response(status, response_headers, exc_info=None):
             if exc_info:
@@ -49,12 +91,17 @@ class WSGIMixIn(object):
         try:
             for data in result:
                 if data:    # don't send headers until body appears
-                    write(data)
+                    buffered_write(data)
             if not headers_sent:
-                write('')   # send headers now if body was empty
+                buffered_write('')   # send headers now if body was empty
         finally:
-            if hasattr(result, 'close'):
-                result.close() 
+            # even if the application blew up half way, what it produced
+            # before that goes out, as it did before the output was buffered
+            try:
+                out.flush()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
 
     def error(self, req, e):
         traceback.print_exc(file=req.stderr)
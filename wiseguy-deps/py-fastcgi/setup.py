@@ -8,7 +8,7 @@ c_ext = Extension("fcgi", ["fastcgi/pyfcgi.c"], libraries=["fcgi"],
                  )
 
 setup(name="python-fastcgi",
-      version="1.3",
+      version="1.4",
       description="Python wrapper for the Open Market FastCGI library",
       long_description="python-fastcgi is a lightweight wrapper around the Open Market FastCGI C Library/SDK. It includes threaded and forking WSGI 1.0 server implementations.",
       author="Cody Pisto",
@@ -0,0 +1,151 @@
+#!/usr/bin/env python2.6
+
+"""Compare accept() distribution modes of the preforking http server.
+
+For each mode this starts a server, hammers it with new connections from a
+pool of client processes and reports latency percentiles along with how many
+requests each worker handled.
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from optparse import OptionParser
+
+from wiseguy.http_server import PreForkingHTTPWSGIServer, accept_modes
+
+
+def make_app(app_delay):
+  def pid_app(environ, start_response):
+    if app_delay:
+      time.sleep(app_delay)
+    content = '%s\n' % os.getpid()
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(content)))])
+    return [content]
+  return pid_app
+
+
+def run_server(options, mode):
+  pid = os.fork()
+  if pid:
+    return pid
+  try:
+    httpd = PreForkingHTTPWSGIServer(
+      make_app(options.app_delay),
+      ('127.0.0.1', options.port),
+      workers=options.workers,
+      accept_mode=mode)
+    httpd.serve_forever()
+  finally:
+    os._exit(0)
+
+
+def fetch(port):
+  """Make one request on a fresh connection and return the worker pid."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.connect(('127.0.0.1', port))
+    sock.sendall('GET / HTTP/1.0\r\n\r\n')
+    chunks = []
+    while True:
+      data = sock.recv(4096)
+      if not data:
+        break
+      chunks.append(data)
+  finally:
+    sock.close()
+  response = ''.join(chunks)
+  return response.split('\r\n\r\n', 1)[-1].strip()
+
+
+def run_client(options, write_fd):
+  deadline = time.time() + options.duration
+  results = []
+  while time.time() < deadline:
+    start = time.time()
+    try:
+      worker_pid = fetch(options.port)
+    except socket.error:
+      worker_pid = 'error'
+    results.append('%s %f' % (worker_pid, time.time() - start))
+  f = os.fdopen(write_fd, 'w')
+  f.write('\n'.join(results))
+  f.close()
+
+
+def run_load(options):
+  clients = []
+  for i in xrange(options.clients):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+      os.close(read_fd)
+      try:
+        run_client(options, write_fd)
+      finally:
+        os._exit(0)
+    os.close(write_fd)
+    clients.append((pid, read_fd))
+
+  latencies = []
+  worker_counts = {}
+  for pid, read_fd in clients:
+    f = os.fdopen(read_fd)
+    for line in f.read().splitlines():
+      worker_pid, elapsed = line.split()
+      latencies.append(float(elapsed))
+      worker_counts[worker_pid] = worker_counts.get(worker_pid, 0) + 1
+    f.close()
+    os.waitpid(pid, 0)
+  return latencies, worker_counts
+
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return 0.0
+  index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+  return sorted_values[index]
+
+
+def report(mode, latencies, worker_counts, duration):
+  latencies.sort()
+  print '%s: %s requests, %.0f req/s' % (
+    mode, len(latencies), len(latencies) / duration)
+  print '  p50 %.2fms p90 %.2fms p99 %.2fms max %.2fms' % tuple(
+    1000 * x for x in (percentile(latencies, 0.50),
+                       percentile(latencies, 0.90),
+                       percentile(latencies, 0.99),
+                       percentile(latencies, 1.0)))
+  counts = sorted(worker_counts.items(), key=lambda x: -x[1])
+  print '  per worker: %s' % ' '.join('%s:%s' % x for x in counts)
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('--port', type='int', default=8000)
+  parser.add_option('--workers', type='int', default=4)
+  parser.add_option('--clients', type='int', default=16)
+  parser.add_option('--duration', type='float', default=5.0,
+                    help='seconds of load per mode')
+  parser.add_option('--app-delay', type='float', default=0.0,
+                    help='seconds each request spends in the app')
+  parser.add_option('--modes', default=','.join(accept_modes))
+  (options, args) = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  for mode in options.modes.split(','):
+    server_pid = run_server(options, mode)
+    # give the workers a chance to come up
+    time.sleep(1.0)
+    try:
+      latencies, worker_counts = run_load(options)
+    finally:
+      os.kill(server_pid, signal.SIGTERM)
+      os.waitpid(server_pid, 0)
+    report(mode, latencies, worker_counts, options.duration)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python2.6
+
+"""Time request parsing and environ construction.
+
+Runs a corpus of typical browser, api client and load balancer requests
+through the request line/header parser and get_environ() of the stock
+wsgiref handler and of the wiseguy handler, without any sockets involved.
+"""
+
+import StringIO
+import time
+
+from optparse import OptionParser
+from wsgiref import simple_server
+
+from wiseguy import http_server
+
+corpus = [
+  # browser page load
+  ('GET /search?q=wiseguy&hl=en HTTP/1.1\r\n'
+   'Host: www.example.com\r\n'
+   'User-Agent: Mozilla/5.0 (Windows; U; Windows NT 6.1; en-US; rv:1.9.2.3) '
+   'Gecko/20100401 Firefox/3.6.3\r\n'
+   'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+   'Accept-Language: en-us,en;q=0.5\r\n'
+   'Accept-Encoding: gzip,deflate\r\n'
+   'Accept-Charset: ISO-8859-1,utf-8;q=0.7,*;q=0.7\r\n'
+   'Keep-Alive: 115\r\n'
+   'Connection: keep-alive\r\n'
+   'Referer: http://www.example.com/\r\n'
+   'Cookie: session=a3fWa9e0c1f2; prefs=compact; __utma=1.2.3.4.5.6\r\n'
+   '\r\n'),
+  # xhr from a page
+  ('GET /api/v1/items/1234.json?fields=id,name HTTP/1.1\r\n'
+   'Host: api.example.com\r\n'
+   'User-Agent: Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_6_3; en-us) '
+   'AppleWebKit/533.16 (KHTML, like Gecko) Version/5.0 Safari/533.16\r\n'
+   'Accept: application/json, text/javascript, */*\r\n'
+   'X-Requested-With: XMLHttpRequest\r\n'
+   'Accept-Language: en-us\r\n'
+   'Accept-Encoding: gzip, deflate\r\n'
+   'Cookie: session=a3fWa9e0c1f2\r\n'
+   'Connection: keep-alive\r\n'
+   '\r\n'),
+  # behind a load balancer
+  ('POST /api/v1/items HTTP/1.1\r\n'
+   'Host: api.example.com\r\n'
+   'Content-Type: application/json; charset=utf-8\r\n'
+   'Content-Length: 48\r\n'
+   'X-Forwarded-For: 10.1.2.3, 192.168.0.7\r\n'
+   'X-Forwarded-Proto: https\r\n'
+   'X-Request-Start: t=1276543210123456\r\n'
+   'User-Agent: python-requests/0.4\r\n'
+   'Accept: */*\r\n'
+   '\r\n'),
+  # health check
+  ('GET /health HTTP/1.0\r\n'
+   'User-Agent: ELB-HealthChecker/1.0\r\n'
+   '\r\n'),
+]
+
+
+class FakeServer(object):
+  def __init__(self):
+    self.base_environ = {'SERVER_NAME': 'localhost', 'SERVER_PORT': '8000',
+                         'GATEWAY_INTERFACE': 'CGI/1.1', 'SCRIPT_NAME': ''}
+
+
+class StockHandler(simple_server.WSGIRequestHandler):
+  def __init__(self, server):
+    self.server = server
+    self.client_address = ('127.0.0.1', 40000)
+
+  def address_string(self):
+    return self.client_address[0]
+
+
+class WiseguyHandler(http_server.WiseguyRequestHandler):
+  def __init__(self, server):
+    self.server = server
+    self.client_address = ('127.0.0.1', 40000)
+
+
+def run(handler_class, iterations):
+  server = FakeServer()
+  requests = [StringIO.StringIO(raw) for raw in corpus]
+  start = time.time()
+  for i in xrange(iterations):
+    for request in requests:
+      request.seek(0)
+      handler = handler_class(server)
+      handler.rfile = request
+      if handler_class is WiseguyHandler:
+        handler.rfile = http_server.SocketFileWrapper(request, handler)
+      handler.raw_requestline = handler.rfile.readline()
+      handler.parse_request()
+      handler.get_environ()
+  return time.time() - start
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('--iterations', type='int', default=20000)
+  (options, args) = parser.parse_args()
+
+  request_count = options.iterations * len(corpus)
+  for name, handler_class in (('wsgiref', StockHandler),
+                              ('wiseguy', WiseguyHandler)):
+    elapsed = run(handler_class, options.iterations)
+    print '%s: %.2f usec/request' % (name, 1e6 * elapsed / request_count)
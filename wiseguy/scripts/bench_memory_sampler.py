@@ -0,0 +1,70 @@
+#!/usr/bin/env python2.6
+
+"""Time one memory check over a set of children.
+
+Forks children that each build a heap with lots of separate mappings, then
+compares calling resource_manager.get_memory_usage() for every pid (what
+check_children used to do) against a single MemorySampler pass.
+"""
+
+import mmap
+import os
+import signal
+import time
+
+from optparse import OptionParser
+
+from wiseguy import resource_manager
+
+
+def spawn_children(count, mappings):
+  pids = []
+  for i in xrange(count):
+    pid = os.fork()
+    if not pid:
+      # separate anonymous maps show up as separate entries in smaps
+      maps = [mmap.mmap(-1, 64 * 1024) for j in xrange(mappings)]
+      for m in maps:
+        m[0] = 'x'
+      heap = [str(j) for j in xrange(200000)]
+      signal.pause()
+      os._exit(0)
+    pids.append(pid)
+  # let them build their heaps
+  time.sleep(2.0)
+  return pids
+
+
+def time_call(function, repeat):
+  start = time.time()
+  for i in xrange(repeat):
+    function()
+  return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('--children', type='int', default=64)
+  parser.add_option('--mappings', type='int', default=500,
+                    help='extra mappings per child')
+  parser.add_option('--repeat', type='int', default=5)
+  (options, args) = parser.parse_args()
+
+  pids = spawn_children(options.children, options.mappings)
+  try:
+    have_smaps_rollup = resource_manager.have_smaps_rollup
+    # the old way parsed all of smaps
+    resource_manager.have_smaps_rollup = False
+    per_pid = time_call(
+      lambda: [resource_manager.get_memory_usage(pid) for pid in pids],
+      options.repeat)
+    resource_manager.have_smaps_rollup = have_smaps_rollup
+    sampler = resource_manager.MemorySampler()
+    batched = time_call(lambda: sampler.sample(pids), options.repeat)
+    print 'smaps_rollup: %s' % have_smaps_rollup
+    print 'get_memory_usage per pid, full smaps: %.1fms' % (1000 * per_pid)
+    print 'MemorySampler.sample:                 %.1fms' % (1000 * batched)
+  finally:
+    for pid in pids:
+      os.kill(pid, signal.SIGKILL)
+      os.waitpid(pid, 0)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python2.6
+
+"""Compare routing a request by scanning every route against RoutesApp.
+
+The scan is the way the routes example used to dispatch - compare the path
+to each route in turn, then __import__ the controller. RoutesApp looks up
+plain paths in a dict, walks a tree for the {} patterns and imports
+controllers once, up front. Half of the generated routes are plain paths,
+the other half have a {} segment, and the requests are spread evenly over
+all of them plus some that don't match anything.
+"""
+
+import random
+import time
+
+from optparse import OptionParser
+
+from wiseguy.examples.routes import routes as routes_example
+
+
+def make_routes(count):
+  routes = []
+  for i in xrange(count / 2):
+    routes.append(('/section%s/page%s' % (i % 20, i), 'Controller.index'))
+    routes.append(('/api%s/item/{id:\d+}' % i, 'Controller.hello'))
+  return routes
+
+
+def make_paths(count, request_count):
+  paths = []
+  for i in xrange(request_count):
+    n = random.randrange(count / 2)
+    choice = random.randrange(5)
+    if choice < 2:
+      paths.append('/section%s/page%s' % (n % 20, n))
+    elif choice < 4:
+      paths.append('/api%s/item/%s' % (n, random.randrange(1000)))
+    else:
+      paths.append('/missing/%s' % n)
+  return paths
+
+
+def scan_dispatch(routes, path):
+  """The old RoutesApp.__call__, without the controller call."""
+  for route in routes:
+    if path == route[0]:
+      module_name, func_name = route[1].split('.', 1)
+      module = __import__(
+        routes_example.modulepath + module_name.lower(), globals(), locals(),
+        [module_name])
+      return vars(module)[module_name], func_name
+  return None
+
+
+def start_response(status, headers):
+  pass
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('--routes', type='int', default=2000)
+  parser.add_option('--requests', type='int', default=20000)
+  (options, args) = parser.parse_args()
+
+  routes = make_routes(options.routes)
+  paths = make_paths(options.routes, options.requests)
+
+  start = time.time()
+  app = routes_example.RoutesApp(routes)
+  print 'RoutesApp setup for %s routes: %.1fms' % (
+    len(routes), 1000 * (time.time() - start))
+
+  start = time.time()
+  for path in paths:
+    scan_dispatch(routes, path)
+  elapsed = time.time() - start
+  print 'linear scan: %.1fus per request' % (
+    1000000 * elapsed / len(paths))
+
+  start = time.time()
+  for path in paths:
+    app.match(path)
+  elapsed = time.time() - start
+  print 'RoutesApp.match: %.1fus per request' % (
+    1000000 * elapsed / len(paths))
+
+  start = time.time()
+  for path in paths:
+    app({'PATH_INFO': path}, start_response)
+  elapsed = time.time() - start
+  print 'RoutesApp, calling the controller: %.1fus per request' % (
+    1000000 * elapsed / len(paths))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python2.6
+
+"""Measure how slow clients affect everyone else, with and without the
+buffering front end.
+
+A few client processes upload their request bodies a few bytes at a time,
+the way a phone on a bad connection does, while the rest make ordinary
+requests as fast as they can. Without the front end each slow upload holds
+a worker for its whole duration, so the fast clients queue up behind them.
+"""
+
+import logging
+import os
+import signal
+import socket
+import time
+
+from optparse import OptionParser
+
+from wiseguy.front_end import PreForkingBufferedHTTPWSGIServer
+from wiseguy.http_server import PreForkingHTTPWSGIServer
+
+
+def app(environ, start_response):
+  body = environ['wsgi.input'].read()
+  content = '%s %s\n' % (os.getpid(), len(body))
+  start_response('200 OK', [('Content-Type', 'text/plain'),
+                            ('Content-Length', str(len(content)))])
+  return [content]
+
+
+def run_server(options, buffered):
+  pid = os.fork()
+  if pid:
+    return pid
+  try:
+    if buffered:
+      httpd = PreForkingBufferedHTTPWSGIServer(
+        app, ('127.0.0.1', options.port), options.backend_path,
+        workers=options.workers)
+    else:
+      httpd = PreForkingHTTPWSGIServer(
+        app, ('127.0.0.1', options.port), workers=options.workers)
+    httpd.serve_forever()
+  finally:
+    os._exit(0)
+
+
+def fetch(port, body='', trickle_delay=0):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.connect(('127.0.0.1', port))
+    request = 'POST / HTTP/1.0\r\nContent-Length: %s\r\n\r\n' % len(body)
+    if trickle_delay:
+      sock.sendall(request)
+      for i in xrange(0, len(body), 16):
+        sock.sendall(body[i:i + 16])
+        time.sleep(trickle_delay)
+    else:
+      sock.sendall(request + body)
+    while sock.recv(4096):
+      pass
+  finally:
+    sock.close()
+
+
+def run_client(options, slow, write_fd):
+  deadline = time.time() + options.duration
+  latencies = []
+  errors = 0
+  while time.time() < deadline:
+    start = time.time()
+    try:
+      if slow:
+        fetch(options.port, 'x' * options.body_size, options.trickle_delay)
+      else:
+        fetch(options.port, 'x' * options.body_size)
+    except socket.error:
+      errors += 1
+      continue
+    latencies.append(time.time() - start)
+  f = os.fdopen(write_fd, 'w')
+  f.write('%s\n%s' % (errors, '\n'.join(str(x) for x in latencies)))
+  f.close()
+
+
+def run_load(options):
+  clients = []
+  for i in xrange(options.slow_clients + options.clients):
+    slow = i < options.slow_clients
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+      os.close(read_fd)
+      try:
+        run_client(options, slow, write_fd)
+      finally:
+        os._exit(0)
+    os.close(write_fd)
+    clients.append((pid, read_fd, slow))
+
+  latencies = []
+  errors = 0
+  for pid, read_fd, slow in clients:
+    f = os.fdopen(read_fd)
+    lines = f.read().splitlines()
+    f.close()
+    os.waitpid(pid, 0)
+    if slow:
+      continue
+    errors += int(lines[0])
+    latencies.extend(float(x) for x in lines[1:])
+  return latencies, errors
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('--port', type='int', default=8000)
+  parser.add_option('--backend-path', default='/tmp/bench_slow_clients.sock')
+  parser.add_option('--workers', type='int', default=4)
+  parser.add_option('--clients', type='int', default=4,
+                    help='clients sending requests as fast as they can')
+  parser.add_option('--slow-clients', type='int', default=8)
+  parser.add_option('--body-size', type='int', default=1024)
+  parser.add_option('--trickle-delay', type='float', default=0.05,
+                    help='seconds between each 16 bytes of a slow upload')
+  parser.add_option('--duration', type='float', default=10.0)
+  (options, args) = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  for buffered in (False, True):
+    server_pid = run_server(options, buffered)
+    time.sleep(1.0)
+    try:
+      latencies, errors = run_load(options)
+    finally:
+      os.kill(server_pid, signal.SIGTERM)
+      os.waitpid(server_pid, 0)
+    latencies.sort()
+    if latencies:
+      median = latencies[len(latencies) / 2]
+      p99 = latencies[int(len(latencies) * 0.99)]
+    else:
+      median = p99 = 0.0
+    print '%s: fast clients %.0f req/s, %s errors, median %.1fms p99 %.1fms' % (
+      buffered and 'front end' or 'direct',
+      len(latencies) / options.duration, errors, 1000 * median, 1000 * p99)
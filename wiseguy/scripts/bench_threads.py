@@ -0,0 +1,157 @@
+#!/usr/bin/env python2.6
+
+"""Compare throughput per GB of pure prefork against threaded workers.
+
+The application waits on a 'backend' for a while on each request, like a
+memcache or mysql call, and each worker process builds its own copy of some
+application state. For each workers x threads layout this starts a server,
+runs load from a pool of client processes and then measures the memory of
+the workers that answered, counting shared pages once.
+"""
+
+import logging
+import os
+import signal
+import socket
+import time
+
+from optparse import OptionParser
+
+from wiseguy import resource_manager
+from wiseguy.http_server import PreForkingHTTPWSGIServer
+
+_app_state = None
+
+
+def make_app(app_mb, io_delay):
+  def app(environ, start_response):
+    global _app_state
+    if _app_state is None:
+      # private to each worker, the way a real application's caches and
+      # touched refcounts end up
+      _app_state = [str(i) * 10 for i in xrange(app_mb * 1024 * 1024 / 48)]
+    time.sleep(io_delay)
+    content = '%s\n' % os.getpid()
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(content)))])
+    return [content]
+  return app
+
+
+def run_server(options, workers, threads):
+  pid = os.fork()
+  if pid:
+    return pid
+  try:
+    httpd = PreForkingHTTPWSGIServer(
+      make_app(options.app_mb, options.io_delay),
+      ('127.0.0.1', options.port),
+      workers=workers,
+      threads=threads)
+    httpd.serve_forever()
+  finally:
+    os._exit(0)
+
+
+def fetch(port):
+  """Make one request on a fresh connection and return the worker pid."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.connect(('127.0.0.1', port))
+    sock.sendall('GET / HTTP/1.0\r\n\r\n')
+    chunks = []
+    while True:
+      data = sock.recv(4096)
+      if not data:
+        break
+      chunks.append(data)
+  finally:
+    sock.close()
+  response = ''.join(chunks)
+  return response.split('\r\n\r\n', 1)[-1].strip()
+
+
+def run_client(options, write_fd):
+  deadline = time.time() + options.duration
+  results = []
+  while time.time() < deadline:
+    try:
+      results.append(fetch(options.port))
+    except socket.error:
+      results.append('error')
+  f = os.fdopen(write_fd, 'w')
+  f.write('\n'.join(results))
+  f.close()
+
+
+def run_load(options):
+  clients = []
+  for i in xrange(options.clients):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+      os.close(read_fd)
+      try:
+        run_client(options, write_fd)
+      finally:
+        os._exit(0)
+    os.close(write_fd)
+    clients.append((pid, read_fd))
+
+  worker_pids = set()
+  requests = errors = 0
+  for pid, read_fd in clients:
+    f = os.fdopen(read_fd)
+    for worker_pid in f.read().splitlines():
+      if worker_pid == 'error':
+        errors += 1
+      else:
+        requests += 1
+        worker_pids.add(int(worker_pid))
+    f.close()
+    os.waitpid(pid, 0)
+  return requests, errors, worker_pids
+
+
+def get_memory_in_use(pids):
+  """Private memory of every worker plus the shared memory, once."""
+  mem_usage_map = resource_manager.MemorySampler().sample(pids)
+  if not mem_usage_map:
+    return 0
+  total_private = sum(mem['private'] for mem in mem_usage_map.itervalues())
+  max_shared = max(mem['shared'] for mem in mem_usage_map.itervalues())
+  return total_private + max_shared
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('--port', type='int', default=8000)
+  parser.add_option('--layouts', default='16x1,4x4,2x8',
+                    help='comma separated workers x threads')
+  parser.add_option('--clients', type='int', default=16)
+  parser.add_option('--duration', type='float', default=5.0,
+                    help='seconds of load per layout')
+  parser.add_option('--io-delay', type='float', default=0.02,
+                    help='seconds each request waits on the backend')
+  parser.add_option('--app-mb', type='int', default=20,
+                    help='megabytes of state each worker builds')
+  (options, args) = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  for layout in options.layouts.split(','):
+    workers, threads = [int(x) for x in layout.split('x')]
+    server_pid = run_server(options, workers, threads)
+    # give the workers a chance to come up
+    time.sleep(1.0)
+    try:
+      requests, errors, worker_pids = run_load(options)
+      mem_kb = get_memory_in_use(worker_pids)
+    finally:
+      os.kill(server_pid, signal.SIGTERM)
+      os.waitpid(server_pid, 0)
+    rate = requests / options.duration
+    mem_gb = mem_kb / (1024.0 * 1024.0)
+    print '%s workers x %s threads: %.0f req/s, %s errors, %.0fMB, ' \
+          '%.0f req/s per GB' % (workers, threads, rate, errors,
+                                 mem_kb / 1024.0, mem_gb and rate / mem_gb)
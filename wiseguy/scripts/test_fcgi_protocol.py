@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import struct
+import unittest
+
+from wiseguy import fcgi_protocol
+from wiseguy.fcgi_protocol import (
+  FCGI_BEGIN_REQUEST, FCGI_GET_VALUES, FCGI_GET_VALUES_RESULT, FCGI_PARAMS,
+  FCGI_RESPONDER, FCGI_STDIN, ProtocolError, decode_pairs, encode_pairs,
+  pack_record, pack_stream)
+
+
+class FakeSocket(object):
+  """Hands out pieces to recv() one at a time, then ''."""
+  def __init__(self, pieces):
+    self.pieces = list(pieces)
+    self.sent = []
+    self.closed = False
+
+  def recv(self, size):
+    if not self.pieces:
+      return ''
+    return self.pieces.pop(0)
+
+  def sendall(self, data):
+    self.sent.append(data)
+
+  def close(self):
+    self.closed = True
+
+
+def pack_request(request_id, params, stdin=''):
+  records = [
+    pack_record(FCGI_BEGIN_REQUEST, request_id,
+                struct.pack('!HB5x', FCGI_RESPONDER, 0)),
+    pack_record(FCGI_PARAMS, request_id, encode_pairs(params)),
+    pack_record(FCGI_PARAMS, request_id),
+    ]
+  if stdin:
+    records.append(pack_stream(FCGI_STDIN, request_id, stdin))
+  records.append(pack_record(FCGI_STDIN, request_id))
+  return ''.join(records)
+
+
+def read_all(pieces):
+  """Feed pieces to a Connection, returning it and the last read()."""
+  connection = fcgi_protocol.Connection(FakeSocket(pieces))
+  result = True
+  for i in xrange(len(pieces)):
+    result = connection.read()
+  return connection, result
+
+
+class DecodePairsTest(unittest.TestCase):
+  def test_round_trip(self):
+    pairs = [('REQUEST_URI', '/a?b=c'), ('EMPTY', ''),
+             ('LONG_NAME' * 20, 'long value' * 100)]
+    self.assertEqual(decode_pairs(encode_pairs(pairs)), dict(pairs))
+
+  def test_empty(self):
+    self.assertEqual(decode_pairs(''), {})
+
+  def test_truncated_value(self):
+    data = encode_pairs([('NAME', 'value')])
+    for end in xrange(1, len(data)):
+      self.assertRaises(ProtocolError, decode_pairs, data[:end])
+
+  def test_truncated_long_length(self):
+    # the high bit says a four byte length follows
+    self.assertRaises(ProtocolError, decode_pairs, '\x80\x00')
+
+  def test_oversized_length(self):
+    # the top bit is masked off, the length is still far past the end
+    data = '\xff\xff\xff\xff\x01' + 'x' * 10
+    self.assertRaises(ProtocolError, decode_pairs, data)
+
+
+class ConnectionReadTest(unittest.TestCase):
+  params = [('REQUEST_METHOD', 'POST'), ('REQUEST_URI', '/upload')]
+
+  def check_request(self, connection, stdin):
+    self.assertEqual(len(connection.ready), 1)
+    request = connection.ready[0]
+    self.assertEqual(request.request_id, 1)
+    self.assertEqual(request.environ, dict(self.params))
+    self.assertEqual(request.stdin.read(), stdin)
+
+  def test_one_read(self):
+    connection, result = read_all([pack_request(1, self.params, 'body')])
+    self.assertTrue(result)
+    self.check_request(connection, 'body')
+
+  def test_split_everywhere(self):
+    data = pack_request(1, self.params, 'body')
+    connection, result = read_all(list(data))
+    self.assertTrue(result)
+    self.check_request(connection, 'body')
+
+  def test_split_record_waits(self):
+    data = pack_request(1, self.params, 'x' * 1000)
+    connection, result = read_all([data[:-20]])
+    self.assertTrue(result)
+    self.assertEqual(connection.ready, [])
+    self.assertFalse(connection.closed)
+
+  def test_large_stdin(self):
+    stdin = 'x' * (fcgi_protocol.max_content_size * 3 + 1)
+    data = pack_request(1, self.params, stdin)
+    pieces = [data[i:i + 1000] for i in xrange(0, len(data), 1000)]
+    connection, result = read_all(pieces)
+    self.check_request(connection, stdin)
+
+  def test_multiplexed(self):
+    first = pack_request(1, self.params, 'one')
+    second = pack_request(2, self.params, 'two')
+    # interleave the records of the two requests
+    records = []
+    for data in (first, second):
+      offset = 0
+      pieces = []
+      while offset < len(data):
+        length, padding = struct.unpack('!HB', data[offset + 4:offset + 7])
+        end = offset + fcgi_protocol.header_size + length + padding
+        pieces.append(data[offset:end])
+        offset = end
+      records.append(pieces)
+    interleaved = [record for pair in zip(*records) for record in pair]
+    connection, result = read_all([''.join(interleaved)])
+    self.assertEqual([request.request_id for request in connection.ready],
+                     [1, 2])
+    self.assertEqual(connection.ready[1].stdin.read(), 'two')
+
+  def test_truncated_begin_request(self):
+    data = pack_record(FCGI_BEGIN_REQUEST, 1, '\x00\x01')
+    connection, result = read_all([data])
+    self.assertFalse(result)
+    self.assertTrue(connection.closed)
+
+  def test_bad_version(self):
+    data = '\x02' + pack_request(1, self.params)[1:]
+    connection, result = read_all([data])
+    self.assertFalse(result)
+    self.assertTrue(connection.closed)
+
+  def test_truncated_params(self):
+    data = ''.join([
+      pack_record(FCGI_BEGIN_REQUEST, 1,
+                  struct.pack('!HB5x', FCGI_RESPONDER, 0)),
+      pack_record(FCGI_PARAMS, 1, encode_pairs(self.params)[:-3]),
+      pack_record(FCGI_PARAMS, 1),
+      ])
+    connection, result = read_all([data])
+    self.assertFalse(result)
+    self.assertTrue(connection.closed)
+
+  def test_hang_up(self):
+    connection = fcgi_protocol.Connection(FakeSocket([]))
+    self.assertFalse(connection.read())
+    self.assertTrue(connection.closed)
+
+  def test_get_values(self):
+    data = pack_record(FCGI_GET_VALUES, 0, encode_pairs(
+      [('FCGI_MPXS_CONNS', ''), ('FCGI_UNHEARD_OF', '')]))
+    connection, result = read_all([data])
+    self.assertTrue(result)
+    reply = ''.join(connection.socket.sent)
+    record_type, length = struct.unpack('!xBxxH', reply[:6])
+    self.assertEqual(record_type, FCGI_GET_VALUES_RESULT)
+    content = reply[fcgi_protocol.header_size:
+                    fcgi_protocol.header_size + length]
+    self.assertEqual(decode_pairs(content), {'FCGI_MPXS_CONNS': '1'})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import unittest
+
+from wiseguy.front_end import ChunkedDecoder, decode_chunked
+
+
+def encode_chunked(chunks, trailer=''):
+  return ''.join('%x\r\n%s\r\n' % (len(chunk), chunk)
+                 for chunk in chunks) + '0\r\n%s\r\n' % trailer
+
+
+class ChunkedDecoderTest(unittest.TestCase):
+  chunks = ['hello', ' ', 'x' * 5000, 'world']
+
+  def feed_pieces(self, pieces):
+    decoder = ChunkedDecoder()
+    for piece in pieces:
+      if decoder.feed(piece):
+        break
+    return decoder
+
+  def test_one_piece(self):
+    decoder = self.feed_pieces([encode_chunked(self.chunks)])
+    self.assertTrue(decoder.done)
+    self.assertEqual(''.join(decoder.chunks), ''.join(self.chunks))
+    self.assertEqual(decoder.size, len(''.join(self.chunks)))
+    self.assertEqual(decoder.leftover, '')
+
+  def test_split_everywhere(self):
+    data = encode_chunked(self.chunks)
+    decoder = self.feed_pieces(list(data))
+    self.assertTrue(decoder.done)
+    self.assertEqual(''.join(decoder.chunks), ''.join(self.chunks))
+
+  def test_every_split_point(self):
+    data = encode_chunked(['abc', 'defgh'])
+    for split in xrange(1, len(data)):
+      decoder = self.feed_pieces([data[:split], data[split:]])
+      self.assertTrue(decoder.done, split)
+      self.assertEqual(''.join(decoder.chunks), 'abcdefgh')
+
+  def test_incomplete(self):
+    data = encode_chunked(self.chunks)
+    for end in (1, 3, 10, len(data) - 1):
+      decoder = ChunkedDecoder()
+      self.assertFalse(decoder.feed(data[:end]))
+
+  def test_extensions_and_trailer(self):
+    data = '5;name=value\r\nhello\r\n0\r\nX-Checksum: 1\r\n\r\n'
+    decoder = self.feed_pieces([data])
+    self.assertTrue(decoder.done)
+    self.assertEqual(''.join(decoder.chunks), 'hello')
+
+  def test_leftover(self):
+    pipelined = 'GET / HTTP/1.1\r\n\r\n'
+    decoder = self.feed_pieces([encode_chunked(['abc']) + pipelined])
+    self.assertEqual(decoder.leftover, pipelined)
+
+  def test_negative_size(self):
+    self.assertRaises(ValueError, ChunkedDecoder().feed, '-5\r\nhello\r\n')
+
+  def test_bad_size(self):
+    self.assertRaises(ValueError, ChunkedDecoder().feed, 'zz\r\nhello\r\n')
+    self.assertRaises(ValueError, ChunkedDecoder().feed, '\r\nhello\r\n')
+
+  def test_missing_crlf(self):
+    self.assertRaises(ValueError, ChunkedDecoder().feed, '3\r\nabcXY0\r\n\r\n')
+    decoder = ChunkedDecoder()
+    decoder.feed('3\r\nabc')
+    self.assertRaises(ValueError, decoder.feed, 'XY0\r\n\r\n')
+
+  def test_oversized_size_line(self):
+    decoder = ChunkedDecoder()
+    data = '1' * (decoder.max_line_size + 1)
+    self.assertRaises(ValueError, decoder.feed, data)
+
+  def test_oversized_trailer(self):
+    decoder = ChunkedDecoder()
+    decoder.feed('0\r\n')
+    for i in xrange(decoder.max_line_size / 1024):
+      decoder.feed('X-Junk: %s\r\n' % ('x' * 1012))
+    self.assertRaises(ValueError, decoder.feed, 'x' * 1024)
+
+  def test_large_size_streams(self):
+    # a big declared size isn't held in memory, it's up to the caller to
+    # stop it with max_body_size
+    decoder = ChunkedDecoder()
+    self.assertFalse(decoder.feed('ffffffffff\r\n' + 'x' * 100))
+    self.assertEqual(decoder.size, 100)
+
+
+class DecodeChunkedTest(unittest.TestCase):
+  def test_complete(self):
+    head = 'POST / HTTP/1.1\r\n\r\n'
+    data = head + encode_chunked(['abc', 'de']) + 'next'
+    body, end = decode_chunked(data, len(head))
+    self.assertEqual(body, 'abcde')
+    self.assertEqual(data[end:], 'next')
+
+  def test_incomplete(self):
+    data = encode_chunked(['abc'])
+    self.assertEqual(decode_chunked(data[:-1], 0), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+"""Serialize accept() across preforked workers.
+
+When every child blocks on the same listening socket, each new connection
+can wake all of them and the kernel picks a winner more or less at random.
+Holding a lock around accept() means only one worker at a time is waiting for
+the next connection, which is what Apache does with its accept mutex.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+
+
+class FlockAcceptLock(object):
+  """An flock() on a shared lock file.
+
+  flock() locks belong to the open file description, so every worker has to
+  open the file itself after the fork - see post_fork().
+
+  Without a path, a private file (mode 0600, random name) is created in the
+  temp directory, which remove() deletes when the parent exits. A path that
+  is given is left in place, another server may be using it.
+  """
+  def __init__(self, path=None):
+    if path:
+      # don't follow a symlink someone left where the lock should be
+      os.close(os.open(path, os.O_CREAT | os.O_WRONLY | os.O_NOFOLLOW, 0600))
+      self._created = False
+    else:
+      fd, path = tempfile.mkstemp(prefix='wiseguy-accept-', suffix='.lock')
+      os.close(fd)
+      self._created = True
+    self.path = path
+    self._owner_pid = os.getpid()
+    self._fd = None
+
+  def post_fork(self):
+    if self._fd is not None:
+      os.close(self._fd)
+    self._fd = os.open(self.path, os.O_WRONLY | os.O_NOFOLLOW)
+
+  def acquire(self, blocking=True, timeout=None):
+    """Returns False if the lock wasn't taken.
+
+    flock() can't time out, so timeout is ignored - but unlike a semaphore
+    it gives up when a signal arrives, which is what the timeout is for."""
+    flags = fcntl.LOCK_EX
+    if not blocking:
+      flags |= fcntl.LOCK_NB
+    try:
+      fcntl.flock(self._fd, flags)
+    except IOError, e:
+      if not blocking and e[0] in (errno.EACCES, errno.EAGAIN):
+        return False
+      if e[0] == errno.EINTR:
+        return False
+      raise
+    return True
+
+  def release(self):
+    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def remove(self):
+    """Delete the lock file if it was created here, from the parent."""
+    if not self._created or os.getpid() != self._owner_pid:
+      return
+    try:
+      os.remove(self.path)
+    except OSError, e:
+      if e[0] != errno.ENOENT:
+        logging.warning('unable to remove accept lock file %s: %s',
+                        self.path, e)
+
+
+class SemaphoreAcceptLock(object):
+  """A process-shared semaphore created in the parent before forking."""
+  def __init__(self):
+    # python2.6 only, so don't import it until someone asks for it
+    import multiprocessing
+    self._lock = multiprocessing.Lock()
+
+  def post_fork(self):
+    pass
+
+  def acquire(self, blocking=True, timeout=None):
+    """Returns False if the lock wasn't taken.
+
+    A signal doesn't interrupt the wait, so use a timeout to notice one."""
+    if not blocking:
+      return self._lock.acquire(False)
+    return self._lock.acquire(True, timeout)
+
+  def release(self):
+    self._lock.release()
+
+  def remove(self):
+    pass
+
+
+def get_accept_lock(lock_type, path=None):
+  if lock_type == 'flock':
+    lock = FlockAcceptLock(path)
+    logging.info('using accept lock file %s', lock.path)
+    return lock
+  elif lock_type == 'semaphore':
+    return SemaphoreAcceptLock()
+  raise ValueError('unknown accept lock: %s' % lock_type)
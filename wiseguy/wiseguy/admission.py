@@ -0,0 +1,120 @@
+"""Admission control - turn requests away quickly when the workers are swamped.
+
+Once every worker is busy, new connections wait in the listen backlog until
+a worker gets to them, however long that takes. The work still gets done,
+just too late for clients that have given up, and everything behind it
+waits longer too. Shedding answers 503 with a Retry-After before the
+application runs, which takes a worker a fraction of a millisecond instead
+of a whole request, so the backlog drains and the requests that are let in
+are answered in time.
+
+A request is shed when either of these goes over its threshold:
+  queue time - how long the request waited before a worker started reading
+    it. From X-Request-Start when the load balancer sends one (see
+    queue_monitor.py), otherwise estimated from the listen backlog and the
+    worker's average request time.
+  busy ratio - the fraction of the other request slots in the middle of a
+    request, from the scoreboard. Only while connections are waiting in the
+    backlog - a worker that is free to serve the request in hand doesn't
+    help anyone by refusing it unless there's a queue behind it.
+
+Requests are put in a priority class by the first path pattern they match,
+and the class scales the thresholds - low priority requests go first and
+high priority ones are never shed.
+
+Each worker decides for itself. The backlog is checked for every request,
+which is one getsockopt(), the scoreboard only every check_interval seconds.
+"""
+
+import re
+
+# priority class -> the fraction of the thresholds where it is shed. None
+# means never shed.
+default_priority_classes = {
+  'high': None,
+  'normal': 1.0,
+  'low': 0.5,
+  }
+default_priority = 'normal'
+
+
+class AdmissionControl(object):
+  # seconds between looks at the scoreboard
+  check_interval = 0.1
+  # weight of each request in the average request time
+  request_time_smoothing = 0.05
+
+  def __init__(self, max_queue_time=None, max_busy_ratio=None,
+               priorities=None, priority_classes=None, retry_after=1):
+    """max_queue_time - seconds a request can wait before it is shed
+    max_busy_ratio - 0.0 to 1.0
+    priorities - a list of (path regex, priority class), the first match
+      wins and anything else is 'normal'
+    priority_classes - a dict of priority class to threshold fraction,
+      see default_priority_classes
+    retry_after - seconds, for the Retry-After header
+    """
+    self.max_queue_time = max_queue_time
+    self.max_busy_ratio = max_busy_ratio
+    if priority_classes is None:
+      priority_classes = default_priority_classes
+    self.priority_classes = priority_classes
+    self._priorities = []
+    for pattern, priority in priorities or []:
+      if priority not in priority_classes:
+        raise ValueError('unknown priority class: %s' % priority)
+      self._priorities.append((re.compile(pattern), priority))
+    self.retry_after = retry_after
+    # smoothed seconds per request for this worker
+    self.request_time = None
+    self.busy_ratio = 0.0
+    # how many requests are served from the same backlog at once
+    self.concurrency = 1
+    self._last_update_time = 0.0
+
+  def needs_update(self, now):
+    return now - self._last_update_time >= self.check_interval
+
+  def update(self, busy_ratio, concurrency, now):
+    """busy_ratio - of the other request slots
+    concurrency - how many requests are served from the backlog at once
+    """
+    self._last_update_time = now
+    self.busy_ratio = busy_ratio
+    self.concurrency = max(1, concurrency)
+
+  def estimate_queue_time(self, queued):
+    """How long the last of queued connections will wait."""
+    if not queued or self.request_time is None:
+      return 0.0
+    return queued * self.request_time / self.concurrency
+
+  def request_done(self, elapsed):
+    if self.request_time is None:
+      self.request_time = elapsed
+    else:
+      self.request_time += self.request_time_smoothing * (
+        elapsed - self.request_time)
+
+  def get_priority(self, path):
+    for pattern, priority in self._priorities:
+      if pattern.match(path):
+        return priority
+    return default_priority
+
+  def should_shed(self, priority, queue_time=None, queued=None):
+    """queue_time - measured from X-Request-Start, if there was one
+    queued - connections waiting in the listen backlog, None if unknown
+    """
+    fraction = self.priority_classes[priority]
+    if fraction is None:
+      return False
+    if self.max_queue_time is not None:
+      if queue_time is None:
+        queue_time = self.estimate_queue_time(queued)
+      if queue_time > self.max_queue_time * fraction:
+        return True
+    if self.max_busy_ratio is not None and queued != 0:
+      if self.busy_ratio >= self.max_busy_ratio * fraction:
+        return True
+    return False
@@ -0,0 +1,242 @@
+"""Attribute memory growth to where it was allocated, per REQUEST_URI.
+
+A sample of requests run between two snapshots of the heap, and the
+difference is added up by REQUEST_URI and allocation site. Growth that
+shows up request after request for the same uri is usually a cache with no
+limit or a leak.
+
+With tracemalloc (python3, or pytracemalloc on a patched python2) the site
+is the file and line that allocated the memory, and sizes are in bytes.
+Without it, the gc module is used instead - the 'site' is the type of the
+object and only counts are known, but that's often enough to find the
+dict or list that keeps growing. Both are far too slow to run on every
+request, hence sample_rate.
+
+Garbage is collected before each snapshot so only memory that is still
+reachable after the request is counted. With threaded workers the other
+threads' allocations during a sampled request are counted against it too.
+
+Each worker writes its totals to a file of its own now and then, which the
+parent merges for the management server, like stack_sampler.py. The query
+string is left off the uri, and past max_uris distinct uris the rest are
+lumped together, so a worker's totals can't grow without limit.
+"""
+
+import errno
+import gc
+import logging
+import marshal
+import os
+import random
+import threading
+import time
+
+from wiseguy import stack_sampler
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+# the most sites kept for each sampled request
+top_sites = 20
+# what requests are totalled under once there are max_uris
+other_uri = '(other)'
+
+
+class AllocProfiler(object):
+  # how often the totals are written out, see maybe_dump()
+  dump_interval = 10.0
+  # tracemalloc frames to keep, only the innermost is reported
+  traceback_limit = 1
+  # the most distinct uris totalled separately, see other_uri
+  max_uris = 1000
+  # how often to look for the parent clearing the totals
+  clear_check_interval = 1.0
+
+  def __init__(self, path, sample_rate=0.01):
+    """path - where to write the totals for this process
+    sample_rate - the fraction of requests to profile
+    """
+    self.path = path
+    self.sample_rate = sample_rate
+    # uri -> [sampled requests, {site: [size, count]}]
+    self.uri_totals = {}
+    self._last_dump_time = time.time()
+    self._last_clear_check_time = time.time()
+    self._cleared_time = stack_sampler.get_cleared_time(
+      os.path.dirname(path))
+    # the heap is shared, so one sampled request at a time
+    self._lock = threading.Lock()
+    if tracemalloc is not None:
+      self.method = 'tracemalloc'
+    else:
+      self.method = 'gc'
+
+  def start(self):
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+      tracemalloc.start(self.traceback_limit)
+
+  def stop(self):
+    if tracemalloc is not None and tracemalloc.is_tracing():
+      tracemalloc.stop()
+
+  def before_request(self):
+    """Return a snapshot if this request is sampled, otherwise None."""
+    if random.random() >= self.sample_rate:
+      return None
+    if not self._lock.acquire(False):
+      return None
+    try:
+      return self._snapshot()
+    except:
+      self._lock.release()
+      raise
+
+  def after_request(self, snapshot, uri):
+    """Add the growth since snapshot to the totals for uri."""
+    try:
+      sites = self._compare(snapshot, self._snapshot())
+    finally:
+      self._lock.release()
+    sites.sort(key=lambda x: (x[1], x[2]), reverse=True)
+    uri = uri.split('?', 1)[0]
+    if uri not in self.uri_totals and len(self.uri_totals) >= self.max_uris:
+      uri = other_uri
+    totals = self.uri_totals.setdefault(uri, [0, {}])
+    totals[0] += 1
+    site_totals = totals[1]
+    for site, size, count in sites[:top_sites]:
+      if size <= 0 and count <= 0:
+        break
+      site_total = site_totals.setdefault(site, [0, 0])
+      site_total[0] += size
+      site_total[1] += count
+
+  def _snapshot(self):
+    gc.collect()
+    if self.method == 'tracemalloc':
+      return tracemalloc.take_snapshot()
+    type_counts = {}
+    for obj in gc.get_objects():
+      name = type(obj).__name__
+      type_counts[name] = type_counts.get(name, 0) + 1
+    return type_counts
+
+  def _compare(self, old_snapshot, new_snapshot):
+    """Return a list of (site, size, count) for everything that changed."""
+    if self.method == 'tracemalloc':
+      return [(str(stat.traceback[0]), stat.size_diff, stat.count_diff)
+              for stat in new_snapshot.compare_to(old_snapshot, 'lineno')]
+    sites = []
+    for name, count in new_snapshot.iteritems():
+      count_diff = count - old_snapshot.get(name, 0)
+      if count_diff:
+        sites.append(('gc:%s' % name, 0, count_diff))
+    return sites
+
+  def maybe_dump(self):
+    """Write the totals if it's been a while, call between requests."""
+    now = time.time()
+    if now - self._last_clear_check_time >= self.clear_check_interval:
+      self._check_cleared(now)
+    if now - self._last_dump_time >= self.dump_interval:
+      self.dump()
+
+  def _check_cleared(self, now):
+    self._last_clear_check_time = now
+    cleared_time = stack_sampler.get_cleared_time(os.path.dirname(self.path))
+    if cleared_time != self._cleared_time:
+      # start over, or the next dump puts back what was cleared
+      self._cleared_time = cleared_time
+      self.uri_totals = {}
+
+  def dump(self):
+    now = time.time()
+    self._check_cleared(now)
+    self._last_dump_time = now
+    # write and rename so the parent never reads a partial file
+    tmp_path = '%s.tmp' % self.path
+    try:
+      f = open(tmp_path, 'wb')
+      try:
+        marshal.dump((self.method, self.uri_totals), f)
+      finally:
+        f.close()
+      os.rename(tmp_path, self.path)
+    except (IOError, OSError), e:
+      logging.warning('unable to write memory profile %s: %s', self.path, e)
+
+
+def get_profile_path(directory, pid):
+  return os.path.join(directory, '%s.allocs' % pid)
+
+
+def merge_profiles(directory, pids=None):
+  """Merge the totals from every worker (or just pids) in directory.
+
+  Returns (methods, uri_totals)."""
+  methods = set()
+  uri_totals = {}
+  try:
+    filenames = os.listdir(directory)
+  except OSError, e:
+    if e[0] == errno.ENOENT:
+      return methods, uri_totals
+    raise
+  for filename in filenames:
+    name, ext = os.path.splitext(filename)
+    if ext != '.allocs':
+      continue
+    if pids is not None and name not in [str(pid) for pid in pids]:
+      continue
+    try:
+      f = open(os.path.join(directory, filename), 'rb')
+      try:
+        method, worker_totals = marshal.load(f)
+      finally:
+        f.close()
+    except (IOError, EOFError, ValueError, TypeError), e:
+      # probably a worker replacing its file
+      logging.debug('merge_profiles %s: %s', filename, e)
+      continue
+    methods.add(method)
+    for uri, (requests, site_totals) in worker_totals.iteritems():
+      totals = uri_totals.setdefault(uri, [0, {}])
+      totals[0] += requests
+      for site, (size, count) in site_totals.iteritems():
+        site_total = totals[1].setdefault(site, [0, 0])
+        site_total[0] += size
+        site_total[1] += count
+  return methods, uri_totals
+
+
+def format_report(methods, uri_totals, limit=top_sites):
+  """Render merge_profiles() output as plain text, uris that grew the most
+  first."""
+  lines = ['# memory growth by REQUEST_URI and allocation site (%s)' % (
+    ', '.join(sorted(methods)) or 'no samples')]
+  # the gc module only counts objects
+  show_sizes = 'tracemalloc' in methods
+  def growth(item):
+    uri, (requests, site_totals) = item
+    return (sum(size for size, count in site_totals.itervalues()),
+            sum(count for size, count in site_totals.itervalues()))
+  for uri, (requests, site_totals) in sorted(
+    uri_totals.iteritems(), key=growth, reverse=True):
+    size, count = growth((uri, (requests, site_totals)))
+    lines.append('')
+    if show_sizes:
+      lines.append('%s  sampled: %s  bytes: %+d  objects: %+d' % (
+        uri or '-', requests, size, count))
+    else:
+      lines.append('%s  sampled: %s  objects: %+d' % (
+        uri or '-', requests, count))
+    sites = sorted(site_totals.iteritems(), key=lambda x: tuple(x[1]),
+                   reverse=True)
+    for site, (size, count) in sites[:limit]:
+      if show_sizes:
+        lines.append('  %12s %10s  %s' % ('%+d' % size, '%+d' % count, site))
+      else:
+        lines.append('  %10s  %s' % ('%+d' % count, site))
+  return '\n'.join(lines) + '\n'
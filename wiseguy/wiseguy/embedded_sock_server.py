@@ -173,11 +173,19 @@ class EmbeddedSockServer(SocketServer.UnixStreamServer):
     SocketServer.UnixStreamServer.server_activate(self)
     self._activated = True
 
+  @property
+  def _serving(self):
+    # shutdown() clears __serving in python 2.6, 2.7 sets __shutdown_request
+    # instead
+    return (self._BaseServer__serving and
+            not getattr(self, '_BaseServer__shutdown_request', False))
+
   def serve_forever(self, poll_interval=0.5):
     logging.info('started %s', self)
     self._BaseServer__serving = True
+    self._BaseServer__shutdown_request = False
     self._BaseServer__is_shut_down.clear()
-    while self._BaseServer__serving:
+    while self._serving:
       try:
         ready_rfds, ready_wfds, error_fds = select.select(
           [self], [], [], poll_interval)
@@ -191,7 +199,7 @@ class EmbeddedSockServer(SocketServer.UnixStreamServer):
           raise
       # double check the variable here in case we tried to shutdown
       # in a shorter time than poll_interval (likely)
-      if ready_rfds and self._BaseServer__serving:
+      if ready_rfds and self._serving:
         try:
           self._handle_request_noblock()
         except:
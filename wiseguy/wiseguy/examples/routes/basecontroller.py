@@ -4,6 +4,8 @@ class BaseController():
         self.environ = environ
         self.start_response = start_response
         self.args = self.extract_args()
+        # {name} segments of the route, see RoutesApp
+        self.args.update(environ.get('wiseguy.route_args', {}))
         self.status = ''
         self.response = ''
         self.response_headers = []
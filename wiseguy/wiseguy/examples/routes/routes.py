@@ -3,13 +3,14 @@
     TODO:
     1) Securify the module loading process
     2) Check module loading to see if module is in sys.path already
-    3) Build RegExRoutesApp as subclass
 '''
 import logging
 import pprint
 import random
+import re
 import time
 import sys
+from wiseguy import request_timer
 from wiseguy.examples.routes.basecontroller import BaseController
 
 '''
@@ -21,38 +22,147 @@ modulepath = 'wiseguy.examples.routes.'
 '''
     Some simple samples. Probably move to config or db or whatever
     you like for getting routes. memcache might work nicely too
+
+    A path segment like {name} matches anything up to the next /, but not
+    nothing, and {name:regex} only what regex matches. The values end up in
+    environ['wiseguy.route_args'].
 '''
 routes = []
 routes.append(('/', 'Controller.index'))
 routes.append(('/hello', 'Controller.hello'))
+routes.append(('/hello/{name}', 'Controller.hello'))
+
+route_args_environ_key = 'wiseguy.route_args'
+param_pattern = re.compile(r'^\{(\w+)(?::(.*))?\}$')
+
+
+class RouteNode():
+    '''
+        One path segment of the pattern routes. Plain segments are looked
+        up in a dict, so matching a path costs one lookup per segment no
+        matter how many routes there are.
+    '''
+    def __init__(self):
+        self.static = {}
+        # (name, compiled regex or None, RouteNode), tried in order
+        self.params = []
+        # (pattern, controller, func_name) if a route ends here
+        self.target = None
+
+    def match(self, segments, index, args):
+        if index == len(segments):
+            return self.target
+        segment = segments[index]
+        child = self.static.get(segment)
+        if child is not None:
+            target = child.match(segments, index + 1, args)
+            if target is not None:
+                return target
+        if not segment:
+            # /hello/ isn't /hello/{name} with an empty name
+            return None
+        for name, regex, child in self.params:
+            if regex is not None and not regex.match(segment):
+                continue
+            target = child.match(segments, index + 1, args)
+            if target is not None:
+                args[name] = segment
+                return target
+        return None
+
 
 class RoutesApp():
+    '''
+        Dispatch is worked out once, up front: paths with no {} in them go
+        in a dict and the rest in a tree of RouteNodes. Controllers are
+        imported when the app is built as well, so with --preload-app that
+        happens in the parent before forking and requests never call
+        __import__.
+
+        Where more than one route could match, the first plain path wins,
+        and for patterns plain segments are preferred over {} ones.
+    '''
     def __init__(self, routes=None):
         if routes == None:
             routes = []
         self.routes = routes
-        
+        self._controllers = {}
+        self._static_routes = {}
+        self._pattern_routes = RouteNode()
+        for pattern, target in routes:
+            self.add_route(pattern, target)
+
+    def add_route(self, pattern, target):
+        module_name, func_name = target.split('.', 1)
+        controller = self.load_controller(module_name)
+        if controller is None:
+            logging.error('no controller %s for route %s', module_name,
+                          pattern)
+            return
+        route = (pattern, controller, func_name)
+        if '{' not in pattern:
+            self._static_routes.setdefault(pattern, route)
+            return
+        node = self._pattern_routes
+        for segment in pattern.split('/'):
+            match = param_pattern.match(segment)
+            if match is None:
+                node = node.static.setdefault(segment, RouteNode())
+                continue
+            name, regex = match.groups()
+            if regex is not None:
+                regex = re.compile('(?:%s)$' % regex)
+            for param_name, param_regex, child in node.params:
+                if (param_name == name and
+                    getattr(param_regex, 'pattern', None) ==
+                    getattr(regex, 'pattern', None)):
+                    node = child
+                    break
+            else:
+                child = RouteNode()
+                node.params.append((name, regex, child))
+                node = child
+        if node.target is None:
+            node.target = route
+
+    def match(self, path):
+        '''Return ((pattern, controller, func_name), args) or (None, None).'''
+        route = self._static_routes.get(path)
+        if route is not None:
+            return route, {}
+        args = {}
+        route = self._pattern_routes.match(path.split('/'), 0, args)
+        if route is None:
+            return None, None
+        return route, args
+
     def __call__(self, environ, start_response):
         path = environ.get('PATH_INFO','')
 
-        for route in self.routes:
-            if path == route[0]:
-                module_name, func_name = route[1].split('.', 1)
-                controller = self.load_controller(module_name)
-                ctrl = controller(environ, start_response)
-                func = getattr(ctrl, func_name)
-                return func()
+        route, args = self.match(path)
+        if route is not None:
+            pattern, controller, func_name = route
+            environ[request_timer.route_environ_key] = pattern
+            environ[route_args_environ_key] = args
+            ctrl = controller(environ, start_response)
+            func = getattr(ctrl, func_name)
+            return func()
 
         ctrl = BaseController(environ, start_response)
         return ctrl.send404()
 
     def load_controller(self, modulename):
+        try:
+            return self._controllers[modulename]
+        except KeyError:
+            pass
         try:
             module = __import__(modulepath + modulename.lower(), globals(), locals(), [modulename])
         except ImportError:
             return None
-        return vars(module)[modulename]
+        controller = self._controllers[modulename] = vars(module)[modulename]
+        return controller
 
 
 app = RoutesApp(routes)
-    
+
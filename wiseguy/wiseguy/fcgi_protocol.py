@@ -0,0 +1,365 @@
+"""A pure python FastCGI responder.
+
+libfcgi, underneath the fastcgi module, reads one request from a connection
+and won't look at the connection again until that request is finished, so a
+web server has to open a new connection for every request it sends. This
+parses the records itself instead. A worker can then keep connections open
+when the web server sets FCGI_KEEP_CONN, and accept any number of requests
+multiplexed onto one connection, serving them one after another as each is
+complete.
+
+Request objects look enough like fcgi.Request (environ, stdin, stdout and
+stderr) for fastcgi.WSGI.WSGIMixIn, but must be finish()ed by the server.
+
+Record layout and constants are from the FastCGI 1.0 specification.
+"""
+
+import cStringIO
+import errno
+import logging
+import socket
+import struct
+
+FCGI_VERSION_1 = 1
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_DATA = 8
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+FCGI_UNKNOWN_TYPE = 11
+
+FCGI_NULL_REQUEST_ID = 0
+
+# FCGI_BEGIN_REQUEST flags and roles
+FCGI_KEEP_CONN = 1
+FCGI_RESPONDER = 1
+
+# FCGI_END_REQUEST protocol status
+FCGI_REQUEST_COMPLETE = 0
+FCGI_CANT_MPX_CONN = 1
+FCGI_OVERLOADED = 2
+FCGI_UNKNOWN_ROLE = 3
+
+header_format = '!BBHHBx'
+header_size = struct.calcsize(header_format)
+begin_request_format = '!HB5x'
+end_request_format = '!LB3x'
+max_content_size = 0xffff
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def pack_record(record_type, request_id, content=''):
+  # pad to a multiple of 8 bytes, as the spec recommends
+  padding = -len(content) & 7
+  return ''.join((struct.pack(header_format, FCGI_VERSION_1, record_type,
+                              request_id, len(content), padding),
+                  content, '\0' * padding))
+
+
+def pack_stream(record_type, request_id, data):
+  """Split data into as many records as it takes."""
+  return ''.join(pack_record(record_type, request_id,
+                             data[i:i + max_content_size])
+                 for i in xrange(0, len(data), max_content_size))
+
+
+def _pack_length(length):
+  if length < 0x80:
+    return chr(length)
+  return struct.pack('!L', length | 0x80000000)
+
+
+def encode_pairs(pairs):
+  return ''.join('%s%s%s%s' % (_pack_length(len(name)),
+                               _pack_length(len(value)), name, value)
+                 for name, value in pairs)
+
+
+def decode_pairs(data):
+  """Return the name-value pairs in data as a dict."""
+  pairs = {}
+  offset = 0
+  end = len(data)
+  try:
+    while offset < end:
+      lengths = []
+      for i in xrange(2):
+        length = ord(data[offset])
+        if length & 0x80:
+          length = struct.unpack('!L', data[offset:offset + 4])[0] & 0x7fffffff
+          offset += 4
+        else:
+          offset += 1
+        lengths.append(length)
+      name_length, value_length = lengths
+      name = data[offset:offset + name_length]
+      offset += name_length
+      value = data[offset:offset + value_length]
+      offset += value_length
+      if offset > end:
+        raise ProtocolError('truncated name-value pair')
+      pairs[name] = value
+  except (IndexError, struct.error):
+    raise ProtocolError('truncated name-value pair')
+  return pairs
+
+
+class OutputStream(object):
+  """stdout or stderr of a request, sent as records of record_type."""
+  # collect this much before sending a record, the application's writes are
+  # often tiny
+  buffer_size = 8 * 1024
+
+  def __init__(self, request, record_type):
+    self._request = request
+    self._record_type = record_type
+    self._buffer = []
+    self._buffer_bytes = 0
+    # whether anything has been written, an empty stderr stream isn't sent
+    self.used = False
+
+  def write(self, data):
+    if not data:
+      return
+    self.used = True
+    self._buffer.append(data)
+    self._buffer_bytes += len(data)
+    if self._buffer_bytes >= self.buffer_size:
+      self.flush()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    if self._buffer:
+      data = ''.join(self._buffer)
+      self._buffer = []
+      self._buffer_bytes = 0
+      self._request.connection.send(
+        pack_stream(self._record_type, self._request.request_id, data))
+
+  def close(self):
+    """Flush and mark the end of the stream."""
+    data = ''.join(self._buffer)
+    self._buffer = []
+    self._buffer_bytes = 0
+    return (pack_stream(self._record_type, self._request.request_id, data) +
+            pack_record(self._record_type, self._request.request_id))
+
+
+class Request(object):
+  def __init__(self, connection, request_id, keep_conn):
+    self.connection = connection
+    self.request_id = request_id
+    self.keep_conn = keep_conn
+    self.environ = {}
+    self.stdin = cStringIO.StringIO()
+    self.stdout = OutputStream(self, FCGI_STDOUT)
+    self.stderr = OutputStream(self, FCGI_STDERR)
+    # set when the web server gives up on the request
+    self.aborted = False
+    self.finished = False
+    self._params = []
+    self._params_done = False
+    self._stdin_done = False
+
+  @property
+  def complete(self):
+    return self._params_done and self._stdin_done
+
+  def add_params(self, data):
+    if data:
+      self._params.append(data)
+      return
+    self.environ = decode_pairs(''.join(self._params))
+    self._params = None
+    self._params_done = True
+
+  def add_stdin(self, data):
+    if data:
+      self.stdin.write(data)
+      return
+    self.stdin = cStringIO.StringIO(self.stdin.getvalue())
+    self._stdin_done = True
+
+  def finish(self, app_status=0):
+    """Send the rest of the response and end the request."""
+    if self.finished:
+      return
+    self.finished = True
+    data = self.stdout.close()
+    if self.stderr.used:
+      data += self.stderr.close()
+    data += pack_record(FCGI_END_REQUEST, self.request_id, struct.pack(
+      end_request_format, app_status, FCGI_REQUEST_COMPLETE))
+    try:
+      self.connection.send(data)
+    except IOError, e:
+      logging.debug('fcgi request %s finish failed: %s', self.request_id, e)
+    self.connection.request_finished(self)
+
+
+class Connection(object):
+  """A connection from the web server, and the requests arriving on it."""
+  recv_size = 64 * 1024
+  # advertised in reply to FCGI_GET_VALUES
+  max_conns = 1024
+  max_reqs = 1024
+
+  def __init__(self, sock):
+    self.socket = sock
+    self.closed = False
+    # requests that have fully arrived, in order
+    self.ready = []
+    # request id -> Request, for every request that hasn't finished
+    self._requests = {}
+    self._data = ''
+    # don't close until the requests in progress are done
+    self._close_when_idle = False
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  def read(self):
+    """Read what's available and parse any complete records.
+
+    Returns False once the connection is closed."""
+    try:
+      data = self.socket.recv(self.recv_size)
+    except socket.error, e:
+      if e[0] in (errno.EAGAIN, errno.EINTR):
+        return True
+      logging.debug('fcgi connection read failed: %s', e)
+      data = ''
+    if not data:
+      # the web server hung up, nothing can be sent back now
+      self.close()
+      return False
+    self._data += data
+    offset = 0
+    try:
+      while len(self._data) - offset >= header_size:
+        (version, record_type, request_id, content_length,
+         padding_length) = struct.unpack(
+          header_format, self._data[offset:offset + header_size])
+        if version != FCGI_VERSION_1:
+          raise ProtocolError('unknown version %s' % version)
+        record_end = offset + header_size + content_length + padding_length
+        if len(self._data) < record_end:
+          break
+        content_start = offset + header_size
+        self._handle_record(
+          record_type, request_id,
+          self._data[content_start:content_start + content_length])
+        offset = record_end
+    except ProtocolError, e:
+      logging.warning('fcgi protocol error: %s', e)
+      self.close()
+      return False
+    self._data = self._data[offset:]
+    return not self.closed
+
+  def _handle_record(self, record_type, request_id, content):
+    if request_id == FCGI_NULL_REQUEST_ID:
+      self._handle_management_record(record_type, content)
+      return
+
+    if record_type == FCGI_BEGIN_REQUEST:
+      if len(content) < 8:
+        raise ProtocolError('truncated begin request record')
+      role, flags = struct.unpack(begin_request_format, content[:8])
+      if role != FCGI_RESPONDER:
+        self._end_request(request_id, FCGI_UNKNOWN_ROLE)
+        return
+      self._requests[request_id] = Request(
+        self, request_id, bool(flags & FCGI_KEEP_CONN))
+      return
+
+    request = self._requests.get(request_id)
+    if request is None:
+      # the spec says to ignore records for requests we don't know about
+      return
+    if record_type == FCGI_PARAMS:
+      request.add_params(content)
+    elif record_type == FCGI_STDIN:
+      request.add_stdin(content)
+    elif record_type == FCGI_ABORT_REQUEST:
+      self._abort_request(request)
+      return
+    else:
+      # FCGI_DATA is only for the filter role
+      return
+    if request.complete and request not in self.ready:
+      self.ready.append(request)
+
+  def _handle_management_record(self, record_type, content):
+    if record_type == FCGI_GET_VALUES:
+      values = {
+        'FCGI_MAX_CONNS': str(self.max_conns),
+        'FCGI_MAX_REQS': str(self.max_reqs),
+        'FCGI_MPXS_CONNS': '1',
+        }
+      pairs = [(name, values[name]) for name in decode_pairs(content)
+               if name in values]
+      self.send(pack_record(FCGI_GET_VALUES_RESULT, FCGI_NULL_REQUEST_ID,
+                            encode_pairs(pairs)))
+    else:
+      self.send(pack_record(FCGI_UNKNOWN_TYPE, FCGI_NULL_REQUEST_ID,
+                            chr(record_type) + '\0' * 7))
+
+  def _abort_request(self, request):
+    if request in self.ready:
+      # not started yet, just drop it
+      self.ready.remove(request)
+      request.finished = True
+      del self._requests[request.request_id]
+      self._end_request(request.request_id, FCGI_REQUEST_COMPLETE)
+    elif not request.complete:
+      request.finished = True
+      del self._requests[request.request_id]
+      self._end_request(request.request_id, FCGI_REQUEST_COMPLETE)
+    else:
+      # it's running, there's no way to interrupt the application so the
+      # response is sent as usual
+      request.aborted = True
+
+  def _end_request(self, request_id, protocol_status):
+    self.send(pack_record(FCGI_END_REQUEST, request_id, struct.pack(
+      end_request_format, 0, protocol_status)))
+
+  def send(self, data):
+    if self.closed:
+      raise IOError('Write failed', 'connection closed')
+    try:
+      self.socket.sendall(data)
+    except socket.error, e:
+      self.close()
+      # the same error libfcgi gives, see ManagedServer._handle_io_error
+      raise IOError('Write failed', str(e))
+
+  def request_finished(self, request):
+    self._requests.pop(request.request_id, None)
+    if not request.keep_conn:
+      self._close_when_idle = True
+    if self._close_when_idle and not self._requests:
+      self.close()
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    self.ready = []
+    try:
+      self.socket.close()
+    except socket.error:
+      pass
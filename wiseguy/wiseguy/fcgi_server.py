@@ -1,20 +1,43 @@
 import errno
 import logging
 import os
+import select
 import socket
 import stat
 import sys
 
-from fastcgi import fcgi
+try:
+  from fastcgi import fcgi
+except ImportError:
+  fcgi = None
 try:
   from wiseguy import fd_server
 except ImportError:
   # fd_server is python2.6 only
   fd_server = None
+from wiseguy import fcgi_protocol
 from wiseguy import managed_server
 
+# 'libfcgi' - the fastcgi module, one request per connection at a time
+# 'python' - fcgi_protocol, which keeps connections open when the web server
+#   asks and accepts multiplexed requests
+protocols = ('libfcgi', 'python')
+
 
 class FCGIServer(managed_server.ManagedServer):
+  # how often idle request threads check whether the child is quitting
+  thread_poll_interval = 1.0
+
+  def __init__(self, *pargs, **kargs):
+    self._protocol = kargs.pop('protocol', None)
+    if self._protocol is None:
+      self._protocol = fcgi and 'libfcgi' or 'python'
+    if self._protocol not in protocols:
+      raise ValueError('unknown protocol: %s' % self._protocol)
+    if self._protocol == 'libfcgi' and fcgi is None:
+      raise ImportError('the libfcgi protocol requires the fastcgi module')
+    managed_server.ManagedServer.__init__(self, *pargs, **kargs)
+
   @property
   def server_address(self):
     return self._server_address
@@ -67,7 +90,8 @@ class FCGIServer(managed_server.ManagedServer):
     self.lock_startup()
     if self._listen_socket:
       # NOTE: does listening with too much backlog break FIFO queuing? does this mean
-      # a slow worker will make some requests wait unfairly?
+      # a slow worker will make some requests wait unfairly? /server-queue
+      # shows how deep the backlog actually gets, see queue_monitor.py
       self._listen_socket.listen(socket.SOMAXCONN)
       self._listen_fd = self._listen_socket.fileno()
 
@@ -76,18 +100,101 @@ class FCGIServer(managed_server.ManagedServer):
     if not stat.S_ISSOCK(mode):
       raise managed_server.WiseguyError("no listening socket available")
 
-    # 0 is 'flags' - I hate magic parameters
-    self._fcgi_request = fcgi.Request(
-      self._listen_fd, 0)
+    if self._protocol == 'libfcgi':
+      # 0 is 'flags' - I hate magic parameters
+      self._fcgi_request = fcgi.Request(
+        self._listen_fd, 0)
+    elif self._listen_socket is None:
+      self._listen_socket = socket.fromfd(
+        self._listen_fd, self.socket_type, socket.SOCK_STREAM)
     super(FCGIServer, self).server_activate()
 
+  def init_child(self):
+    if self._protocol == 'python':
+      # every worker waits on the listening socket in select(), so several
+      # may wake for one connection
+      self._listen_socket.setblocking(False)
+    managed_server.ManagedServer.init_child(self)
+
   def get_request(self):
+    if self._protocol == 'python':
+      return self._get_multiplexed_request()
     # this is a little janky, the object upon which we call accept() is actually
     # used as a request. very fun for multithreading. for now, just make it
     # look like this operates like most other python servers
-    self._fcgi_request.accept()
+    if self._threads > 1:
+      # each request thread needs a request object of its own. note that
+      # accept() blocks in C, so a thread waiting there won't notice _quit -
+      # the child exits once the busy threads are done.
+      fcgi_request = getattr(self._local, 'fcgi_request', None)
+      if fcgi_request is None:
+        fcgi_request = self._local.fcgi_request = fcgi.Request(
+          self._listen_fd, 0)
+    else:
+      fcgi_request = self._fcgi_request
+    fcgi_request.accept()
     # fixme: client_address is always None
-    return (self._fcgi_request, None)
+    return (fcgi_request, None)
+
+  def _get_multiplexed_request(self):
+    # each request thread looks after its own connections
+    connections = getattr(self._local, 'fcgi_connections', None)
+    if connections is None:
+      connections = self._local.fcgi_connections = []
+    for connection in connections:
+      if connection.ready:
+        # this rotates through the connections, so one busy one doesn't
+        # starve the others
+        connections.remove(connection)
+        connections.append(connection)
+        return (connection.ready.pop(0), None)
+
+    if self._threads > 1:
+      timeout = self.thread_poll_interval
+    else:
+      timeout = None
+    readable = select.select(
+      [self._listen_socket] + connections, [], [], timeout)[0]
+    for ready in readable:
+      if ready is self._listen_socket:
+        try:
+          sock, address = self._listen_socket.accept()
+        except socket.error, e:
+          if e[0] in (errno.EAGAIN, errno.ECONNABORTED):
+            # another worker got it
+            continue
+          raise
+        sock.setblocking(True)
+        if self.socket_type == socket.AF_INET:
+          # responses go out in a few writes, don't let the last one wait on
+          # the ack for the first
+          sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connections.append(fcgi_protocol.Connection(sock))
+      elif not ready.read():
+        connections.remove(ready)
+    # nothing to do yet, come back through handle_request()
+    raise socket.error(errno.EAGAIN, 'no request ready')
+
+  def close_request(self, request):
+    if self._protocol == 'python':
+      request.finish()
+      connections = getattr(self._local, 'fcgi_connections', [])
+      if request.connection.closed and request.connection in connections:
+        connections.remove(request.connection)
+    managed_server.ManagedServer.close_request(self, request)
+
+  def exit_child(self):
+    if self._protocol == 'python':
+      # requests that have already arrived are answered rather than dropped
+      # with the connection. only this thread's connections are reachable,
+      # the other request threads have their own.
+      for connection in getattr(self._local, 'fcgi_connections', []):
+        while connection.ready:
+          request = connection.ready.pop(0)
+          self.process_request(request, None)
+          request.finish()
+        connection.close()
+    managed_server.ManagedServer.exit_child(self)
 
   def handle(self, req):
     """Vaguely named, usually provided by the WSGIMix"""
@@ -0,0 +1,796 @@
+"""A buffering front end for the preforking http server.
+
+Slow clients are expensive for a preforking server. A worker is tied up
+for as long as it takes a phone on a bad connection to upload a request
+body or to read the response. With a front end, one process that does
+nothing but shuffle bytes owns the listening socket. It reads each request
+in full, hands it to a worker over a unix socket, reads the whole response
+back and then trickles it out to the client at whatever pace the client
+manages. The workers only ever talk to the front end, which is always fast.
+
+This is the job nginx or perlbal would do in front of a pool of application
+servers, without having to deploy one.
+
+Requests and responses travel between the front end and the workers as the
+length prefixed strings of embedded_sock_server, over a new unix connection
+for each request, so each one is picked up by whichever worker is idle:
+
+  front end -> worker: client address, request head and complete body
+  worker -> front end: response data strings, an empty string, then an int
+    that is 1 if the client connection should be closed
+"""
+
+import BaseHTTPServer
+import errno
+import logging
+import os
+import select
+import signal
+import socket
+import SocketServer
+import StringIO
+import struct
+import time
+
+from wiseguy import embedded_sock_server
+from wiseguy import http_server
+from wiseguy import preforking
+
+INT_FORMAT = embedded_sock_server.INT_FORMAT
+INT_SIZE = embedded_sock_server.INT_SIZE
+
+
+def pack_str(s):
+  return struct.pack(INT_FORMAT, len(s)) + s
+
+
+def recv_exactly(sock, size):
+  chunks = []
+  while size:
+    data = sock.recv(size)
+    if not data:
+      raise socket.error(errno.ECONNRESET, 'front end closed the connection')
+    chunks.append(data)
+    size -= len(data)
+  return ''.join(chunks)
+
+
+def recv_str(sock):
+  size = struct.unpack(INT_FORMAT, recv_exactly(sock, INT_SIZE))[0]
+  return recv_exactly(sock, size)
+
+
+class ChunkedDecoder(object):
+  """Decode a chunked body as it arrives, without holding on to or rescanning
+  anything already decoded. feed() each piece received; done is set once the
+  last chunk and any trailer are in, and leftover is whatever came after it.
+  Raises ValueError on garbage."""
+  # the most that can be pending while looking for the end of a chunk size
+  # line or the trailer
+  max_line_size = 64 * 1024
+
+  def __init__(self):
+    self.chunks = []
+    self.size = 0
+    self.done = False
+    self.leftover = ''
+    # an incomplete size line, chunk terminator or trailer
+    self._pending = ''
+    # bytes of the current chunk still to come
+    self._remaining = 0
+    # what comes after the current chunk's data: 'size', 'crlf' or 'trailer'
+    self._state = 'size'
+
+  def feed(self, data):
+    """Returns True once the body is complete."""
+    if self._pending:
+      data = self._pending + data
+      self._pending = ''
+    offset = 0
+    while offset < len(data) and not self.done:
+      if self._remaining:
+        end = min(len(data), offset + self._remaining)
+        self.chunks.append(data[offset:end])
+        self.size += end - offset
+        self._remaining -= end - offset
+        offset = end
+      elif self._state == 'crlf':
+        if len(data) - offset < 2:
+          break
+        if data[offset:offset + 2] != '\r\n':
+          raise ValueError('malformed chunk')
+        offset += 2
+        self._state = 'size'
+      elif self._state == 'trailer':
+        # the trailer, if any, ends with a blank line. the workers can't do
+        # anything with it, so it's dropped.
+        if data.startswith('\r\n', offset):
+          offset += 2
+        else:
+          trailer_end = data.find('\r\n\r\n', offset)
+          if trailer_end < 0:
+            break
+          offset = trailer_end + 4
+        self.done = True
+      else:
+        line_end = data.find('\r\n', offset)
+        if line_end < 0:
+          break
+        size_line = data[offset:line_end]
+        # ignore any chunk extensions
+        size = int(size_line.split(';', 1)[0].strip(), 16)
+        if size < 0:
+          raise ValueError('bad chunk size: %r' % size_line[:64])
+        offset = line_end + 2
+        if size:
+          self._remaining = size
+          self._state = 'crlf'
+        else:
+          self._state = 'trailer'
+    if self.done:
+      self.leftover = data[offset:]
+    else:
+      self._pending = data[offset:]
+      if len(self._pending) > self.max_line_size:
+        raise ValueError('chunk size line or trailer too long')
+    return self.done
+
+
+def decode_chunked(data, offset):
+  """Return (body, end) for a complete chunked body starting at offset in
+  data, or None if more is to come. Raises ValueError on garbage."""
+  decoder = ChunkedDecoder()
+  if not decoder.feed(data[offset:]):
+    return None
+  return ''.join(decoder.chunks), len(data) - len(decoder.leftover)
+
+
+def error_response(code):
+  message = BaseHTTPServer.BaseHTTPRequestHandler.responses[code][0]
+  body = '%s %s\n' % (code, message)
+  return ('HTTP/1.1 %s %s\r\n'
+          'Content-Type: text/plain\r\n'
+          'Content-Length: %s\r\n'
+          'Connection: close\r\n'
+          '\r\n%s' % (code, message, len(body), body))
+
+
+class ClientConnection(object):
+  """A connection from a client, and the state of its current request."""
+
+  def __init__(self, front_end, sock, address):
+    self.front_end = front_end
+    self.socket = sock
+    self.address = address
+    self.backend = None
+    self.closed = False
+    # received but not yet handed to a worker, kept as a list so a big
+    # upload isn't copied on every recv()
+    self._in_chunks = []
+    self._in_size = 0
+    self._out_chunks = []
+    self._out_offset = 0
+    self._close_after_response = False
+    self._reset_request()
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  def _reset_request(self):
+    # offset of the body, once the head is in
+    self._body_offset = None
+    # total size of the request, once known
+    self._request_size = None
+    self._chunked = False
+    # the request line and headers, and the body so far, of a chunked request
+    self._head = None
+    self._decoder = None
+    self._start_time = time.time()
+    self.deadline = self._start_time + self.front_end.keepalive_timeout
+
+  @property
+  def events(self):
+    events = 0
+    if self.backend is None and not self._close_after_response:
+      events |= select.POLLIN
+    if self._out_chunks:
+      events |= select.POLLOUT
+    return events
+
+  def handle_event(self, event):
+    if event & select.POLLOUT:
+      self._send()
+    if self.closed:
+      return
+    if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+      if self.backend is None:
+        self._recv()
+      elif event & (select.POLLHUP | select.POLLERR):
+        self.close()
+
+  def _recv(self):
+    try:
+      data = self.socket.recv(self.front_end.recv_size)
+    except socket.error, e:
+      if e[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      data = ''
+    if not data:
+      self.close()
+      return
+    if not self._in_size:
+      # the client has started on a request, give it longer
+      self.deadline = time.time() + self.front_end.request_timeout
+    self._in_chunks.append(data)
+    self._in_size += len(data)
+    self._check_request()
+
+  def _get_data(self):
+    if len(self._in_chunks) > 1:
+      self._in_chunks = [''.join(self._in_chunks)]
+    return self._in_chunks and self._in_chunks[0] or ''
+
+  def _check_request(self):
+    """Send the request to a worker if it has all arrived."""
+    if self._body_offset is None:
+      data = self._get_data()
+      # clients may send a blank line between pipelined requests
+      stripped = data.lstrip('\r\n')
+      if len(stripped) != len(data):
+        data = stripped
+        self._in_chunks = [data]
+        self._in_size = len(data)
+      head_end = data.find('\r\n\r\n')
+      if head_end < 0:
+        if self._in_size > self.front_end.max_head_size:
+          self.send_error(400)
+        return
+      try:
+        self._parse_head(data[:head_end])
+      except ValueError, e:
+        logging.debug('%s bad request: %s', self.address[0], e)
+        self.send_error(400)
+        return
+      self._body_offset = head_end + 4
+      if self._request_size is not None:
+        if self._request_size - self._body_offset > self.front_end.max_body_size:
+          self.send_error(413)
+          return
+        if self._in_size < self._request_size and self._expect_continue:
+          self._queue('HTTP/1.1 100 Continue\r\n\r\n')
+
+    if self._chunked:
+      if self._decoder is None:
+        data = self._get_data()
+        self._head = data[:self._body_offset - 4]
+        self._in_chunks = [data[self._body_offset:]]
+        self._decoder = ChunkedDecoder()
+      # each piece is decoded once, as it arrives. _in_size still counts
+      # everything, see _recv()
+      pieces = self._in_chunks
+      self._in_chunks = []
+      try:
+        for i, piece in enumerate(pieces):
+          if self._decoder.feed(piece):
+            pieces = [self._decoder.leftover] + pieces[i + 1:]
+            break
+      except ValueError:
+        self.send_error(400)
+        return
+      if not self._decoder.done:
+        if self._decoder.size > self.front_end.max_body_size:
+          self.send_error(413)
+        return
+      body = ''.join(self._decoder.chunks)
+      # the workers would rather see a content-length
+      head_lines = [line for line in self._head.split('\r\n')
+                    if not line.lower().startswith('transfer-encoding:')]
+      head_lines.append('Content-Length: %s' % len(body))
+      request = '\r\n'.join(head_lines) + '\r\n\r\n' + body
+      leftover = ''.join(pieces)
+    else:
+      if self._in_size < self._request_size:
+        return
+      data = self._get_data()
+      request = data[:self._request_size]
+      leftover = data[self._request_size:]
+
+    # anything left over is the next pipelined request
+    self._in_chunks = leftover and [leftover] or []
+    self._in_size = len(leftover)
+    self.backend = BackendConnection(self, request)
+    self.front_end.dispatch(self.backend)
+    self.front_end.update_events(self)
+
+  def _parse_head(self, head):
+    lines = head.split('\r\n')
+    words = lines[0].split()
+    if len(words) != 3 or not words[2].startswith('HTTP/'):
+      raise ValueError('bad request line: %r' % lines[0])
+    headers = {}
+    for line in lines[1:]:
+      name, sep, value = line.partition(':')
+      if sep:
+        headers[name.strip().lower()] = value.strip()
+    self._expect_continue = (
+      words[2] == 'HTTP/1.1' and
+      headers.get('expect', '').lower() == '100-continue')
+    if 'transfer-encoding' in headers:
+      self._chunked = True
+      return
+    try:
+      content_length = int(headers.get('content-length', 0))
+    except ValueError:
+      content_length = -1
+    if content_length < 0:
+      raise ValueError('bad content-length')
+    self._request_size = len(head) + 4 + content_length
+
+  def send_error(self, code):
+    self._in_chunks = []
+    self._in_size = 0
+    self._close_after_response = True
+    self._queue(error_response(code))
+
+  def _queue(self, data):
+    self._out_chunks.append(data)
+    self.deadline = time.time() + self.front_end.request_timeout
+    self.front_end.update_events(self)
+
+  def queue_response(self, data):
+    """Called by the backend with each piece of the response."""
+    self._queue(data)
+
+  def response_done(self, close_connection):
+    self.backend = None
+    self._close_after_response = close_connection
+    if self._out_chunks:
+      self.front_end.update_events(self)
+    else:
+      self._response_sent()
+
+  def backend_failed(self, response_started):
+    self.backend = None
+    if response_started:
+      # too late to say anything sensible, the client will notice the
+      # response is short
+      self._close_after_response = True
+      if not self._out_chunks:
+        self.close()
+      return
+    self.send_error(502)
+
+  def _send(self):
+    while self._out_chunks:
+      chunk = self._out_chunks[0]
+      try:
+        sent = self.socket.send(buffer(chunk, self._out_offset))
+      except socket.error, e:
+        if e[0] in (errno.EAGAIN, errno.EINTR):
+          break
+        self.close()
+        return
+      self.deadline = time.time() + self.front_end.request_timeout
+      self._out_offset += sent
+      if self._out_offset < len(chunk):
+        break
+      self._out_chunks.pop(0)
+      self._out_offset = 0
+    if not self._out_chunks and self.backend is None:
+      self._response_sent()
+    else:
+      self.front_end.update_events(self)
+
+  def _response_sent(self):
+    if self._close_after_response:
+      self.close()
+      return
+    self._reset_request()
+    self.front_end.update_events(self)
+    if self._in_size:
+      self._check_request()
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    if self.backend is not None:
+      self.backend.close()
+      self.backend = None
+    self.front_end.unregister(self)
+    self.socket.close()
+
+
+class BackendConnection(object):
+  """A unix connection to a worker, carrying one request."""
+
+  def __init__(self, client, request):
+    self.client = client
+    self.socket = None
+    self.closed = False
+    self._out = pack_str(client.address[0]) + pack_str(request)
+    self._out_offset = 0
+    # received from the worker and not yet passed on, kept as a list so a
+    # big response isn't copied on every recv()
+    self._in_chunks = []
+    self._in_size = 0
+    # bytes of the current response frame still to come, None between
+    # frames
+    self._frame_remaining = None
+    self._response_started = False
+    self._response_done = False
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  @property
+  def events(self):
+    if self._out_offset < len(self._out):
+      return select.POLLOUT
+    return select.POLLIN
+
+  def handle_event(self, event):
+    if event & select.POLLOUT:
+      self._send()
+    elif event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+      self._recv()
+
+  def _send(self):
+    try:
+      self._out_offset += self.socket.send(buffer(self._out, self._out_offset))
+    except socket.error, e:
+      if e[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      self._fail()
+      return
+    if self._out_offset >= len(self._out):
+      self._out = ''
+      self._out_offset = 0
+      self.client.front_end.update_events(self)
+
+  def _recv(self):
+    try:
+      data = self.socket.recv(self.client.front_end.recv_size)
+    except socket.error, e:
+      if e[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      data = ''
+    if not data:
+      self._fail()
+      return
+    self._in_chunks.append(data)
+    self._in_size += len(data)
+    while self._in_size:
+      if self._frame_remaining:
+        # pass on what there is of the frame, there's no need to wait for
+        # all of it
+        data = self._take(min(self._frame_remaining, self._in_size))
+        self._frame_remaining -= len(data)
+        self._response_started = True
+        self.client.queue_response(data)
+        continue
+      if self._in_size < INT_SIZE:
+        break
+      size = struct.unpack(INT_FORMAT, self._take(INT_SIZE))[0]
+      if self._response_done:
+        # the last int is the close flag
+        self._in_chunks = []
+        self._in_size = 0
+        self.close()
+        self.client.response_done(bool(size))
+        return
+      if size:
+        self._frame_remaining = size
+      else:
+        self._response_done = True
+
+  def _take(self, size):
+    """Remove and return the first size bytes received."""
+    pieces = []
+    self._in_size -= size
+    while size:
+      chunk = self._in_chunks[0]
+      if len(chunk) <= size:
+        pieces.append(chunk)
+        del self._in_chunks[0]
+        size -= len(chunk)
+      else:
+        pieces.append(chunk[:size])
+        self._in_chunks[0] = chunk[size:]
+        size = 0
+    if len(pieces) == 1:
+      return pieces[0]
+    return ''.join(pieces)
+
+  def _fail(self):
+    logging.warning('%s lost the worker', self.client.address[0])
+    self.close()
+    self.client.backend_failed(self._response_started)
+
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    if self.socket is not None:
+      self.client.front_end.unregister(self)
+      self.socket.close()
+
+
+class FrontEnd(object):
+  # the most a client can send before it has to finish the headers, and
+  # the biggest body that will be buffered
+  max_head_size = 64 * 1024
+  max_body_size = 64 * 1024 * 1024
+  # seconds a client has to get on with sending a request or reading the
+  # response, and to sit idle between requests on a keep-alive connection
+  request_timeout = 60.0
+  keepalive_timeout = 5.0
+  recv_size = 64 * 1024
+  # how often to retry connecting while the workers' queue is full
+  retry_interval = 0.01
+
+  def __init__(self, server_address, backend_address):
+    """server_address - (host, port) to listen on
+    backend_address - path of the unix socket the workers listen on
+    """
+    self.server_address = server_address
+    self.backend_address = backend_address
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(server_address)
+    self.socket.listen(socket.SOMAXCONN)
+    self.socket.setblocking(False)
+    self._poller = None
+    # fd -> connection
+    self._connections = {}
+    # backends waiting for room in the workers' accept queue
+    self._waiting = []
+    self._next_sweep = 0
+
+  def server_close(self):
+    self.socket.close()
+
+  def serve_forever(self):
+    if hasattr(select, 'epoll'):
+      self._poller = select.epoll()
+      poll_scale = 1.0
+    else:
+      self._poller = select.poll()
+      poll_scale = 1000.0
+    listen_fd = self.socket.fileno()
+    self._poller.register(listen_fd, select.POLLIN)
+    logging.info('front end listening on %s:%s', *self.server_address)
+    while True:
+      if self._waiting:
+        timeout = self.retry_interval
+      else:
+        timeout = 1.0
+      try:
+        events = self._poller.poll(timeout * poll_scale)
+      except (IOError, select.error), e:
+        if e[0] == errno.EINTR:
+          continue
+        raise
+      for fd, event in events:
+        if fd == listen_fd:
+          self._accept()
+          continue
+        connection = self._connections.get(fd)
+        if connection is None:
+          # closed while handling an earlier event
+          continue
+        try:
+          connection.handle_event(event)
+        except Exception:
+          logging.exception('front end error')
+          connection.close()
+      if self._waiting:
+        waiting = self._waiting
+        self._waiting = []
+        for backend in waiting:
+          if not backend.closed:
+            self.dispatch(backend)
+      self._sweep()
+
+  def _accept(self):
+    while True:
+      try:
+        sock, address = self.socket.accept()
+      except socket.error, e:
+        if e[0] in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+          return
+        raise
+      sock.setblocking(False)
+      self.register(ClientConnection(self, sock, address))
+
+  def dispatch(self, backend):
+    """Connect a request to a worker."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+      sock.connect(self.backend_address)
+    except socket.error, e:
+      sock.close()
+      if e[0] == errno.EAGAIN:
+        # every worker is busy and the queue is full, hang on to it
+        self._waiting.append(backend)
+        return
+      logging.error('unable to reach the workers: %s', e)
+      backend.close()
+      backend.client.backend = None
+      backend.client.send_error(503)
+      return
+    backend.socket = sock
+    self.register(backend)
+
+  def register(self, connection):
+    self._connections[connection.fileno()] = connection
+    self._poller.register(connection.fileno(), connection.events)
+
+  def unregister(self, connection):
+    fd = connection.fileno()
+    if self._connections.pop(fd, None) is not None:
+      self._poller.unregister(fd)
+
+  def update_events(self, connection):
+    if connection.fileno() in self._connections:
+      self._poller.modify(connection.fileno(), connection.events)
+
+  def _sweep(self):
+    """Hang up on clients that have been idle for too long."""
+    now = time.time()
+    if now < self._next_sweep:
+      return
+    self._next_sweep = now + 1.0
+    for connection in self._connections.values():
+      if (isinstance(connection, ClientConnection) and
+          connection.backend is None and connection.deadline < now):
+        logging.debug('%s timed out', connection.address[0])
+        connection.close()
+
+
+class FrameWriter(object):
+  """The wfile of a worker, each write goes to the front end as a string."""
+  closed = False
+
+  def __init__(self, sock):
+    self._socket = sock
+
+  def write(self, data):
+    if data:
+      self._socket.sendall(pack_str(data))
+
+  def flush(self):
+    pass
+
+  def end(self, close_connection):
+    self._socket.sendall(pack_str('') +
+                         struct.pack(INT_FORMAT, int(close_connection)))
+
+  def close(self):
+    self.closed = True
+
+
+class BackendWSGIHandler(http_server.WiseguyWSGIHandler):
+  def sendfile(self):
+    # the response has to be framed, so it can't go straight to the socket
+    return False
+
+
+class BackendRequestHandler(http_server.WiseguyRequestHandler):
+  """Serve one request passed on by the front end."""
+  wsgi_handler_class = BackendWSGIHandler
+  # the front end sends the request as soon as it connects
+  backend_timeout = 30.0
+
+  def setup(self):
+    self.connection = self.request
+    self.connection.settimeout(self.backend_timeout)
+    client_host = recv_str(self.connection)
+    request = recv_str(self.connection)
+    self.client_address = (client_host, 0)
+    self.rfile = http_server.SocketFileWrapper(
+      StringIO.StringIO(request), self)
+    self.wfile = FrameWriter(self.connection)
+
+  def handle(self):
+    self.start_time = time.time()
+    try:
+      self.handle_one_request()
+    except Exception, e:
+      logging.exception('http error %s "%s" %s %s', self.address_string(),
+                        self.raw_requestline, e, time.time() - self.start_time)
+      self.close_connection = True
+
+  def wait_for_request(self):
+    # it's all here already
+    return True
+
+  def end_request(self):
+    # the worker's connection only ever carries this one request, leave the
+    # accounting to the server's close_request
+    self.request_count += 1
+    self.server.worker_request_done()
+
+  def finish(self):
+    try:
+      self.wfile.end(self.close_connection)
+    except socket.error, e:
+      # the client went away
+      logging.debug('%s end of response failed: %s', self.address_string(), e)
+
+
+class BackendHTTPServer(http_server.HTTPServer):
+  """The worker side, listening on a unix socket for the front end."""
+  address_family = socket.AF_UNIX
+  # requests wait here while all the workers are busy
+  request_queue_size = socket.SOMAXCONN
+
+  def __init__(self, *pargs, **kargs):
+    # where clients connect, for SERVER_NAME and SERVER_PORT
+    self._public_address = kargs.pop('public_address', ('localhost', 80))
+    kargs.setdefault('RequestHandlerClass', BackendRequestHandler)
+    http_server.HTTPServer.__init__(self, *pargs, **kargs)
+
+  def server_bind(self):
+    self.lock_startup()
+    try:
+      os.remove(self.server_address)
+    except OSError, e:
+      if e[0] != errno.ENOENT:
+        raise
+    SocketServer.TCPServer.server_bind(self)
+    self._listen_socket = self.socket
+    if self._drop_privileges_callback:
+      self._drop_privileges_callback()
+    self.server_name, self.server_port = self._public_address
+    self.setup_environ()
+
+
+class PreForkingBufferedHTTPWSGIServer(preforking.PreForkingMixIn,
+                                       BackendHTTPServer):
+  """Workers behind a front end process that buffers slow clients.
+
+  server_address is the path of the unix socket between the two.
+  """
+  def __init__(self, app, front_end_address, server_address, **kargs):
+    self._front_end = FrontEnd(front_end_address, server_address)
+    self._front_end_pid = None
+    kargs['public_address'] = front_end_address
+    BackendHTTPServer.__init__(self, server_address, **kargs)
+    self.set_app(app)
+
+  def _spawn_front_end(self):
+    pid = os.fork()
+    if pid:
+      self._front_end_pid = pid
+      return
+    for sig in self.signal_list:
+      signal.signal(sig, signal.SIG_DFL)
+    try:
+      self._front_end.serve_forever()
+    except:
+      logging.exception('front end failed')
+    os._exit(1)
+
+  def init_child(self):
+    # only the front end accepts clients
+    self._front_end.server_close()
+    BackendHTTPServer.init_child(self)
+
+  def handle_other_child(self, pid, status):
+    if pid == self._front_end_pid and not self._quit:
+      logging.error('front end exited: %s, restarting', status)
+      self._spawn_front_end()
+
+  def serve_forever(self):
+    # before the application is preloaded, the front end doesn't need it
+    self._spawn_front_end()
+    try:
+      preforking.PreForkingMixIn.serve_forever(self)
+    finally:
+      preforking._kill(self._front_end_pid, signal.SIGTERM)
+      try:
+        os.waitpid(self._front_end_pid, 0)
+      except OSError:
+        pass
@@ -1,7 +1,9 @@
 import errno
 import logging
+import os
 import select
 import socket
+import stat
 import string
 import struct
 import sys
@@ -12,6 +14,8 @@ import urllib
 from wsgiref import simple_server
 
 import wiseguy
+from wiseguy import accept_lock
+from wiseguy import admission
 try:
   from wiseguy import fd_server
 except ImportError:
@@ -19,23 +23,198 @@ except ImportError:
   fd_server = None
 from wiseguy import managed_server
 from wiseguy import preforking
+from wiseguy import queue_monitor
+from wiseguy import request_timer
+from wiseguy import scoreboard
 
 NOLINGER = struct.pack('ii', 1, 0)
 
+# python2 doesn't export this, but it's been 15 on linux since 3.9
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+# the response when admission control sheds a request
+overloaded_body = 'Service Unavailable\n'
+
+
+def _get_libc_sendfile():
+  """Wrap sendfile(2) with ctypes, the signature matches os.sendfile."""
+  import ctypes
+  import ctypes.util
+  libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  # use the explicit 64-bit version so large files work on 32-bit platforms
+  c_sendfile = libc.sendfile64
+  c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+  c_sendfile.restype = ctypes.c_long
+
+  def libc_sendfile(out_fd, in_fd, offset, count):
+    c_offset = ctypes.c_int64(offset)
+    sent = c_sendfile(out_fd, in_fd, ctypes.byref(c_offset), count)
+    if sent < 0:
+      error = ctypes.get_errno()
+      raise OSError(error, os.strerror(error))
+    return sent
+  return libc_sendfile
+
+# os.sendfile is python3 only, so try pysendfile and then libc
+try:
+  from os import sendfile
+except ImportError:
+  try:
+    from sendfile import sendfile
+  except ImportError:
+    try:
+      sendfile = _get_libc_sendfile()
+    except (ImportError, OSError, AttributeError):
+      sendfile = None
+
+# how children get new connections:
+#   shared - everyone accept()s on the socket inherited from the parent
+#   reuseport - each child binds its own SO_REUSEPORT socket to the address and
+#     the kernel spreads connections across them. a child that quits has to
+#     serve what's queued on its socket first, see _drain_worker_socket()
+#   flock, semaphore - the inherited socket, but only the holder of the
+#     accept lock waits in accept()
+accept_modes = ('shared', 'reuseport', 'flock', 'semaphore')
+
 translate_header_table = string.maketrans(
   'abcdefghijklmnopqrstuvwxyz-',
   'ABCDEFGHIJKLMNOPQRSTUVWXYZ_')
 
+# request lines with these versions are parsed without BaseHTTPServer's
+# general purpose version checks
+fast_request_versions = frozenset(['HTTP/1.0', 'HTTP/1.1'])
+
+class KeepAlivePoller(object):
+  """Park idle keep-alive connections in an epoll set.
+
+  Instead of blocking in select() on a single idle connection for up to
+  keepalive_timeout, a worker hands the connection to the poller and goes
+  back to waiting on the listening socket. A parked connection only occupies
+  the worker again once it has a request to read.
+
+  Each worker owns its poller - the epoll set is created after the fork and
+  never shared with the parent or the other children.
+  """
+  def __init__(self, listen_fd, keepalive_timeout):
+    self.listen_fd = listen_fd
+    self.keepalive_timeout = keepalive_timeout
+    self._epoll = select.epoll()
+    self._epoll.register(listen_fd, select.EPOLLIN)
+    # map fd -> (request_handler, deadline)
+    self._parked = {}
+
+  def __len__(self):
+    return len(self._parked)
+
+  def is_parked(self, request):
+    try:
+      return request.fileno() in self._parked
+    except socket.error:
+      # the socket has already been closed
+      return False
+
+  def park(self, request_handler):
+    fd = request_handler.connection.fileno()
+    self._parked[fd] = (request_handler, time.time() + self.keepalive_timeout)
+    self._epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+
+  def unpark(self, fd):
+    request_handler, deadline = self._parked.pop(fd)
+    self._epoll.unregister(fd)
+    return request_handler
+
+  def poll(self):
+    """Block until the listening socket or a parked connection is readable.
+
+    Returns (listen_ready, ready_handlers, expired_handlers). Ready and
+    expired handlers are no longer parked when they are returned.
+    """
+    timeout = -1
+    if self._parked:
+      next_deadline = min(deadline for request_handler, deadline
+                          in self._parked.itervalues())
+      timeout = max(0.0, next_deadline - time.time())
+
+    listen_ready = False
+    ready_handlers = []
+    for fd, event in self._epoll.poll(timeout):
+      if fd == self.listen_fd:
+        listen_ready = True
+      elif fd in self._parked:
+        ready_handlers.append(self.unpark(fd))
+
+    expired_handlers = []
+    now = time.time()
+    for fd, (request_handler, deadline) in self._parked.items():
+      if deadline <= now:
+        expired_handlers.append(self.unpark(fd))
+    return listen_ready, ready_handlers, expired_handlers
+
+  def close(self):
+    """Stop polling and return the handlers that were still parked."""
+    request_handlers = [self.unpark(fd) for fd in self._parked.keys()]
+    self._epoll.close()
+    return request_handlers
+
+
 class HTTPServer(simple_server.WSGIServer, managed_server.ManagedServer):
+  # how often idle request threads check whether the child is quitting
+  thread_poll_interval = 1.0
+  # and idle workers in the accept lock modes, which can't rely on a signal
+  # to wake them
+  accept_lock_poll_interval = 1.0
+  # with reuseport, how long a quitting child keeps serving the connections
+  # queued on its own socket, see _drain_worker_socket()
+  reuseport_drain_timeout = 10.0
+
   def __init__(self, *pargs, **kargs):
+    threaded = kargs.get('threads', 1) > 1
+    # park idle keep-alive connections in a per-worker epoll set rather than
+    # letting each one hold a worker until keepalive_timeout expires
+    self._keepalive_poll = kargs.pop('keepalive_poll', False)
+    if self._keepalive_poll and not hasattr(select, 'epoll'):
+      logging.warning('keepalive_poll requires epoll, disabling')
+      self._keepalive_poll = False
+    if self._keepalive_poll and threaded:
+      # the poller belongs to one thread, a waiting connection just holds its
+      # request thread instead
+      logging.warning('keepalive_poll is not supported with threads, disabling')
+      self._keepalive_poll = False
+    self._keepalive_poller = None
+    self._accept_mode = kargs.pop('accept_mode', 'shared')
+    if self._accept_mode not in accept_modes:
+      raise ValueError('unknown accept_mode: %s' % self._accept_mode)
+    if self._accept_mode in ('flock', 'semaphore') and threaded:
+      # the lock is held per process, it can't hand off between threads
+      logging.warning('accept_mode %s is not supported with threads, '
+                      'using shared', self._accept_mode)
+      self._accept_mode = 'shared'
+    if self._accept_mode in ('flock', 'semaphore'):
+      self._accept_lock = accept_lock.get_accept_lock(
+        self._accept_mode, kargs.pop('accept_lock_path', None))
+    else:
+      self._accept_lock = None
+    # answer 503 rather than queueing when the workers can't keep up, see
+    # admission.py
+    shed_queue_time = kargs.pop('shed_queue_time', None)
+    shed_busy_ratio = kargs.pop('shed_busy_ratio', None)
+    shed_priorities = kargs.pop('shed_priorities', None)
+    shed_retry_after = kargs.pop('shed_retry_after', 1)
+    if shed_queue_time is not None or shed_busy_ratio is not None:
+      self._admission = admission.AdmissionControl(
+        shed_queue_time, shed_busy_ratio, shed_priorities,
+        retry_after=shed_retry_after)
+    else:
+      self._admission = None
     # don't bind_and_activate in the managed_server
     # that will be handled when the WSGIServer initializes, or externally by
     # the calling code
     managed_kargs = kargs.copy()
     managed_kargs['bind_and_activate'] = False
-    managed_server.ManagedServer.__init__(self, *pargs, **managed_kargs)
-    RequestHandlerClass = kargs.get(
+    RequestHandlerClass = managed_kargs.pop(
       'RequestHandlerClass', WiseguyRequestHandler)
+    managed_server.ManagedServer.__init__(self, *pargs, **managed_kargs)
     if sys.version_info >= (2, 6):
       simple_server.WSGIServer.__init__(
         self, self._server_address, RequestHandlerClass,
@@ -49,6 +228,11 @@ class HTTPServer(simple_server.WSGIServer, managed_server.ManagedServer):
     self.lock_startup()
     bind_address = self.server_address
     try:
+      if self._accept_mode == 'reuseport':
+        # SO_REUSEPORT would let us bind right on top of a running server, so
+        # check by hand to get the usual fd handoff from the old process tree
+        _check_address_in_use(self.address_family, bind_address)
+        self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
       simple_server.WSGIServer.server_bind(self)
       self._listen_socket = self.socket
       if self._drop_privileges_callback:
@@ -85,16 +269,213 @@ class HTTPServer(simple_server.WSGIServer, managed_server.ManagedServer):
 
   def server_activate(self):
     self.lock_startup()
-    simple_server.WSGIServer.server_activate(self)
+    # with reuseport, the parent socket only holds the address. if it
+    # listened, the kernel would queue connections on it that no child accepts
+    if self._accept_mode != 'reuseport':
+      simple_server.WSGIServer.server_activate(self)
     managed_server.ManagedServer.server_activate(self)
 
+  def init_child(self):
+    if self._accept_mode == 'reuseport':
+      self._bind_worker_socket()
+    elif self._accept_lock:
+      self._accept_lock.post_fork()
+    if self._threads > 1:
+      # the request threads all wait on the listening socket, only one of
+      # them gets each connection
+      self.socket.setblocking(False)
+    managed_server.ManagedServer.init_child(self)
+
+  def _bind_worker_socket(self):
+    worker_socket = socket.socket(self.address_family, self.socket_type)
+    worker_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    worker_socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    try:
+      worker_socket.bind(self.server_address)
+    except socket.error, e:
+      # probably inherited a listening socket from a server that wasn't
+      # using SO_REUSEPORT, just share that one instead
+      logging.warning('unable to bind SO_REUSEPORT socket %s: %s',
+                      self.server_address, e)
+      worker_socket.close()
+      return
+    worker_socket.listen(self.request_queue_size)
+    self.socket = worker_socket
+
+  def get_request(self):
+    if self._accept_lock is None:
+      return simple_server.WSGIServer.get_request(self)
+    # when polling, we have parked connections to look after, so don't wait
+    # for the lock
+    if not self._accept_lock.acquire(blocking=not self._keepalive_poll,
+                                     timeout=self.accept_lock_poll_interval):
+      raise socket.error(errno.EAGAIN, 'accept lock is busy')
+    try:
+      # told to quit while waiting for the lock
+      if self._quit:
+        raise socket.error(errno.EAGAIN, 'quitting')
+      # don't sit in accept() until the next connection either, or a SIGTERM
+      # goes unnoticed until then
+      if (not self._keepalive_poll and not select.select(
+        [self], [], [], self.accept_lock_poll_interval)[0]):
+        raise socket.error(errno.EAGAIN, 'no connection yet')
+      return simple_server.WSGIServer.get_request(self)
+    finally:
+      self._accept_lock.release()
+
+  def should_shed(self, request_handler):
+    """Return True if admission control turns this request away."""
+    now = time.time()
+    if self._admission.needs_update(now):
+      self._update_admission(now)
+    priority = self._admission.get_priority(request_handler.path)
+    backlog = queue_monitor.get_socket_backlog(self.socket)
+    if backlog is None:
+      queued = None
+    else:
+      queued = backlog[0]
+    if not self._admission.should_shed(
+      priority, request_handler.queue_time, queued):
+      return False
+    self.record_shed(priority)
+    return True
+
+  def _update_admission(self, now):
+    busy_ratio = 0.0
+    slots = self._threads
+    if self._scoreboard is not None:
+      workers = self._scoreboard.read()
+      busy = len([w for w in workers if w['state'] in scoreboard.busy_states])
+      # leave out this request's slot
+      if len(workers) > 1:
+        busy_ratio = float(max(0, busy - 1)) / (len(workers) - 1)
+      if self._accept_mode != 'reuseport':
+        # everyone takes from the same backlog
+        slots = len(workers)
+    self._admission.update(busy_ratio, slots, now)
+
+  def shutdown_request(self, request):
+    # parked connections are still alive, they just aren't our problem until
+    # the client sends another request
+    if self._is_parked(request):
+      return
+    simple_server.WSGIServer.shutdown_request(self, request)
+
   def close_request(self, request):
+    if self._is_parked(request):
+      return
     simple_server.WSGIServer.close_request(self, request)
     managed_server.ManagedServer.close_request(self, request)    
 
   # this is the main entry point and it will override the implementation in
-  # ManagedServer. it is inherited from the base class.
-  # def handle_request(self):
+  # ManagedServer. it is inherited from the base class unless we are
+  # polling keep-alive connections.
+  def handle_request(self):
+    if not self._keepalive_poll:
+      if self._accept_lock:
+        # don't select() first - the whole point is that only the lock
+        # holder is waiting on the listening socket
+        return self._handle_request_noblock()
+      # not SocketServer's version - newer ones retry select() on EINTR,
+      # so a SIGTERM wouldn't stop an idle worker until the next connection.
+      # request threads don't see signals at all, so they check back now
+      # and then.
+      if self._threads > 1:
+        timeout = self.thread_poll_interval
+      else:
+        timeout = None
+      if select.select([self], [], [], timeout)[0]:
+        self._handle_request_noblock()
+      return
+
+    if self._keepalive_poller is None:
+      # the listening socket is shared by all the workers, so accept() has to
+      # be non-blocking - epoll may wake several of us for one connection
+      self.socket.setblocking(False)
+      self._keepalive_poller = KeepAlivePoller(
+        self.socket.fileno(), self.RequestHandlerClass.keepalive_timeout)
+
+    listen_ready, ready_handlers, expired_handlers = (
+      self._keepalive_poller.poll())
+    for request_handler in expired_handlers:
+      logging.debug('%s closing idle connection',
+                    request_handler.address_string())
+      self._close_parked_connection(request_handler)
+    for request_handler in ready_handlers:
+      if self._quit:
+        self._close_parked_connection(request_handler)
+        continue
+      try:
+        request_handler.resume()
+      except:
+        self.handle_error(request_handler.request,
+                          request_handler.client_address)
+      if not request_handler.parked:
+        self.shutdown_request(request_handler.request)
+    if listen_ready and not self._quit:
+      self._handle_request_noblock()
+
+  def park_connection(self, request_handler):
+    """Hand an idle keep-alive connection to the poller.
+
+    Returns False if the connection should be handled (or closed) by the
+    caller instead."""
+    if not self._keepalive_poll or self._quit:
+      return False
+    request_handler.parked = True
+    self._keepalive_poller.park(request_handler)
+    return True
+
+  def _is_parked(self, request):
+    return bool(self._keepalive_poller and
+                self._keepalive_poller.is_parked(request))
+
+  def _close_parked_connection(self, request_handler):
+    request_handler.parked = False
+    request_handler.close_connection = True
+    request_handler.finish()
+    self.shutdown_request(request_handler.request)
+
+  def _drain_worker_socket(self):
+    """Serve the connections still queued on this child's own socket.
+
+    With reuseport each child's socket has its own accept queue, and closing
+    it resets every connection still waiting there. The kernel keeps sending
+    connections here until the socket is closed, so this stops once the
+    queue is empty or after reuseport_drain_timeout - anything that arrives
+    between the last look and the close is still reset."""
+    deadline = time.time() + self.reuseport_drain_timeout
+    served = 0
+    while time.time() < deadline:
+      try:
+        if not select.select([self], [], [], 0)[0]:
+          break
+      except select.error, e:
+        if e[0] == errno.EINTR:
+          continue
+        raise
+      self._handle_request_noblock()
+      served += 1
+    self.socket.close()
+    if served:
+      logging.info('served %s connections queued on the worker socket',
+                   served)
+
+  def exit_child(self):
+    if (self._accept_mode == 'reuseport' and
+        self.socket is not self._listen_socket):
+      self._drain_worker_socket()
+    if self._keepalive_poller is not None:
+      for request_handler in self._keepalive_poller.close():
+        request_handler.parked = False
+        request_handler.finish()
+        simple_server.WSGIServer.close_request(self, request_handler.request)
+    managed_server.ManagedServer.exit_child(self)
+
+  def exit_parent(self):
+    if self._accept_lock:
+      self._accept_lock.remove()
+    managed_server.ManagedServer.exit_parent(self)
 
 
 class WiseguyWSGIHandler(simple_server.ServerHandler):
@@ -106,10 +487,27 @@ class WiseguyWSGIHandler(simple_server.ServerHandler):
   server_software = 'wiseguy/%s' % wiseguy.__version__
   start = None
   request_handler = None
+  # the status line, headers and body chunks are collected and sent with one
+  # write once this many bytes are pending, or the response is done. set this
+  # to 0 for applications that stream and need every chunk sent immediately.
+  write_buffer_size = 16 * 1024
+  _write_buffer = None
+  _write_buffer_bytes = 0
+  # set once anything, even just the status line, has reached the client
+  _output_sent = False
+  # set once the headers announcing a chunked body have gone out
+  _chunked = False
+  # whatever the application left in environ['wiseguy.route'], saved before
+  # close() throws the environ away
+  route = None
   
   def log_exception(self, exc_info):
     try:
-      elapsed = time.time() - self.start      
+      if self.start is None:
+        # the application blew up before it returned anything
+        elapsed = 0.0
+      else:
+        elapsed = time.time() - self.start
       logging.exception('wsgi error %s "%s" %s',
          elapsed, self.request_handler.raw_requestline, self.headers)
     finally:
@@ -117,6 +515,27 @@ class WiseguyWSGIHandler(simple_server.ServerHandler):
     # force the connection to get torn down
     self.request_handler.close_connection = True
 
+  def handle_error(self):
+    """Send a 500 if nothing has gone out yet, otherwise whatever the
+    application managed before it blew up.
+
+    wsgiref only looks at headers_sent, which is set as soon as the headers
+    are written to the buffer."""
+    self.log_exception(sys.exc_info())
+    if self.headers_sent and not self._output_sent:
+      # the status line and headers are still in the buffer, start over
+      self._write_buffer = None
+      self._write_buffer_bytes = 0
+      self._chunked = False
+      self.headers_sent = False
+    if not self.headers_sent:
+      self.result = self.error_output(self.environ, self.start_response)
+      self.finish_response()
+    else:
+      # log_exception has set close_connection, so the client sees a
+      # truncated body
+      self.close()
+
   def error_output(self, environ, start_response):
     start_response(self.error_status, self.error_headers[:], sys.exc_info())
     if self.request_handler.debug:
@@ -129,13 +548,133 @@ class WiseguyWSGIHandler(simple_server.ServerHandler):
     return self.request_handler.http_version
   
   def cleanup_headers(self):
+    request_handler = self.request_handler
+    if 'Content-Length' not in self.headers and self._response_has_body():
+      # a single item iterable can still get a content-length
+      self.set_content_length()
+      if 'Content-Length' not in self.headers:
+        if request_handler.request_version == 'HTTP/1.1':
+          self.headers['Transfer-Encoding'] = 'chunked'
+        else:
+          # the client can only find the end of the body when we hang up
+          request_handler.close_connection = True
     # NOTE: make sure you communicate to the client that you will close the
     # underlying connection
-    if self.request_handler.close_connection:
+    if request_handler.close_connection:
       self.headers['Connection'] = 'close'
 
+  def _response_has_body(self):
+    if self.request_handler.command == 'HEAD':
+      return False
+    status_code = self.status[:3]
+    return not (status_code in ('204', '304') or status_code[0] == '1')
+
+  def send_headers(self):
+    simple_server.ServerHandler.send_headers(self)
+    # everything written from here on is body
+    self._chunked = self.headers.get('Transfer-Encoding') == 'chunked'
+
+  def _write(self, data):
+    if self._chunked:
+      # an empty chunk would end the body
+      if data:
+        self._buffer_write('%x\r\n' % len(data))
+        self._buffer_write(data)
+        self._buffer_write('\r\n')
+    else:
+      self._buffer_write(data)
+
+  def _buffer_write(self, data):
+    if len(data) >= self.write_buffer_size:
+      # don't copy big chunks around just to save a syscall
+      self._flush_write_buffer()
+      self._output_sent = True
+      self.stdout.write(data)
+      return
+    if self._write_buffer is None:
+      self._write_buffer = []
+    self._write_buffer.append(data)
+    self._write_buffer_bytes += len(data)
+
+  def _flush(self):
+    # wsgiref calls this after every write(), only really flush once we have
+    # a reasonable amount to send
+    if self._write_buffer_bytes >= self.write_buffer_size:
+      self._flush_write_buffer()
+
+  def _flush_write_buffer(self):
+    if self._write_buffer:
+      data = ''.join(self._write_buffer)
+      self._write_buffer = None
+      self._write_buffer_bytes = 0
+      self._output_sent = True
+      self.stdout.write(data)
+    self.stdout.flush()
+
+  def close(self):
+    try:
+      # don't mark the body complete if the application blew up half way,
+      # the client is better off seeing it cut short
+      if self._chunked and not self.request_handler.close_connection:
+        self._chunked = False
+        self._buffer_write('0\r\n\r\n')
+      self._flush_write_buffer()
+    finally:
+      if self.environ is not None:
+        self.route = self.environ.get(request_timer.route_environ_key)
+      simple_server.ServerHandler.close(self)
+
+  def sendfile(self):
+    """Send a wsgi.file_wrapper over a regular file with sendfile(2).
+
+    Returns False without sending anything if the file can't be sent this
+    way, in which case the response goes out through the normal write loop.
+    """
+    if sendfile is None:
+      return False
+    filelike = self.result.filelike
+    try:
+      in_fd = filelike.fileno()
+      offset = filelike.tell()
+      file_stat = os.fstat(in_fd)
+    except (AttributeError, IOError, OSError, ValueError):
+      return False
+    if not stat.S_ISREG(file_stat.st_mode):
+      return False
+
+    count = max(0, file_stat.st_size - offset)
+    if not self.headers_sent:
+      content_length = self.headers.get('Content-Length')
+      if content_length is None:
+        self.headers['Content-Length'] = str(count)
+      else:
+        # the application might only want part of the file
+        count = min(count, int(content_length))
+      self.send_headers()
+    self._flush_write_buffer()
+    if self.request_handler.command == 'HEAD':
+      return True
+
+    out_fd = self.request_handler.connection.fileno()
+    while count > 0:
+      try:
+        sent = sendfile(out_fd, in_fd, offset, count)
+      except OSError, e:
+        if e[0] == errno.EINTR:
+          continue
+        # make this look like any other failed write to the client
+        raise socket.error(e[0], e[1])
+      if not sent:
+        # the file got shorter underneath us
+        break
+      offset += sent
+      count -= sent
+      self.bytes_sent += sent
+    return True
+
   def finish_response(self):
     self.start = time.time()
+    self.request_handler.server.set_worker_state(scoreboard.STATE_WRITING)
     if not self.result_is_file() or not self.sendfile():
       for data in self.result:
         if self.request_handler.command != 'HEAD':
@@ -147,12 +686,79 @@ class WiseguyWSGIHandler(simple_server.ServerHandler):
     self.close()
 
 
-class SocketFileWrapper(object):
-  """A simple wrapper to keep track of the bytes read.
+class RequestHeaders(object):
+  """A stripped down replacement for mimetools.Message.
 
-  This is not complete and may break - for instance if people start sending
-  us data with 'Transfer-Encoding: chunked', but it works for now.
+  mimetools.Message goes through rfc822 and parses the content type for every
+  request, most of which is thrown away. This reads the header block and
+  keeps (name, value) pairs in order, plus enough of the mimetools interface
+  for BaseHTTPServer and existing callers.
   """
+  # same limit httplib applies to responses
+  max_headers = 100
+
+  def __init__(self, fp, seekable=0):
+    self.fp = fp
+    # the raw lines, for anyone still poking at mimetools internals
+    self.headers = []
+    self._items = []
+    self.dict = {}
+    readline = fp.readline
+    while True:
+      line = readline()
+      if not line or line == '\r\n' or line == '\n':
+        break
+      self.headers.append(line)
+      if line[0] in ' \t':
+        # continuation of the previous header
+        if self._items:
+          name, value = self._items[-1]
+          value = value + ' ' + line.strip()
+          self._items[-1] = (name, value)
+          self.dict[name.lower()] = value
+        continue
+      if len(self.headers) > self.max_headers:
+        raise ValueError('too many headers')
+      name, sep, value = line.partition(':')
+      if not sep:
+        # not a header, mimetools would give up here, we just ignore it
+        continue
+      name = name.strip()
+      value = value.strip()
+      self._items.append((name, value))
+      self.dict[name.lower()] = value
+
+  def getheader(self, name, default=None):
+    return self.dict.get(name.lower(), default)
+  get = getheader
+
+  def __getitem__(self, name):
+    return self.dict[name.lower()]
+
+  def __contains__(self, name):
+    return name.lower() in self.dict
+
+  def items(self):
+    """Return (name, value) pairs in the order they were sent."""
+    return self._items
+
+  @property
+  def typeheader(self):
+    return self.dict.get('content-type')
+
+  @property
+  def type(self):
+    typeheader = self.typeheader
+    if typeheader is None:
+      return 'text/plain'
+    return typeheader.split(';', 1)[0].strip().lower()
+
+  def __str__(self):
+    return ''.join(self.headers)
+
+
+class SocketFileWrapper(object):
+  """A simple wrapper to keep track of the bytes read."""
   def __init__(self, _file, request_handler):
     self.file = _file
     self.request_handler = request_handler
@@ -161,20 +767,7 @@ class SocketFileWrapper(object):
   def __getattr__(self, name):
     return getattr(self.file, name)
 
-  def get_content_length(self):
-    cl = self.request_handler.headers.getheader('Content-Length')
-    if cl is None:
-      return cl
-    return int(cl)
-    
   def read(self, size=-1):
-    if self.get_content_length() is None:
-      return ''
-    
-    if size < 0:
-      # read up to the content-length
-      size = self.get_content_length()
-
     result = self.file.read(size)
     self._bytes_read += len(result)
     return result
@@ -186,22 +779,185 @@ class SocketFileWrapper(object):
 
   def socket_tell(self):
     return self._bytes_read
-   
+
+
+class RequestBody(object):
+  """The wsgi.input for a single request.
+
+  Reads stop exactly at the end of the body, either Content-Length bytes or
+  the last chunk of a 'Transfer-Encoding: chunked' body, so whatever follows
+  in the stream is left alone for the next request on the connection.
+  """
+  # longest chunk size or trailer line we will put up with
+  max_line_size = 8192
+
+  def __init__(self, rfile, content_length=0, chunked=False):
+    self.rfile = rfile
+    self.chunked = chunked
+    # bytes left in the body, or in the current chunk
+    self._remaining = content_length
+    self._chunk_count = 0
+    self._done = not chunked and not content_length
+    # set if the client went away before sending the whole body
+    self.truncated = False
+
+  def _available(self):
+    if not self._remaining and not self._done:
+      if self.chunked:
+        self._next_chunk()
+      else:
+        self._done = True
+    return self._remaining
+
+  def _next_chunk(self):
+    if self._chunk_count:
+      # the CRLF at the end of the previous chunk
+      if self.rfile.readline(self.max_line_size).rstrip('\r\n'):
+        raise ValueError('malformed chunk')
+    line = self.rfile.readline(self.max_line_size)
+    if not line:
+      self._set_truncated()
+      return
+    try:
+      # ignore any chunk extensions
+      chunk_size = int(line.split(';', 1)[0], 16)
+    except ValueError:
+      raise ValueError('bad chunk size: %r' % line[:64])
+    if chunk_size < 0:
+      raise ValueError('bad chunk size: %r' % line[:64])
+    self._chunk_count += 1
+    if chunk_size:
+      self._remaining = chunk_size
+      return
+
+    # last chunk, skip the trailers
+    while True:
+      line = self.rfile.readline(self.max_line_size)
+      if not line:
+        self._set_truncated()
+        return
+      if line in ('\r\n', '\n'):
+        break
+    self._done = True
+
+  def _set_truncated(self):
+    self.truncated = True
+    self._remaining = 0
+    self._done = True
+
+  def read(self, size=-1):
+    if size is None:
+      size = -1
+    data_list = []
+    while size:
+      available = self._available()
+      if not available:
+        break
+      if size < 0 or size > available:
+        want = available
+      else:
+        want = size
+      data = self.rfile.read(want)
+      if not data:
+        self._set_truncated()
+        break
+      self._remaining -= len(data)
+      if size > 0:
+        size -= len(data)
+      data_list.append(data)
+    return ''.join(data_list)
+
+  def readline(self, size=-1):
+    if size is None:
+      size = -1
+    data_list = []
+    while size:
+      available = self._available()
+      if not available:
+        break
+      if size < 0 or size > available:
+        want = available
+      else:
+        want = size
+      data = self.rfile.readline(want)
+      if not data:
+        self._set_truncated()
+        break
+      self._remaining -= len(data)
+      if size > 0:
+        size -= len(data)
+      data_list.append(data)
+      if data.endswith('\n'):
+        break
+    return ''.join(data_list)
+
+  def readlines(self, hint=None):
+    lines = []
+    total = 0
+    for line in self:
+      lines.append(line)
+      total += len(line)
+      if hint and total >= hint:
+        break
+    return lines
+
+  def __iter__(self):
+    while True:
+      line = self.readline()
+      if not line:
+        break
+      yield line
+
+  def discard(self, max_size):
+    """Throw away whatever the application didn't read.
+
+    Returns True if the connection is positioned at the start of the next
+    request, False if the body was bigger than max_size, malformed or cut
+    short.
+    """
+    try:
+      while max_size > 0:
+        data = self.read(min(max_size, 64 * 1024))
+        if not data:
+          break
+        max_size -= len(data)
+      return not self._available() and self._done and not self.truncated
+    except ValueError, e:
+      logging.warning('bad request body: %s', e)
+      return False
+
 
 class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
   # force http 1.1 protocol version
   protocol_version = 'HTTP/1.1'
   wsgi_handler_class = WiseguyWSGIHandler
-  header_size = None
+  MessageClass = RequestHeaders
+  request_body = None
   request_count = 0
   start_time = None
+  # when the connection was accepted, cleared once the first request starts
+  accept_time = None
+  # when the request line and headers had been read
+  parse_time = None
+  # seconds since the load balancer's X-Request-Start, if it sent one
+  queue_time = None
   raw_requestline = None
   debug = False
   # how long will we wait after accepting a connection or processing a request
   # before we return to the accept() loop
   keepalive_timeout = 5.0
+  # how much unread request body we will read and throw away to keep a
+  # connection alive
+  max_discard_size = 64 * 1024
+  # raw header name -> (translated name, environ key), shared by all requests
+  _environ_key_cache = {}
+  environ_key_cache_size = 512
+  # set while the connection is waiting in the server's keep-alive poller
+  parked = False
+  close_connection = False
 
   def setup(self):
+    self.accept_time = time.time()
     self.connection = self.request
     # NOTE: these were added when I could not figure out where the load
     # balancer was getting confused. I'm not convinced they are necessary
@@ -215,11 +971,49 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
 
   def parse_request(self):
     try:
+      if not self._parse_request():
+        return False
+      self.request_body = self._get_request_body()
+      return True
+    except ValueError, e:
+      self.send_error(400, str(e))
+      return False
+
+  def _get_request_body(self):
+    transfer_encoding = self.headers.getheader('transfer-encoding')
+    if transfer_encoding is not None:
+      # chunked has to be the last coding applied, otherwise the only way to
+      # find the end of the body is for the client to close the connection
+      if transfer_encoding.lower().split(',')[-1].strip() != 'chunked':
+        raise ValueError('unsupported transfer-encoding: %s' %
+                         transfer_encoding)
+      return RequestBody(self.rfile, chunked=True)
+    content_length = self.headers.getheader('content-length')
+    if content_length:
+      try:
+        content_length = int(content_length)
+      except ValueError:
+        content_length = -1
+      if content_length < 0:
+        raise ValueError('bad content-length: %s' % content_length)
+      return RequestBody(self.rfile, content_length)
+    return RequestBody(self.rfile)
+
+  def _parse_request(self):
+    words = self.raw_requestline.split()
+    if len(words) != 3 or words[2] not in fast_request_versions:
+      # let BaseHTTPServer deal with the odd stuff and the errors
       return simple_server.WSGIRequestHandler.parse_request(self)
-    finally:
-      # save the amount of data read at this point to optimize POST
-      # keep-alive
-      self.header_size = self.rfile.socket_tell()
+    self.command, self.path, self.request_version = words
+    self.requestline = self.raw_requestline.rstrip('\r\n')
+    self.close_connection = (self.request_version == 'HTTP/1.0')
+    self.headers = self.MessageClass(self.rfile, 0)
+    conntype = self.headers.getheader('connection', '').lower()
+    if conntype == 'close':
+      self.close_connection = True
+    elif conntype == 'keep-alive':
+      self.close_connection = False
+    return True
 
   @property
   def http_version(self):
@@ -241,7 +1035,7 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
     # fixme: is this a bug in simple_server.WSGIRequestHandler??
     try:
       self.handle_one_request()
-      while not self.close_connection:
+      while not self.close_connection and not self.parked:
         self.handle_one_request()
     except select.error, e:
       raise
@@ -252,71 +1046,151 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
         logging.exception('http error %s "%s" %s %s',
                           self.address_string(), self.raw_requestline, e, elapsed)
 
-  def handle_one_request(self):
+  def resume(self):
+    """Serve a connection that was parked by the server's poller."""
+    self.parked = False
+    try:
+      self.handle()
+    finally:
+      self.finish()
+
+  def finish(self):
+    if self.parked:
+      # leave the connection open for the next request
+      self.wfile.flush()
+      return
+    simple_server.WSGIRequestHandler.finish(self)
+
+  def wait_for_request(self):
+    """Return True once the next request has started to arrive."""
+    if self.server._keepalive_poll:
+      # don't wait around, the poller will tell us when there is data
+      timeout = 0
+    else:
+      timeout = self.keepalive_timeout
     ready_rfds, ready_wfds, ready_xfds = select.select(
-      [self.rfile], [], [self.rfile], self.keepalive_timeout)
+      [self.rfile], [], [self.rfile], timeout)
     if not ready_rfds:
+      if self.server.park_connection(self):
+        return False
       logging.debug('%s closing idle connection', self.address_string())
       self.close_connection = True
+      return False
+    return True
+
+  def handle_one_request(self):
+    if not self.wait_for_request():
       return
 
     self.start_time = time.time()
+    self.raw_requestline = self.rfile.readline()
+    if not self.raw_requestline:
+      # the client closed a kept-alive connection - there's no request, so
+      # don't count one
+      self.close_connection = True
+      return
+    self.server.set_worker_state(scoreboard.STATE_READING)
     try:
-      self.raw_requestline = self.rfile.readline()
       if not self.parse_request(): # An error code has been sent, just exit
         return
+      self.parse_time = time.time()
+      self.queue_time = queue_monitor.get_queue_time(
+        self.headers.getheader('x-request-start'), self.start_time)
+      if self.queue_time is not None:
+        self.server.record_queue_time(self.queue_time)
+      if self.server._admission is not None and self.server.should_shed(self):
+        self.send_overloaded(self.server._admission.retry_after)
+        return
 
+      self.server._profiling = False
       if self.server._should_profile_request(self):
-        profiling = True
-        self.server._profile.runcall(self._run_wsgi_app)
+        self.server.run_profiled(self._run_wsgi_app)
+      elif self.server._alloc_profiler is not None:
+        self.server.run_alloc_profiled(self.path, self._run_wsgi_app)
       else:
         self._run_wsgi_app()
+      if self.server._admission is not None:
+        self.server._admission.request_done(time.time() - self.start_time)
 
-      # This deserves some explanation. If we get a malformed request, bail
-      # out early or for any other reason don't consume the inbound stream,
-      # we need to close the connection to prevent a persistent connection
-      # from getting confused. The best way to handle this is to assume we
-      # close on a POST and only keep alive when we are pretty sure we can.
-      # This check means that only urlencoded POSTs are going to stay alive,
-      # multipart forms with close every time.
-      if self.command == 'POST':
+      # If the application didn't read the whole body, the rest of it is
+      # sitting in front of the next request. Skip over it if it's not too
+      # big, otherwise the connection can't be reused.
+      if (not self.close_connection and
+          not self.request_body.discard(self.max_discard_size)):
         self.close_connection = True
-        content_length_value = self.headers.getheader('Content-Length')
-        if content_length_value is not None:
-          content_length = int(content_length_value)
-          # We consider the POST request 'safe' to keep alive when we know the
-          # size before hand and that matches exactly the amount of data we
-          # have read from the inbound stream.
-          if self.rfile.socket_tell() == (self.header_size + content_length):
-            self.close_connection = False
     finally:
-      # this tracks the number of requests handled by a persistent connection
-      self.request_count += 1
-
-      # we need to call the close_request functionality here, but only if we
-      # are dealing with persistent connections - otherwise this will be
-      # called when the connection is torn down.
-      # FIXME: this is a little hard to understand because the fcgi and http
-      # code paths are not as identical as they could be.
-      if not self.close_connection:
-        # specifically, we want to call the routine on ManagedServer, not the
-        # one on SocketServer. Multiple inheritence definitely getting beyond
-        # shady here.
-        #self.server.close_request(self)
-        managed_server.ManagedServer.close_request(self.server, self)
-        # if we decide to terminate, close the connection immediately
-        # FIXME: this results in this request getting double counted, but has
-        # no immediately upleasant implication.
-        if self.server._quit:
-          self.close_connection = True
+      self.end_request()
+
+  def send_overloaded(self, retry_after):
+    """Answer 503 without running the application."""
+    # the rest of the request is unread, so the connection can't be reused
+    self.close_connection = True
+    if self.command == 'HEAD':
+      body = ''
+    else:
+      body = overloaded_body
+    self.wfile.write(
+      '%s 503 Service Unavailable\r\n'
+      'Content-Type: text/plain\r\n'
+      'Content-Length: %s\r\n'
+      'Retry-After: %s\r\n'
+      'Connection: close\r\n'
+      '\r\n%s' % (self.protocol_version, len(overloaded_body), retry_after,
+                   body))
+
+  def end_request(self):
+    # this tracks the number of requests handled by a persistent connection
+    self.request_count += 1
+    self.server.worker_request_done()
+
+    # we need to call the close_request functionality here, but only if we
+    # are dealing with persistent connections - otherwise this will be
+    # called when the connection is torn down.
+    # FIXME: this is a little hard to understand because the fcgi and http
+    # code paths are not as identical as they could be.
+    if not self.close_connection:
+      # specifically, we want to call the routine on ManagedServer, not the
+      # one on SocketServer. Multiple inheritence definitely getting beyond
+      # shady here.
+      #self.server.close_request(self)
+      managed_server.ManagedServer.close_request(self.server, self)
+      # if we decide to terminate, close the connection immediately
+      # FIXME: this results in this request getting double counted, but has
+      # no immediately upleasant implication.
+      if self.server._quit:
+        self.close_connection = True
 
   def _run_wsgi_app(self):
+    self.server.set_worker_state(scoreboard.STATE_APP, self.path,
+                                 self.requestline)
     handler = self.wsgi_handler_class(
-      self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+      self.request_body, self.wfile, self.get_stderr(), self.get_environ())
     # NOTE: handy backpointer, but gc problem?
     handler.request_handler = self
+    app_start_time = time.time()
     handler.run(self.server.get_app())
     handler.request_handler = None
+    if self.server._request_timer is not None:
+      self._record_timing(handler, app_start_time)
+
+  def _record_timing(self, handler, app_start_time):
+    end_time = time.time()
+    # the application iterator runs while the response is being written
+    write_start_time = handler.start or end_time
+    timings = {
+      'parse': self.parse_time - self.start_time,
+      'app': write_start_time - app_start_time,
+      'write': end_time - write_start_time,
+      }
+    if self.accept_time is not None:
+      timings['queue'] = self.start_time - self.accept_time
+      timings['total'] = end_time - self.accept_time
+      self.accept_time = None
+    else:
+      timings['total'] = end_time - self.start_time
+    if self.queue_time is not None:
+      timings['upstream_queue'] = self.queue_time
+    self.server.record_request_timing(handler.route, timings)
 
   def get_environ(self):
     """An optimization for code orginally wsgiref.handlers."""
@@ -345,19 +1219,41 @@ class WiseguyRequestHandler(simple_server.WSGIRequestHandler):
     if length:
       env['CONTENT_LENGTH'] = length
 
-    for h in self.headers.headers:
-      k, v = h.split(':', 1)
-      k = k.translate(translate_header_table)
-      v = v.strip()
+    environ_key_cache = self._environ_key_cache
+    for h, v in self.headers.items():
+      try:
+        k, http_key = environ_key_cache[h]
+      except KeyError:
+        k, http_key = self._cache_environ_key(h)
       if k in env:
         continue
-      http_key = 'HTTP_' + k
       if http_key in env:
         env[http_key] += ',' + v     # comma-separate multiple headers
       else:
         env[http_key] = v
     return env
 
+  @classmethod
+  def _cache_environ_key(cls, header_name):
+    k = header_name.translate(translate_header_table)
+    http_key = 'HTTP_' + k
+    if len(cls._environ_key_cache) >= cls.environ_key_cache_size:
+      # clients can send whatever names they like, don't let that grow
+      # forever. real traffic only uses a few dozen.
+      cls._environ_key_cache.clear()
+    cls._environ_key_cache[header_name] = (k, http_key)
+    return k, http_key
+
+
+def _check_address_in_use(address_family, address):
+  """Raise EADDRINUSE if someone is already bound to address."""
+  probe_socket = socket.socket(address_family, socket.SOCK_STREAM)
+  try:
+    probe_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    probe_socket.bind(address)
+  finally:
+    probe_socket.close()
+
 
 class PreForkingHTTPWSGIServer(preforking.PreForkingMixIn, HTTPServer):
   def __init__(self, app, *pargs, **kargs):
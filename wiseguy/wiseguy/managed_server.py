@@ -1,11 +1,15 @@
 import errno
 import fcntl
+import gc
 import logging
 import os
 import signal
 import socket
 import sys
+import thread
 import threading
+import time
+import traceback
 
 try:
   from wiseguy import fd_server
@@ -13,8 +17,13 @@ except ImportError:
   # fd_server is python2.6 only
   fd_server = None
   
+from wiseguy import alloc_profiler
 from wiseguy import management_server
 from wiseguy import micro_management_server
+from wiseguy import queue_monitor
+from wiseguy import request_timer
+from wiseguy import scoreboard
+from wiseguy import stack_sampler
 
 
 class WiseguyError(Exception):
@@ -33,6 +42,22 @@ class ManagedServer(object):
                fd_server_address=None,
                drop_privileges_callback=None,
                max_total_mem=None,
+               min_workers=None,
+               max_workers=None,
+               preload_modules=None,
+               preload_gc=False,
+               recycle_requests=None,
+               recycle_age=None,
+               recycle_rss_growth=None,
+               stack_sample_interval=None,
+               stack_sample_path=None,
+               stats_address=None,
+               stats_send_interval=10.0,
+               threads=1,
+               alloc_profile_rate=None,
+               alloc_profile_path=None,
+               request_wall_timeout=None,
+               request_cpu_timeout=None,
                **kargs):
     """Construct the manager for a particular server instance.
     server_address - a (host, port) tuple or string
@@ -40,10 +65,47 @@ class ManagedServer(object):
       if there is no server address, assume STDIN is a socket
     accept_input_timeout - set a timeout between the accept() call
       and the time we get data on an incoming socket, milliseconds 
+    min_workers, max_workers - if either is set, the number of workers
+      floats between them depending on how busy the workers are
+    preload_modules - import these in the parent before forking so the
+      children share them copy-on-write
+    preload_gc - collect garbage after preloading, and freeze what's left
+      where the gc module supports it
+    recycle_requests, recycle_age, recycle_rss_growth - replace a child
+      after this many requests, seconds, or kb/minute of rss growth. unlike
+      max_requests, the parent starts the replacement before the old child
+      is told to finish
+    stack_sample_interval - sample the python stack of every child each
+      time it uses this many seconds of cpu, see stack_sampler.py
+    stack_sample_path - directory for the per child sample files
+    stats_address - (host, port) of a spyglass server, each child sends the
+      time spent in each phase of its requests, see request_timer.py
+    stats_send_interval - seconds between sends from each child
+    threads - serve this many requests at once in each child, one per
+      thread. worth it when the application mostly waits on other servers,
+      since the threads share one copy of it
+    alloc_profile_rate - diff the heap around this fraction of requests and
+      total the growth by uri and allocation site, see alloc_profiler.py
+    alloc_profile_path - directory for the per child totals
+    request_wall_timeout, request_cpu_timeout - seconds a request can run,
+      or use cpu, before the parent has the child log its stack and quit
+      after the request. if it's still in the same request a while later,
+      it's killed. the cpu limit only applies to single threaded children
     """
     if kargs:
       logging.warning('passing deprecated args: %s', ', '.join(kargs.keys()))
       
+    # per request thread state, see _scoreboard_slot and _profiling
+    self._local = threading.local()
+    self._threads = max(1, threads)
+    # the ids of the request threads in the middle of a request
+    self._busy_threads = set()
+    self._min_workers = min_workers
+    self._max_workers = max_workers
+    if min_workers is not None:
+      workers = max(workers, min_workers)
+    if max_workers is not None:
+      workers = min(workers, max_workers)
     self._workers = workers
     self._server_address = server_address
     self._management_address = management_address
@@ -52,10 +114,16 @@ class ManagedServer(object):
     self._listen_fd = 0
     self._accept_input_timeout = accept_input_timeout
     self._child_pids = set()
+    # parent side bookkeeping for each child pid, see PreForkingMixIn
+    self._child_info = {}
+    self._recycle_times = []
     self._quit = False
     self._max_requests = max_requests
     self._max_rss = max_rss
     self._max_total_mem = max_total_mem
+    self._recycle_requests = recycle_requests
+    self._recycle_age = recycle_age
+    self._recycle_rss_growth = recycle_rss_growth
     self._mem_stats = None
     self._request_count = 0
     self._skip_profile_requests = 0
@@ -65,8 +133,29 @@ class ManagedServer(object):
     self._profile_memory = profile_memory
     self._profile_memory_min_delta = 0
     self._profile = None
+    # the profilers can only follow one thread at a time
+    self._profile_lock = threading.Lock()
     self._profiling = None
     self._profiler_module = profiler_module
+    self._stack_sample_interval = stack_sample_interval
+    self._stack_sample_path = (stack_sample_path or
+                               '/tmp/wiseguy-stacks-%s' % os.getpid())
+    self._stack_sampler = None
+    self._stats_address = stats_address
+    self._stats_send_interval = stats_send_interval
+    self._request_timer = None
+    self._alloc_profile_rate = alloc_profile_rate
+    self._alloc_profile_path = (alloc_profile_path or
+                                '/tmp/wiseguy-allocs-%s' % os.getpid())
+    self._alloc_profiler = None
+    self._request_wall_timeout = request_wall_timeout
+    self._request_cpu_timeout = request_cpu_timeout
+    # thread id -> the request line of the request it's serving, for the
+    # stack dump when a request runs past its deadline
+    self._request_lines = {}
+    self._preload_modules = preload_modules or []
+    self._preload_gc = preload_gc
+    self._preload_functions = []
     self._init_functions = []
     self._exit_functions = []
     # FIXME: should we add a _privileged_functions? this would run before
@@ -74,6 +163,11 @@ class ManagedServer(object):
     self._drop_privileges_callback = drop_privileges_callback
     # should we allow the a new process to fork?
     self._allow_spawning = True
+    # shared with the children when they are forked, see scoreboard.py
+    self._scoreboard = None
+    # this child's slot in the scoreboard, one per thread when threaded
+    self._scoreboard_slot = None
+    self._thread_slots = []
 
     self._management_server = None
     # the address of the umgmt server in the currently running managed server,
@@ -184,6 +278,36 @@ class ManagedServer(object):
       logging.debug('start management_server')
       self._management_server.start()
         
+  def register_preload_function(self, function, *pargs, **kargs):
+    """these run once in the parent process prior to forking any children"""
+    _register_function(self._preload_functions, function, pargs, kargs)
+
+  def preload(self):
+    """Do as much work as possible before forking.
+
+    Anything imported or initialized here is shared by the children until
+    one of them writes to it. Errors are raised - better to not start at
+    all than to have every child fail the same way."""
+    for module_name in self._preload_modules:
+      logging.info('preload module %s', module_name)
+      __import__(module_name)
+    for (func, targs, kargs) in self._preload_functions:
+      try:
+        func(*targs, **kargs)
+      except:
+        logging.exception('exception during preload function')
+        raise
+    if self._preload_gc:
+      # anything collected in a child dirties the pages the object lived on,
+      # so get rid of the garbage while there is only one copy
+      unreachable = gc.collect()
+      # python2 can't exempt the survivors from future collections, which
+      # touch their gc headers, but newer versions of the gc module can
+      if hasattr(gc, 'freeze'):
+        gc.freeze()
+      logging.info('preload gc collected %s objects, %s tracked',
+                   unreachable, len(gc.get_objects()))
+
   def register_init_function(self, function, *pargs, **kargs):
     """these run in the child process prior to starting the request loop"""
     _register_function(self._init_functions, function, pargs, kargs)
@@ -214,6 +338,23 @@ class ManagedServer(object):
       except:
         logging.exception('exception during exit function')
 
+  def _get_scoreboard_slot(self):
+    return getattr(self._local, 'scoreboard_slot', None)
+
+  def _set_scoreboard_slot(self, slot):
+    self._local.scoreboard_slot = slot
+
+  _scoreboard_slot = property(_get_scoreboard_slot, _set_scoreboard_slot)
+
+  def _get_profiling(self):
+    return getattr(self._local, 'profiling', None)
+
+  def _set_profiling(self, profiling):
+    self._local.profiling = profiling
+
+  # whether the current request is being profiled
+  _profiling = property(_get_profiling, _set_profiling)
+
   def serve_forever(self):
     """Override me"""
     raise NotImplementedError
@@ -223,6 +364,12 @@ class ManagedServer(object):
     
     if self._profile_memory:
       self.init_profile_memory()
+    if self._stack_sample_interval:
+      self.init_stack_sampler()
+    if self._stats_address:
+      self.init_request_timer()
+    if self._alloc_profile_rate:
+      self.init_alloc_profiler()
     self._run_init_functions()
 
   def handle_request(self):
@@ -261,18 +408,118 @@ class ManagedServer(object):
 
   def process_request(self, request, client_address):
     self._profiling = False
+    self.set_worker_state(scoreboard.STATE_APP,
+                          request.environ.get('REQUEST_URI', ''),
+                          '%s %s' % (request.environ.get('REQUEST_METHOD', ''),
+                                     request.environ.get('REQUEST_URI', '')))
+    start_time = time.time()
+    queue_time = queue_monitor.get_queue_time(
+      request.environ.get('HTTP_X_REQUEST_START'), start_time)
+    if queue_time is not None:
+      self.record_queue_time(queue_time)
     try:
       if self._should_profile_request(request):
-        self._profiling = True
         logging.debug('profile: %s', request.environ.get('PATH_INFO', ''))
-        self._profile.runcall(self.finish_request, request, client_address)
+        self.run_profiled(self.finish_request, request, client_address)
+      elif self._alloc_profiler is not None:
+        self.run_alloc_profiled(request.environ.get('REQUEST_URI', ''),
+                                self.finish_request, request, client_address)
       else:
         self.finish_request(request, client_address)
     except IOError, e:
       self._handle_io_error(e)
     except Exception, e:
       self.handle_error(request, client_address)
-      
+    if self._request_timer is not None:
+      # the fastcgi library hides the phases, the whole request is app time
+      elapsed = time.time() - start_time
+      timings = {'app': elapsed, 'total': elapsed}
+      if queue_time is not None:
+        timings['upstream_queue'] = queue_time
+      self.record_request_timing(
+        request.environ.get(request_timer.route_environ_key), timings)
+    self.worker_request_done()
+
+  def run_profiled(self, function, *pargs):
+    """Call function under the profiler.
+
+    The profilers keep a single call stack, so when another thread is
+    already being profiled this request just runs without it."""
+    if not self._profile_lock.acquire(False):
+      return function(*pargs)
+    try:
+      self._profiling = True
+      return self._profile.runcall(function, *pargs)
+    finally:
+      self._profile_lock.release()
+
+  def run_alloc_profiled(self, uri, function, *pargs):
+    """Call function, between heap snapshots if the request is sampled."""
+    snapshot = self._alloc_profiler.before_request()
+    if snapshot is None:
+      return function(*pargs)
+    try:
+      return function(*pargs)
+    finally:
+      self._alloc_profiler.after_request(snapshot, uri)
+
+  def set_worker_state(self, state, uri=None, request_line=None):
+    """Record what this child is up to in the scoreboard."""
+    if self._scoreboard_slot is not None:
+      self._scoreboard_slot.set_state(state, uri)
+    if request_line is not None:
+      self._request_lines[thread.get_ident()] = request_line
+    if self._threads > 1 and state in scoreboard.busy_states:
+      self._busy_threads.add(thread.get_ident())
+
+  def record_request_timing(self, route, timings):
+    """timings - a dict of phase name to elapsed seconds"""
+    if self._request_timer is not None:
+      self._request_timer.record(route, timings)
+
+  def record_queue_time(self, queue_time):
+    """How long the current request waited before a worker started on it,
+    see queue_monitor.py"""
+    if self._scoreboard_slot is not None:
+      self._scoreboard_slot.add_queue_time(queue_time)
+
+  def record_shed(self, priority):
+    """Count a request turned away by admission control."""
+    if self._scoreboard_slot is not None:
+      self._scoreboard_slot.add_shed()
+    if self._request_timer is not None:
+      self._request_timer.increment('shed.%s' % priority)
+
+  def worker_request_done(self):
+    if self._scoreboard_slot is not None:
+      self._scoreboard_slot.request_done()
+    self._request_lines.pop(thread.get_ident(), None)
+    if self._threads > 1:
+      self._busy_threads.discard(thread.get_ident())
+    if self._stack_sampler is not None:
+      self._stack_sampler.maybe_dump()
+    if self._request_timer is not None:
+      self._request_timer.maybe_send()
+    if self._alloc_profiler is not None:
+      self._alloc_profiler.maybe_dump()
+
+  def log_request_stacks(self, stack_frame=None):
+    """Log the request line and python stack of every thread in the middle
+    of a request.
+
+    stack_frame - where a signal handler interrupted this thread, so the
+    handler itself isn't in the stack"""
+    frames = sys._current_frames()
+    if stack_frame is not None:
+      frames[thread.get_ident()] = stack_frame
+    for thread_id, request_line in self._request_lines.items():
+      frame = frames.get(thread_id)
+      if frame is None:
+        continue
+      logging.error('request past its deadline: pid %s thread %s %r\n%s',
+                    os.getpid(), thread_id, request_line,
+                    ''.join(traceback.format_stack(frame)).rstrip())
+
   def get_request(self):
     """Return (request, client_address)
 
@@ -295,6 +542,14 @@ class ManagedServer(object):
     # for instance the embedded managment server
     #sys.exit(0)
     try:
+      if self._stack_sampler:
+        self._stack_sampler.stop()
+        self._stack_sampler.dump()
+      if self._request_timer:
+        self._request_timer.send()
+      if self._alloc_profiler:
+        self._alloc_profiler.stop()
+        self._alloc_profiler.dump()
       # emulating the atexit() functionality here - you want certain
       # thing to tear down, but others (inherited file descriptors
       # for instance) to be left intact
@@ -317,11 +572,13 @@ class ManagedServer(object):
     if self._max_requests is not None:
       # if we are profiling a specific servlet, only count the
       # hits to that servlet against the request limit
-      if self._profile_uri_regex:
-        if self._profiling:
+      if not self._profile_uri_regex or self._profiling:
+        # all of the request threads count against the same limit
+        self._lock.acquire()
+        try:
           self._request_count += 1
-      else:
-        self._request_count += 1
+        finally:
+          self._lock.release()
       if self._request_count >= self._max_requests:
         self._quit = True
       
@@ -374,8 +631,14 @@ class ManagedServer(object):
       logging.warning('failed handle_profile_memory: %s', str(e))
       return
     
-    mem_delta = compute_memory_delta(self._mem_stats, current_mem_stats)
-    self._mem_stats = current_mem_stats
+    # with threads, the growth is blamed on whichever request finishes
+    # next, but at least every kb is only counted once
+    self._lock.acquire()
+    try:
+      mem_delta = compute_memory_delta(self._mem_stats, current_mem_stats)
+      self._mem_stats = current_mem_stats
+    finally:
+      self._lock.release()
     # only log if something changed
     if (mem_delta['VmSize'] > self._profile_memory_min_delta or
         # had to remove VMData - it's not available in generic mode
@@ -388,6 +651,79 @@ class ManagedServer(object):
       current = 'CurRSS:%(VmRSS)s' % current_mem_stats
       logging.info('profile_memory %s %s %s', current, delta, request_uri)
       
+  def set_stack_sampling(self, interval):
+    """Set the sample interval in seconds, None turns sampling off."""
+    self._stack_sample_interval = interval
+
+  def init_stack_sampler(self):
+    try:
+      os.makedirs(self._stack_sample_path)
+    except OSError, e:
+      if e[0] != errno.EEXIST:
+        logging.warning('failed init_stack_sampler: %s', e)
+        return
+    if self._threads > 1:
+      # only the threads in the middle of a request
+      thread_ids = lambda: self._busy_threads
+    else:
+      thread_ids = None
+    self._stack_sampler = stack_sampler.StackSampler(
+      stack_sampler.get_sample_path(self._stack_sample_path, os.getpid()),
+      self._stack_sample_interval, thread_ids)
+    self._stack_sampler.start()
+
+  def init_request_timer(self):
+    try:
+      self._request_timer = request_timer.RequestTimer(
+        self._stats_address, send_interval=self._stats_send_interval)
+    except ImportError, e:
+      logging.warning('failed init_request_timer: %s', e)
+
+  def handle_server_stack_samples(self, pid=None, clear=False):
+    """Return the folded stacks of all children, or just one."""
+    if pid:
+      pids = [pid]
+    else:
+      pids = None
+    stack_counts = stack_sampler.merge_folded(self._stack_sample_path, pids)
+    if clear:
+      stack_sampler.clear_samples(self._stack_sample_path)
+    return stack_sampler.format_folded(stack_counts)
+
+  def set_alloc_profiling(self, rate):
+    """Set the fraction of requests to profile, None turns it off."""
+    self._alloc_profile_rate = rate
+
+  def init_alloc_profiler(self):
+    try:
+      os.makedirs(self._alloc_profile_path)
+    except OSError, e:
+      if e[0] != errno.EEXIST:
+        logging.warning('failed init_alloc_profiler: %s', e)
+        return
+    self._alloc_profiler = alloc_profiler.AllocProfiler(
+      alloc_profiler.get_profile_path(self._alloc_profile_path, os.getpid()),
+      self._alloc_profile_rate)
+    self._alloc_profiler.start()
+
+  def handle_server_alloc_profile_data(self, pid=None, clear=False):
+    """Return (response code, report) for all children, or just one."""
+    if pid:
+      pids = [pid]
+    else:
+      pids = None
+    try:
+      methods, uri_totals = alloc_profiler.merge_profiles(
+        self._alloc_profile_path, pids)
+    except Exception, e:
+      logging.exception('handle_server_alloc_profile_data')
+      return (500, str(e))
+    if clear:
+      stack_sampler.clear_samples(self._alloc_profile_path)
+    if not uri_totals:
+      return (404, 'no memory profile data in %s' % self._alloc_profile_path)
+    return (200, alloc_profiler.format_report(methods, uri_totals))
+
   def _should_profile_request(self, req):
     # this a little fugly
     if (self._profile and
@@ -404,7 +740,7 @@ class ManagedServer(object):
   # FIXME: this relies on prefork behavior
   def handle_server_profile(
     self, profile_path, profile_uri, request_count, skip_request_count,
-    bias, profiler_module):
+    bias, profiler_module, children=1):
     try:
       pid = tuple(self._child_pids)[0]
       self.spawn_child(profile_path, profile_uri, request_count,
@@ -73,12 +73,55 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
     '/server-profile': 'handle_server_profile',
     '/server-profile-data': 'handle_server_last_profile_data',
     '/server-profile-memory': 'handle_profile_memory',
+    '/server-alloc-profiler': 'handle_alloc_profiler',
+    '/server-alloc-profile-data': 'handle_alloc_profile_data',
     '/server-prune-worker': 'handle_prune_worker',
     '/server-resume-spawning': 'handle_resume_spawning',
     '/server-suspend-spawning': 'handle_suspend_spawning',
     '/server-set-max-rss': 'handle_set_max_rss',
     '/server-set-max-total-mem': 'handle_set_max_total_mem',
+    '/server-status': 'handle_server_status',
+    '/server-reload-status': 'handle_server_reload_status',
+    '/server-queue': 'handle_server_queue',
+    '/server-cpu': 'handle_server_cpu',
+    '/server-memory': 'handle_server_memory',
+    '/server-stack-sampler': 'handle_stack_sampler',
+    '/server-stack-samples': 'handle_stack_samples',
     })
+
+  # like handle_profile_memory, this cycles the children to take effect
+  def handle_stack_sampler(self):
+    enable = self._get_int('enable', 0)
+    interval = self._get_float('interval', 0.01)
+    if enable:
+      self.server.fcgi_server.set_stack_sampling(interval)
+    else:
+      self.server.fcgi_server.set_stack_sampling(None)
+    self.server.fcgi_server.handle_server_cycle()
+    if enable:
+      return 'set stack sampler: on (interval: %s).\n' % interval
+    else:
+      return 'set stack sampler: off.\n'
+
+  def handle_stack_samples(self):
+    pid = self._get_int('pid', None)
+    clear = self._get_int('clear', 0)
+    return self.server.fcgi_server.handle_server_stack_samples(pid, clear)
+
+  def handle_server_memory(self):
+    return self.server.fcgi_server.handle_server_memory()
+
+  def handle_server_status(self):
+    return self.server.fcgi_server.handle_server_status()
+
+  def handle_server_reload_status(self):
+    return self.server.fcgi_server.handle_server_reload_status()
+
+  def handle_server_queue(self):
+    return self.server.fcgi_server.handle_server_queue()
+
+  def handle_server_cpu(self):
+    return self.server.fcgi_server.handle_server_cpu()
   
   def handle_set_max_rss(self):
     max_rss = self._get_int('max_rss', 0)
@@ -124,12 +167,14 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
     request_count = self._get_int('request_count', 1000)
     skip_request_count = self._get_int('skip_request_count', 0)
     bias = self._get_float('bias', None)
+    # profile this many children at once and merge their stats
+    children = self._get_int('children', 1)
 
     self.server.fcgi_server.handle_server_profile(
       profile_path, profile_uri, request_count, skip_request_count,
-      bias, profiler_module)
-    return ('starting profiler: %s (bias: %s).\n' %
-            (profiler_module, bias))
+      bias, profiler_module, children)
+    return ('starting profiler: %s (bias: %s, children: %s).\n' %
+            (profiler_module, bias, children))
 
   def handle_server_last_profile_data(self):
     profile_path = self._get_str('profile_path', '/tmp')
@@ -140,6 +185,29 @@ class ManagementRequestHandler(embedded_http_server.EmbeddedRequestHandler):
       self.content_type = 'application/octet-stream'
     return data
 
+  # like handle_profile_memory, this cycles the children to take effect
+  def handle_alloc_profiler(self):
+    enable = self._get_int('enable', 0)
+    rate = self._get_float('rate', 0.01)
+    if enable:
+      self.server.fcgi_server.set_alloc_profiling(rate)
+    else:
+      self.server.fcgi_server.set_alloc_profiling(None)
+    self.server.fcgi_server.handle_server_cycle()
+    if enable:
+      return 'set allocation profiler: on (rate: %s).\n' % rate
+    else:
+      return 'set allocation profiler: off.\n'
+
+  def handle_alloc_profile_data(self):
+    pid = self._get_int('pid', None)
+    clear = self._get_int('clear', 0)
+    self.response_code, data = (
+      self.server.fcgi_server.handle_server_alloc_profile_data(pid, clear))
+    if self.response_code == 200:
+      self.content_type = 'application/octet-stream'
+    return data
+
   # note: this sets a variable in the parent - now you need
   # to cycle the children to actually collect data
   def handle_profile_memory(self):
@@ -46,6 +46,31 @@ class MicroManagementClient(embedded_sock_server.SocketClient):
     else:
       raise MicroManagementError('bad response %r' % response)
 
+  @embedded_sock_server.disconnect_on_completion
+  def cancel_reload(self):
+    self.send_str('cancel_reload')
+    response = self.recv_str()
+    if response == 'OK':
+      pass
+    elif response == 'ERROR':
+      error_str = self.recv_str()
+      raise MicroManagementError(error_str)
+    else:
+      raise MicroManagementError('bad response %r' % response)
+
+  @embedded_sock_server.disconnect_on_completion
+  def memory_in_use(self):
+    """Return (children, total kb, average private kb per child)."""
+    self.send_str('memory_in_use')
+    response = self.recv_str()
+    if response == 'OK':
+      return tuple(int(x) for x in self.recv_str().split())
+    elif response == 'ERROR':
+      error_str = self.recv_str()
+      raise MicroManagementError(error_str)
+    else:
+      raise MicroManagementError('bad response %r' % response)
+
 
 class MicroManagementHandler(embedded_sock_server.EmbeddedHandler):
   def handle_fd_server_shutdown(self):
@@ -61,13 +86,33 @@ class MicroManagementHandler(embedded_sock_server.EmbeddedHandler):
   def handle_prune_worker(self):
     try:
       logging.info('handle_prune_worker')
-      self.server.fcgi_server.handle_server_prune_worker()
+      self.server.fcgi_server.handle_server_prune_worker(reload=True)
       self.send_str('OK')
     except Exception, e:
       logging.exception('handle_prune_child')
       self.send_str('ERROR')
       self.send_str(str(e))
 
+  def handle_cancel_reload(self):
+    try:
+      logging.info('handle_cancel_reload')
+      self.server.fcgi_server.handle_server_cancel_reload()
+      self.send_str('OK')
+    except Exception, e:
+      logging.exception('handle_cancel_reload')
+      self.send_str('ERROR')
+      self.send_str(str(e))
+
+  def handle_memory_in_use(self):
+    try:
+      memory_in_use = self.server.fcgi_server.handle_server_memory_in_use()
+      self.send_str('OK')
+      self.send_str('%d %d %d' % memory_in_use)
+    except Exception, e:
+      logging.exception('handle_memory_in_use')
+      self.send_str('ERROR')
+      self.send_str(str(e))
+
   def handle_graceful_shutdown(self):
     # this is tricky - you don't want to really wait until everything dies
     # you just want to queue the action and go about your business. also,
@@ -7,12 +7,17 @@ import re
 import select
 import signal
 import socket
+import thread
 import threading
 import time
 import sys
 
+from wiseguy import managed_server
 from wiseguy import micro_management_server
+from wiseguy import queue_monitor
+from wiseguy import request_timer
 from wiseguy import resource_manager
+from wiseguy import scoreboard
 
 log = logging.getLogger('wsgi')
 
@@ -26,6 +31,60 @@ class PreForkingMixIn(object):
   check_interval = 1
   mem_check_interval = 30
   last_mem_check_time = 0
+  _memory_sampler = None
+  # the most children the scoreboard can keep track of, threaded children
+  # take a slot per thread
+  scoreboard_slots = 128
+  # adaptive pool sizing, see adapt_workers(). the busy ratio is smoothed
+  # over check_interval samples so a single burst doesn't fork a worker.
+  spawn_busy_ratio = 0.75
+  prune_busy_ratio = 0.25
+  busy_ratio_smoothing = 0.3
+  # seconds without being busy before we prune a worker, and between prunes
+  prune_cool_down = 60
+  _busy_ratio_average = 0.0
+  _last_busy_time = 0
+  # (total kb in use, average private kb per child) from check_children
+  _mem_in_use = None
+  # recycling limits are lowered by a random fraction up to this much for
+  # each child, so children started together don't all go at once
+  recycle_jitter = 0.1
+  # recycle at most recycle_limit children every recycle_interval seconds
+  recycle_limit = 1
+  recycle_interval = 10
+  # a child over max_rss waits its turn to be recycled like any other, unless
+  # it gets past max_rss * max_rss_kill_ratio, then it's killed outright
+  max_rss_kill_ratio = 1.5
+  # don't judge rss growth until a child has been up this long
+  rss_growth_min_age = 60
+  # how long a threaded child waits for requests in flight when it's told to
+  # quit, before it exits anyway
+  thread_shutdown_timeout = 30.0
+  # after a graceful shutdown, children that still aren't in a request after
+  # graceful_shutdown_timeout are killed, the rest get until drain_timeout
+  graceful_shutdown_timeout = 30.0
+  drain_timeout = 300.0
+  # during a rolling reload, how long a new child gets to start up and how
+  # long to wait for an old one to go, see rolling_start()
+  reload_ready_timeout = 60.0
+  reload_drain_timeout = 60.0
+  # progress of a rolling reload, for handle_server_reload_status()
+  _reload_status = None
+  # the old process tree's worker count before it was pruned for a reload
+  _workers_before_reload = None
+  # samples the listen backlog and queue times, see init_queue_monitor()
+  _queue_monitor = None
+  # the children profiling for a fleet profile and where their stats go,
+  # see handle_server_profile()
+  _profile_fleet = None
+  # sends the parent's own samples and counts to spyglass, see
+  # init_parent_request_timer()
+  _parent_request_timer = None
+  # a child past a request deadline gets deadline_signal to log its stack,
+  # and if it's still in the same request deadline_kill_grace seconds later,
+  # a SIGKILL. SIGALRM is no good, the parent passes it on to every child.
+  deadline_signal = signal.SIGUSR2
+  deadline_kill_grace = 10.0
   
   def parent_signal_handler(self, signalnum, stack_frame):
     if signalnum != signal.SIGALRM:
@@ -74,6 +133,17 @@ class PreForkingMixIn(object):
 
     signal.signal(signal.SIGTERM, self.child_signal_handler)
     signal.signal(signal.SIGINT, self.child_signal_handler)
+    signal.signal(self.deadline_signal, self.child_deadline_handler)
+
+  def child_deadline_handler(self, signalnum, stack_frame):
+    # the parent thinks a request has run too long. show where it's stuck
+    # and replace this child once it's done, in case it has left something
+    # in a bad state.
+    try:
+      self.log_request_stacks(stack_frame)
+    except Exception:
+      logging.exception('child_deadline_handler')
+    self._quit = True
 
 #   # NOTE: this can't be used reliably in a thread.
 #   # on some platforms, you get stats about a process by exec'ing a tool and
@@ -87,11 +157,19 @@ class PreForkingMixIn(object):
 #       except:
 #         logging.exception('check_children error')
 
+  @property
+  def memory_sampler(self):
+    if self._memory_sampler is None:
+      self._memory_sampler = resource_manager.MemorySampler(
+        self.mem_check_interval)
+    return self._memory_sampler
+
   def check_children(self):
     # limit children based on memory consumption
-    # FIXME: might want to fork off this new children first, presuming
-    # there are resources to do so, then kill the unruly children. this
-    # might result in smoother response times
+    # children over max_rss are replaced before they are killed, see
+    # recycle_child(), no faster than check_recycle() replaces them. when we
+    # are over max_total_mem there is no room to do that, so those are just
+    # killed.
     if (self.last_mem_check_time and
         self.last_mem_check_time + self.mem_check_interval > time.time()):
       return
@@ -99,38 +177,48 @@ class PreForkingMixIn(object):
     if not self._quit and self._allow_spawning:
       # We kill children using max-rss (per child) or max-total-mem
       killed = {}
-      if self._max_rss:
-        for pid in self.child_pids:
-          try:
-            rss = resource_manager.get_memory_usage(pid)['VmRSS']
-          except resource_manager.MemoryException, e:
-            logging.warning('resource manager error pid: %s %s', pid, e)
-            continue
-          if rss > self._max_rss:
-            logging.info('kill child pid: %s, rss: %s', pid, rss)
-            _kill(pid, signal.SIGTERM)
-            killed[pid] = True
-            # fixme: sigterm is ok for now, but we might need to escalate to a
-            # sigkill at some point
-
-      if self._max_total_mem:
-        mem_usage = []
+      if self._max_rss or self._max_total_mem:
         try:
-          for pid in self.child_pids:
-            if pid in killed: # we killed this guy above already
-              continue
-            mem_usage.append((resource_manager.get_memory_usage(pid), pid))
+          # every child in one pass
+          mem_usage_map = self.memory_sampler.sample(self.child_pids)
         except resource_manager.MemoryException, e:
           logging.warning('resource manager error: %s', e)
           return
 
-        # we assume swap is private (there is no way to find the
-        # shared component of swap)
+      if self._max_rss:
+        over_rss = []
+        for pid, mem in mem_usage_map.iteritems():
+          rss = mem['VmRSS']
+          if rss > self._max_rss * self.max_rss_kill_ratio:
+            logging.warning('kill child pid: %s, rss: %s', pid, rss)
+            _kill(pid, signal.SIGKILL)
+            killed[pid] = True
+          elif rss > self._max_rss:
+            # a child still finishing its last request already has its
+            # replacement, don't start another one every check
+            if self._get_child_info(pid)['recycling']:
+              killed[pid] = True
+            else:
+              over_rss.append((rss, pid))
+        # biggest first
+        over_rss.sort(reverse=True)
+        now = time.time()
+        for rss, pid in over_rss[:self._recycle_allowance(now)]:
+          self.recycle_child(pid, 'rss: %s' % rss)
+          self._recycle_times.append(now)
+          killed[pid] = True
 
-        total_private_mem = sum(mem['private'] + mem['swap']
-                                for mem, pid in mem_usage)
+      if self._max_total_mem:
+        mem_usage = [(mem, pid) for pid, mem in mem_usage_map.iteritems()
+                     # we killed this guy above already
+                     if pid not in killed]
+        if not mem_usage:
+          return
+
+        self._mem_in_use = _get_memory_in_use(
+          [mem for mem, pid in mem_usage])
+        total_in_use = self._mem_in_use[0]
         max_shared_mem = max(mem['shared'] for mem, pid in mem_usage)
-        total_in_use = max_shared_mem + total_private_mem
         logging.debug('checking children total in use %s. max %s',
                       total_in_use, self._max_total_mem)
         if total_in_use >= self._max_total_mem:
@@ -180,19 +268,13 @@ class PreForkingMixIn(object):
         pid, status = os.waitpid(-1, os.WNOHANG)
         if pid:
           try:
-            # NOTE: this is the first good place I can think of to use the
-            # 'with' statement
-            self._lock.acquire()
-            try:
-              self._child_pids.remove(pid)
-            finally:
-              self._lock.release()
-            logging.info("child finished: %s, %s", pid, status)
+            self._remove_child(pid, status)
           except KeyError, e:
             logging.debug("child finished, no such pid: %s, %s",
                       pid, status)
             # this is probably a secondary process that we aren't
             # interested in - just wait for the next child to die
+            self.handle_other_child(pid, status)
             continue
           if pid and status != 0:
             self.handle_bad_child(pid, status)
@@ -214,6 +296,10 @@ class PreForkingMixIn(object):
       if not pid:
         time.sleep(self.check_interval)
         self.check_children()
+        self.check_recycle()
+        self.adapt_workers()
+        self.check_queue()
+        self.check_cpu()
 
       while (not self._quit and
              len(self.child_pids) < self._workers):
@@ -222,6 +308,172 @@ class PreForkingMixIn(object):
           break
         self.spawn_child()
 
+  def _remove_child(self, pid, status):
+    """Forget a child that has exited, raises KeyError if it isn't ours."""
+    # NOTE: this is the first good place I can think of to use the
+    # 'with' statement
+    self._lock.acquire()
+    try:
+      self._child_pids.remove(pid)
+    finally:
+      self._lock.release()
+    if self._scoreboard:
+      self._scoreboard.release_slot(pid)
+    self._child_info.pop(pid, None)
+    logging.info("child finished: %s, %s", pid, status)
+    if self._profile_fleet and pid in self._profile_fleet['pids']:
+      self._profile_fleet['pids'].remove(pid)
+      if not self._profile_fleet['pids']:
+        self.merge_profile_fleet()
+
+  def _get_child_info(self, pid):
+    """Parent side bookkeeping for a child: spawn time, jitter and so on."""
+    try:
+      return self._child_info[pid]
+    except KeyError:
+      pass
+    info = self._child_info[pid] = {
+      'spawn_time': time.time(),
+      'jitter': 1.0 - random.random() * self.recycle_jitter,
+      'rss_baseline': None,
+      'recycling': False,
+      # (time, cpu seconds) from the last check_cpu() and the cpu percent
+      # since the one before
+      'cpu_sample': None,
+      'cpu_percent': 0.0,
+      # (slot, request_start) -> cpu seconds when the request started
+      'request_cpu': {},
+      # (slot, request_start) -> when deadline_signal was sent
+      'deadlines': {},
+      }
+    return info
+
+  def check_recycle(self):
+    """Replace children that have done enough work, lived long enough or are
+    leaking memory, at most recycle_limit of them per recycle_interval."""
+    if not (self._recycle_requests or self._recycle_age or
+            self._recycle_rss_growth):
+      return
+    if self._quit or not self._allow_spawning or not self._scoreboard:
+      return
+
+    now = time.time()
+    allowance = self._recycle_allowance(now)
+    if not allowance:
+      return
+
+    candidates = []
+    pid_to_workers = scoreboard.group_by_pid(self._scoreboard.read())
+    for pid, workers in pid_to_workers.iteritems():
+      if pid not in self._child_pids:
+        continue
+      info = self._get_child_info(pid)
+      if info['recycling']:
+        continue
+      age = now - info['spawn_time']
+      jitter = info['jitter']
+      requests = sum(w['requests'] for w in workers)
+      rss = max(w['rss'] for w in workers)
+      if (self._recycle_requests and
+          requests >= self._recycle_requests * jitter):
+        candidates.append((age, pid, 'requests: %s' % requests))
+      elif self._recycle_age and age >= self._recycle_age * jitter:
+        candidates.append((age, pid, 'age: %d' % age))
+      elif self._recycle_rss_growth and rss:
+        if info['rss_baseline'] is None:
+          info['rss_baseline'] = (now, rss)
+          continue
+        baseline_time, baseline_rss = info['rss_baseline']
+        if now - baseline_time < self.rss_growth_min_age:
+          continue
+        growth = (rss - baseline_rss) * 60.0 / (now - baseline_time)
+        if growth >= self._recycle_rss_growth * jitter:
+          candidates.append((age, pid, 'rss growth: %d kb/min' % growth))
+
+    # oldest first
+    candidates.sort(reverse=True)
+    for age, pid, reason in candidates[:allowance]:
+      self.recycle_child(pid, reason)
+      self._recycle_times.append(now)
+
+  def _recycle_allowance(self, now):
+    """How many more children can be recycled this recycle_interval."""
+    self._recycle_times = [t for t in self._recycle_times
+                           if t > now - self.recycle_interval]
+    return max(self.recycle_limit - len(self._recycle_times), 0)
+
+  def recycle_child(self, pid, reason):
+    """Start a replacement for a child, then ask the old one to finish."""
+    logging.info('recycle child pid: %s, %s', pid, reason)
+    self._get_child_info(pid)['recycling'] = True
+    if not self._quit:
+      self.spawn_child()
+    _kill(pid, signal.SIGTERM)
+
+  @property
+  def adaptive(self):
+    return self._min_workers is not None or self._max_workers is not None
+
+  def adapt_workers(self):
+    """Grow or shrink the pool based on how many workers are busy.
+
+    Add a worker when the smoothed busy ratio is above spawn_busy_ratio, as
+    long as there is room under max_total_mem. Remove an idle one when the
+    ratio has stayed under prune_busy_ratio for prune_cool_down seconds.
+    Runs from manage_children, so at most one change per check_interval."""
+    if not self.adaptive or self._quit or not self._scoreboard:
+      return
+    workers = self._scoreboard.read()
+    if not workers:
+      return
+    now = time.time()
+    if not self._last_busy_time:
+      # give a freshly started pool a full cool down
+      self._last_busy_time = now
+    self._busy_ratio_average += self.busy_ratio_smoothing * (
+      self._scoreboard.busy_ratio(workers) - self._busy_ratio_average)
+    if self._busy_ratio_average > self.prune_busy_ratio:
+      self._last_busy_time = now
+
+    max_workers = self._max_workers or 64
+    min_workers = self._min_workers or 1
+    pid_to_workers = scoreboard.group_by_pid(workers)
+    if self._busy_ratio_average >= self.spawn_busy_ratio:
+      if self._workers >= max_workers or len(pid_to_workers) < self._workers:
+        # at the limit, or still waiting for the last one to start up
+        return
+      if self._max_total_mem and self._mem_in_use:
+        total_in_use, private_per_child = self._mem_in_use
+        if total_in_use + private_per_child > self._max_total_mem:
+          logging.info('busy, but no memory for another worker: %s/%s',
+                       total_in_use, self._max_total_mem)
+          return
+      self._lock.acquire()
+      try:
+        self._workers += 1
+      finally:
+        self._lock.release()
+      logging.info('busy ratio %.2f, growing to %s workers',
+                   self._busy_ratio_average, self._workers)
+      # manage_children takes care of the actual spawn
+    elif (self._workers > min_workers and
+          now - self._last_busy_time >= self.prune_cool_down):
+      # a threaded child is only idle if all of its threads are
+      idle_pids = [pid for pid, slots in pid_to_workers.iteritems()
+                   if all(w['state'] == scoreboard.STATE_IDLE for w in slots)]
+      if not idle_pids:
+        return
+      self._lock.acquire()
+      try:
+        self._workers -= 1
+      finally:
+        self._lock.release()
+      logging.info('busy ratio %.2f, shrinking to %s workers',
+                   self._busy_ratio_average, self._workers)
+      # start the cool down over for the next one
+      self._last_busy_time = now
+      _kill(idle_pids[0], signal.SIGTERM)
+
   # spawn another n children and kill off the old ones so the code cleanly
   # restarts
   # workers - new number of worker processes
@@ -258,18 +510,49 @@ class PreForkingMixIn(object):
   # that get modified, but this shouldn't cause a problem since we mostly
   # operate on a consistent copy. the server as a whole should trend towards
   # consistency.
-  def handle_server_prune_worker(self):
+  def handle_server_prune_worker(self, reload=False):
+    """reload - a new process tree is taking over from this one"""
     pid = None
     self._lock.acquire()
     try:
       if self._workers:
+        if reload and self._workers_before_reload is None:
+          self._workers_before_reload = self._workers
+          self._reload_status = {'state': 'handing over',
+                                 'start_time': time.time()}
         self._workers -= 1
-        pid = self.child_pids[0]
+        # skip the ones that are already on their way out
+        pids = [pid for pid in self.child_pids
+                if not self._get_child_info(pid)['recycling']]
+        if pids:
+          pid = pids[0]
+          self._get_child_info(pid)['recycling'] = True
     finally:
       self._lock.release()
     if pid is not None:
       _kill(pid, signal.SIGTERM)
 
+  def handle_server_cancel_reload(self):
+    """Put back the workers pruned by a reload that didn't finish."""
+    self._lock.acquire()
+    try:
+      if self._workers_before_reload is not None:
+        logging.warning('reload cancelled, back to %s workers',
+                        self._workers_before_reload)
+        self._workers = self._workers_before_reload
+        self._workers_before_reload = None
+        self._reload_status = None
+    finally:
+      self._lock.release()
+
+  def handle_server_memory_in_use(self):
+    """Return (children, total kb, average private kb per child)."""
+    pids = self.child_pids
+    mem_usage_map = self.memory_sampler.sample(pids)
+    total_in_use, private_per_child = _get_memory_in_use(
+      mem_usage_map.values())
+    return (len(pids), total_in_use, private_per_child)
+
   # NOTE: THREADED this executes in another thread. there are shared variables
   # that get modified, but this shouldn't cause a problem since we mostly
   # operate on a consistent copy. the server as a whole should trend towards
@@ -279,12 +562,38 @@ class PreForkingMixIn(object):
 
     Each worker should terminate gracefully, as should the parent."""
     self.graceful_shutdown()
+    self._reload_status = {'state': 'draining', 'start_time': time.time()}
+
+    # schedule some insurance - children that don't exit get a SIGKILL, and
+    # the parent tears down nicely.
+    drain_thread = threading.Thread(target=self._kill_when_drained)
+    drain_thread.setDaemon(True)
+    drain_thread.start()
 
-    # schedule some insurance - if this thread is still alive in 30 seconds,
-    # send SIGKILL to the children and let the parent tear down nicely.
-    timer = threading.Timer(30.0, self.force_shutdown)
-    timer.setDaemon(True)
-    timer.start()
+  def _busy_pids(self):
+    if not self._scoreboard:
+      return set()
+    return set(w['pid'] for w in self._scoreboard.read()
+               if w['state'] in scoreboard.busy_states)
+
+  def _kill_when_drained(self):
+    """Let children finish the requests they are in the middle of."""
+    start_time = time.time()
+    while self.child_pids:
+      time.sleep(self.check_interval)
+      elapsed = time.time() - start_time
+      if elapsed >= self.drain_timeout:
+        logging.warning('children still busy after %ss, killing them',
+                        self.drain_timeout)
+        self.force_shutdown()
+        return
+      if elapsed >= self.graceful_shutdown_timeout:
+        # anything not in a request by now is stuck somewhere a SIGTERM
+        # can't reach
+        busy_pids = self._busy_pids()
+        for pid in self.child_pids:
+          if pid not in busy_pids:
+            _kill(pid, signal.SIGKILL)
 
   def _send_signal(self, signo):
     for pid in self.child_pids:
@@ -299,6 +608,64 @@ class PreForkingMixIn(object):
 
   # FIXME: this is kind of dopey the way we have to send back an http-like
   # response. should this be only in the management_server?
+  def handle_server_profile(
+    self, profile_path, profile_uri, request_count, skip_request_count,
+    bias, profiler_module, children=1):
+    """Replace children with ones that profile request_count requests.
+
+    One child's profile is too noisy for anything that isn't hit often, so
+    with children > 1 that many profile at once and their stats are added
+    up when the last one finishes, see merge_profile_fleet()."""
+    if children <= 1:
+      return managed_server.ManagedServer.handle_server_profile(
+        self, profile_path, profile_uri, request_count, skip_request_count,
+        bias, profiler_module)
+    if self._profile_fleet:
+      logging.warning('fleet profile already running, %s children left',
+                      len(self._profile_fleet['pids']))
+      return
+    try:
+      old_pids = [pid for pid in self.child_pids
+                  if not self._get_child_info(pid)['recycling']][:children]
+      self._profile_fleet = {
+        'pids': set(),
+        'paths': [],
+        'profile_path': profile_path,
+        'profiler_module': profiler_module,
+        }
+      for i in xrange(children):
+        pid = self.spawn_child(profile_path, profile_uri, request_count,
+                               skip_request_count, bias, profiler_module,
+                               link_last_profile=False)
+        if pid:
+          self._profile_fleet['pids'].add(pid)
+          self._profile_fleet['paths'].append(
+            get_profile_filename(profile_path, pid, profiler_module))
+      for pid in old_pids:
+        self._get_child_info(pid)['recycling'] = True
+        _kill(pid, signal.SIGTERM)
+    except:
+      logging.exception("handle_server_profile")
+
+  def merge_profile_fleet(self):
+    """Add up the stats of a finished fleet profile and link it as
+    last_profile for /server-profile-data."""
+    fleet = self._profile_fleet
+    self._profile_fleet = None
+    path = os.path.join(
+      os.path.abspath(fleet['profile_path']),
+      '%s-fleet-%u.%s' % (os.path.basename(sys.argv[0]), os.getpid(),
+                          fleet['profiler_module']))
+    try:
+      merged = resource_manager.merge_profile_stats(fleet['paths'], path)
+    except Exception:
+      logging.exception('merge_profile_fleet')
+      return
+    logging.info('merged %s/%s profiles into %s', merged,
+                 len(fleet['paths']), path)
+    if merged:
+      _link_last_profile(path)
+
   def handle_server_last_profile_data(self, profile_path):
     last_profile_link = os.path.join(os.path.abspath(profile_path),
                                      last_profile_symlink_name)
@@ -316,26 +683,247 @@ class PreForkingMixIn(object):
       logging.exception("handle_server_last_profile_data")
       return (500, str(e))
 
+  def init_parent_request_timer(self):
+    if not self._stats_address:
+      return
+    try:
+      self._parent_request_timer = request_timer.RequestTimer(
+        self._stats_address, send_interval=self._stats_send_interval)
+    except ImportError, e:
+      logging.warning('failed init_parent_request_timer: %s', e)
+
+  def init_queue_monitor(self):
+    if self._listen_socket is None:
+      # fastcgi on stdin
+      return
+    self._queue_monitor = queue_monitor.QueueMonitor(
+      self._listen_socket, self._parent_request_timer)
+
+  def check_queue(self):
+    if self._queue_monitor is None:
+      return
+    try:
+      self._queue_monitor.sample(self._scoreboard and self._scoreboard.read())
+    except Exception, e:
+      logging.warning('check_queue error: %s', e)
+
+  def check_cpu(self):
+    """Sample the cpu time of every child and enforce the request
+    deadlines."""
+    try:
+      self._check_cpu()
+    except Exception, e:
+      logging.warning('check_cpu error: %s', e)
+
+  def _check_cpu(self):
+    now = time.time()
+    cpu_times = {}
+    last_samples = {}
+    for pid in self.child_pids:
+      try:
+        cpu_times[pid] = resource_manager.get_cpu_time(pid)
+      except resource_manager.CpuException, e:
+        # probably exited since child_pids was read
+        logging.debug('check_cpu pid %s: %s', pid, e)
+        continue
+      info = self._get_child_info(pid)
+      last_sample = last_samples[pid] = info['cpu_sample']
+      info['cpu_sample'] = (now, cpu_times[pid])
+      if last_sample is not None and now > last_sample[0]:
+        info['cpu_percent'] = 100.0 * (
+          cpu_times[pid] - last_sample[1]) / (now - last_sample[0])
+    if not self._scoreboard:
+      return
+    for pid, workers in scoreboard.group_by_pid(
+      self._scoreboard.read()).iteritems():
+      if pid not in cpu_times:
+        continue
+      self._check_deadlines(pid, workers, cpu_times[pid], last_samples[pid],
+                            now)
+    if self._parent_request_timer is not None:
+      self._parent_request_timer.maybe_send()
+
+  def _check_deadlines(self, pid, workers, cpu_time, last_sample, now):
+    info = self._get_child_info(pid)
+    request_cpu = {}
+    deadlines = {}
+    send_signal = False
+    for w in workers:
+      if w['state'] not in scoreboard.busy_states or not w['request_start']:
+        continue
+      key = (w['slot'], w['request_start'])
+      # the threads of a child share its cpu time, so only a single threaded
+      # child can say how much a request has used
+      if self._threads == 1:
+        start_cpu = info['request_cpu'].get(key)
+        if start_cpu is None:
+          # a request that started since the last sample is measured from
+          # that sample, so it may include a little of the one before
+          if last_sample is not None and last_sample[0] <= w['request_start']:
+            start_cpu = last_sample[1]
+          else:
+            start_cpu = cpu_time
+        request_cpu[key] = start_cpu
+        cpu = cpu_time - start_cpu
+      else:
+        cpu = None
+      if key in info['deadlines']:
+        deadlines[key] = info['deadlines'][key]
+        if (deadlines[key] is not None and
+            now - deadlines[key] >= self.deadline_kill_grace):
+          logging.error('killing pid %s, still in %s %.1fs after its '
+                        'deadline', pid, w['uri'], now - deadlines[key])
+          _kill(pid, signal.SIGKILL)
+          self._increment_parent_count('deadline.killed')
+          # just the once
+          deadlines[key] = None
+        continue
+      wall = now - w['request_start']
+      if self._request_wall_timeout and wall > self._request_wall_timeout:
+        reason = 'wall'
+      elif (self._request_cpu_timeout and cpu is not None and
+            cpu > self._request_cpu_timeout):
+        reason = 'cpu'
+      else:
+        continue
+      if cpu is None:
+        logging.error('request over its %s deadline: pid %s %s wall %.1fs',
+                      reason, pid, w['uri'], wall)
+      else:
+        logging.error('request over its %s deadline: pid %s %s wall %.1fs '
+                      'cpu %.1fs', reason, pid, w['uri'], wall, cpu)
+      self._increment_parent_count('deadline.%s' % reason)
+      deadlines[key] = now
+      send_signal = True
+    if send_signal:
+      # the child logs the stacks of all its requests at once
+      _kill(pid, self.deadline_signal)
+    # forget the requests that have finished
+    info['request_cpu'] = request_cpu
+    info['deadlines'] = deadlines
+
+  def _increment_parent_count(self, name):
+    if self._parent_request_timer is not None:
+      self._parent_request_timer.increment(name)
+
+  def handle_server_cpu(self):
+    """Show the cpu used by each child, and by the requests in flight."""
+    now = time.time()
+    lines = ['%-7s %10s %6s %9s %9s  %s' % (
+      'pid', 'cpu_s', 'cpu_%', 'wall_s', 'req_cpu_s', 'uri')]
+    if self._scoreboard:
+      pid_to_workers = scoreboard.group_by_pid(self._scoreboard.read())
+    else:
+      pid_to_workers = {}
+    for pid in sorted(self.child_pids):
+      info = self._child_info.get(pid)
+      if info is None or info['cpu_sample'] is None:
+        lines.append('%-7s %10s' % (pid, '-'))
+        continue
+      cpu_time = info['cpu_sample'][1]
+      lines.append('%-7s %10.2f %6.1f' % (pid, cpu_time, info['cpu_percent']))
+      for w in pid_to_workers.get(pid, []):
+        if w['state'] not in scoreboard.busy_states or not w['request_start']:
+          continue
+        key = (w['slot'], w['request_start'])
+        if key in info['request_cpu']:
+          cpu = '%.3f' % (cpu_time - info['request_cpu'][key])
+        else:
+          cpu = '-'
+        lines.append('%-7s %10s %6s %9.3f %9s  %s' % (
+          '', '', '', now - w['request_start'], cpu, w['uri']))
+    limits = []
+    if self._request_wall_timeout:
+      limits.append('wall %ss' % self._request_wall_timeout)
+    if self._request_cpu_timeout:
+      limits.append('cpu %ss' % self._request_cpu_timeout)
+    lines.append('')
+    lines.append('request deadlines: %s' % (', '.join(limits) or 'none'))
+    return '\n'.join(lines) + '\n'
+
+  def handle_server_queue(self):
+    if self._queue_monitor is None:
+      return 'no listening socket.\n'
+    return self._queue_monitor.format_status()
+
+  def handle_server_status(self):
+    if not self._scoreboard:
+      return 'no scoreboard.\n'
+    return scoreboard.format_status(self._scoreboard.read())
+
+  def handle_server_reload_status(self):
+    status = self._reload_status
+    if status is None:
+      return 'no reload in progress.\n'
+    elapsed = time.time() - status['start_time']
+    if status['state'] in ('handing over', 'draining'):
+      # the old process tree
+      return '%s: %s workers left, %s busy, %.1fs\n' % (
+        status['state'], len(self.child_pids), len(self._busy_pids()),
+        elapsed)
+    return ('reload %s: %s/%s new workers ready, %s old workers told to '
+            'finish, %.1fs\n' % (status['state'], status['ready'],
+                                  status['target'], status['pruned'], elapsed))
+
+  def handle_server_memory(self):
+    """Show the memory of each child, including how much is still shared
+    with the parent."""
+    try:
+      mem_usage_map = self.memory_sampler.get(self.child_pids)
+    except resource_manager.MemoryException, e:
+      return 'ERROR.\n%s\n' % e
+    lines = ['sampled %.1f seconds ago' % (
+      time.time() - self.memory_sampler.sample_time), '']
+    lines.append('%-7s %10s %10s %10s %10s %10s' % (
+      'pid', 'rss_kb', 'size_kb', 'shared_kb', 'private_kb', 'swap_kb'))
+    for pid, mem in sorted(mem_usage_map.iteritems()):
+      lines.append('%-7s %10s %10s %10s %10s %10s' % (
+        pid, mem['VmRSS'], mem['VmSize'], mem.get('shared', '-'),
+        mem.get('private', '-'), mem.get('swap', '-')))
+    return '\n'.join(lines) + '\n'
+
   def handle_bad_child(self, pid, status):
     # a child exitted with a non-zero return code
     logging.error("child error on exit: %s, %s", pid, status)
 
+  def handle_other_child(self, pid, status):
+    """Called when a process that isn't a worker exits."""
+    pass
+
   def spawn_child(self, profile_path=None, profile_uri=None,
                   max_requests=None, skip_profile_requests=None,
-                  profile_bias=None, profiler_module=None):
+                  profile_bias=None, profiler_module=None,
+                  link_last_profile=True):
     if not self._allow_spawning:
       logging.warning('spawn_child is disabled')
       return
 
     logging.debug("respawning a child")
+    if self._scoreboard is None:
+      self._scoreboard = scoreboard.Scoreboard(
+        self.scoreboard_slots * self._threads)
+    slot_indexes = [self._scoreboard.reserve_slot()
+                    for i in xrange(self._threads)]
     pid = os.fork()
     if pid:
       # parent
       self._child_pids.add(pid)
+      self._get_child_info(pid)
+      for slot_index in slot_indexes:
+        if slot_index is not None:
+          self._scoreboard.assign_slot(slot_index, pid)
       return pid
 
     # child
     self.post_fork_reinit()
+    self._thread_slots = [
+      self._scoreboard.get_slot(slot_index) if slot_index is not None else None
+      for slot_index in slot_indexes]
+    if self._threads == 1:
+      self._scoreboard_slot = self._thread_slots[0]
+      if self._scoreboard_slot is not None:
+        # not idle until init_child() is done, see wait_for_ready()
+        self._scoreboard_slot.start(os.getpid(), scoreboard.STATE_STARTING)
 
     if not profile_path:
       profile_path = self._profile_path
@@ -343,6 +931,10 @@ class PreForkingMixIn(object):
       profile_uri = self._profile_uri
     if max_requests:
       self._max_requests = max_requests
+    elif self._max_requests:
+      # don't let children that started together all quit together
+      self._max_requests -= int(
+        self._max_requests * random.random() * self.recycle_jitter)
     if skip_profile_requests:
       self._skip_profile_requests = skip_profile_requests
       # you have to increase the max number of requests to account
@@ -353,11 +945,7 @@ class PreForkingMixIn(object):
     if profile_path:
       if profiler_module is None:
         profiler_module = self._profiler_module
-      path = os.path.join(
-        os.path.abspath(profile_path),
-        '%s-%u.%s' % (os.path.basename(sys.argv[0]),
-                      os.getpid(),
-                      profiler_module))
+      path = get_profile_filename(profile_path, os.getpid(), profiler_module)
       last_profile_link = os.path.join(
         os.path.abspath(profile_path),
         last_profile_symlink_name)
@@ -377,20 +965,16 @@ class PreForkingMixIn(object):
     # do it here so we can get most of the wiseguy scaffold in place
     # prior
     self.init_child()
+    if self._scoreboard_slot is not None:
+      self._scoreboard_slot.set_state(scoreboard.STATE_IDLE)
     self._child_request_loop()
 
     # fixme: move to managed_server.exit_child?
     if self._profile:
       self._profile.close()
-      last_profile_link = os.path.join(
-        os.path.dirname(self._profile.filename),
-        last_profile_symlink_name)
-      try:
-        os.symlink(self._profile.filename, last_profile_link)
-      except OSError, e:
-        if e[0] not in (errno.EEXIST,):
-          logging.exception("error creating symlink %s",
-                            self._profile.filename)
+      # a fleet profile is linked once the parent has merged it
+      if link_last_profile:
+        _link_last_profile(self._profile.filename)
       
     self.exit_child()
 
@@ -423,13 +1007,161 @@ class PreForkingMixIn(object):
     logging._releaseLock()
     
   def _child_request_loop(self):
+    if self._threads > 1:
+      self._threaded_request_loop()
+      return
     while not self._quit:
       try:
         self.handle_request()
       except (select.error, IOError), e:
         self._handle_io_error(e)
 
+  def _threaded_request_loop(self):
+    threads = []
+    for slot in self._thread_slots:
+      t = threading.Thread(target=self._request_thread, args=(slot,))
+      # don't let a stuck request keep the child around forever
+      t.setDaemon(True)
+      t.start()
+      threads.append(t)
+
+    # signals are only delivered to the main thread, so it just waits for
+    # one to set _quit, or for the request threads to quit by themselves
+    while not self._quit and [t for t in threads if t.isAlive()]:
+      time.sleep(self.check_interval)
+    self._quit = True
+    # idle threads may be stuck in accept(), only wait for the busy ones
+    deadline = time.time() + self.thread_shutdown_timeout
+    while self._busy_threads:
+      if time.time() >= deadline:
+        logging.warning('%s request threads still busy, exiting anyway',
+                        len(self._busy_threads))
+        break
+      time.sleep(0.1)
+
+  def _request_thread(self, slot):
+    self._scoreboard_slot = slot
+    if slot is not None:
+      slot.start(os.getpid())
+    try:
+      while not self._quit:
+        try:
+          self.handle_request()
+        except (select.error, IOError), e:
+          self._handle_io_error(e)
+    except:
+      # this would kill a single threaded child, so take this one down too
+      logging.exception('request thread failed')
+      self._busy_threads.discard(thread.get_ident())
+      self._quit = True
+
+  def rolling_start(self, uclient):
+    """Take over from the previous process tree one worker at a time.
+
+    An old worker is only told to finish once a new one has started up and
+    run its init functions, so there are always about self._workers ready
+    to take requests. With max_total_mem set, old workers are drained first
+    whenever the two trees together wouldn't fit. If a new worker dies
+    before it is ready, the old tree gets its workers back and this raises.
+    """
+    status = self._reload_status = {
+      'state': 'starting', 'start_time': time.time(), 'ready': 0,
+      'target': self._workers, 'pruned': 0}
+    while status['ready'] < status['target']:
+      if self._max_total_mem:
+        old_workers, old_total, old_private = self._get_old_memory_in_use(
+          uclient)
+        if old_workers and not self._have_memory_for_worker(
+            old_total, old_private):
+          logging.info('reload: no memory for another worker, draining one')
+          status['state'] = 'draining'
+          self._prune_old_worker(uclient)
+          self._wait_for_old_worker(uclient, old_workers)
+          continue
+
+      status['state'] = 'spawning'
+      pid = self.spawn_child()
+      if pid is None:
+        break
+      if not self.wait_for_ready(pid):
+        status['state'] = 'failed'
+        try:
+          uclient.cancel_reload()
+        except Exception, e:
+          logging.warning('uclient error during cancel_reload: %s', e)
+        self.graceful_shutdown()
+        raise managed_server.WiseguyError(
+          'reload failed, child %s did not start' % pid)
+      status['ready'] += 1
+      if status['pruned'] < status['ready']:
+        self._prune_old_worker(uclient)
+    status['state'] = 'done'
+
+  def _prune_old_worker(self, uclient):
+    self._reload_status['pruned'] += 1
+    try:
+      logging.debug('sending prune_worker to old wiseguy')
+      uclient.prune_worker()
+    except socket.timeout:
+      # if we timed out, maybe the parent is already dead
+      logging.warning('uclient timed out during prune_worker')
+    except Exception, e:
+      logging.warning('uclient error during prune_worker: %s', e)
+
+  def _get_old_memory_in_use(self, uclient):
+    """Return (children, total kb, average private kb per child) for the
+    old process tree, zeros if it has gone away."""
+    try:
+      memory_in_use = uclient.memory_in_use()
+    except Exception, e:
+      logging.warning('uclient error during memory_in_use: %s', e)
+      memory_in_use = (0, 0, 0)
+    return memory_in_use
+
+  def _have_memory_for_worker(self, old_total, old_private):
+    try:
+      new_total, new_private = _get_memory_in_use(
+        self.memory_sampler.sample(self.child_pids).values())
+    except resource_manager.MemoryException, e:
+      logging.warning('resource manager error: %s', e)
+      return True
+    # a new child costs about what the others do
+    estimate = new_private or old_private
+    return old_total + new_total + estimate <= self._max_total_mem
+
+  def _wait_for_old_worker(self, uclient, old_workers):
+    deadline = time.time() + self.reload_drain_timeout
+    while time.time() < deadline:
+      if self._get_old_memory_in_use(uclient)[0] < old_workers:
+        return
+      time.sleep(0.1)
+    logging.warning('reload: old worker still running after %ss',
+                    self.reload_drain_timeout)
+
+  def wait_for_ready(self, pid):
+    """Wait for a new child to be ready to accept requests, return False if
+    it exits first."""
+    deadline = time.time() + self.reload_ready_timeout
+    while time.time() < deadline:
+      exited_pid, status = os.waitpid(pid, os.WNOHANG)
+      if exited_pid:
+        self._remove_child(pid, status)
+        self.handle_bad_child(pid, status)
+        return False
+      if not self._scoreboard:
+        # no way to tell, hope for the best
+        return True
+      slots = scoreboard.group_by_pid(self._scoreboard.read()).get(pid, [])
+      if [w for w in slots if w['state'] != scoreboard.STATE_STARTING]:
+        return True
+      time.sleep(0.05)
+    logging.warning('child %s not ready after %ss', pid,
+                    self.reload_ready_timeout)
+    return True
+
   def serve_forever(self):
+    self.preload()
+
     # if you are a stealing existing file descriptors and you know the previous
     # pid, fire up a client so you can gracefully prune the children as you
     # start up. the thinking is that if you start too quickly you will use up
@@ -452,18 +1184,12 @@ class PreForkingMixIn(object):
     else:
       uclient = None
 
+    if uclient:
+      self.rolling_start(uclient)
+
     while len(self.child_pids) < self._workers:
       logging.debug('serve_forever - spawn %s/%s',
                 len(self._child_pids) + 1, self._workers)
-      if uclient:
-        try:
-          logging.debug('sending prune_worker to old wiseguy')
-          uclient.prune_worker()
-        except socket.timeout:
-          # if we timed out, maybe the parent is already dead
-          logging.warning('uclient timed out during prune_worker')
-        except Exception, e:
-          logging.warning('uclient error during prune_worker: %s', e)
       self.spawn_child()
 
     # once you have spawned as many children as you think you need, send the
@@ -479,12 +1205,48 @@ class PreForkingMixIn(object):
       
     self.install_parent_signals()
     self.unlock_startup()
+    self.init_parent_request_timer()
+    self.init_queue_monitor()
     try:
       self.manage_children()
     except:
       logging.exception("unhandled exception in manage_children, exitting")
     self.exit_parent()
 
+def get_profile_filename(profile_path, pid, profiler_module):
+  return os.path.join(
+    os.path.abspath(profile_path),
+    '%s-%u.%s' % (os.path.basename(sys.argv[0]), pid, profiler_module))
+
+
+def _link_last_profile(filename):
+  last_profile_link = os.path.join(os.path.dirname(filename),
+                                   last_profile_symlink_name)
+  try:
+    os.remove(last_profile_link)
+  except OSError, e:
+    if e[0] not in (errno.ENOENT,):
+      logging.exception("error removing symlink: %s", last_profile_link)
+  try:
+    os.symlink(filename, last_profile_link)
+  except OSError, e:
+    if e[0] not in (errno.EEXIST,):
+      logging.exception("error creating symlink %s", filename)
+
+
+def _get_memory_in_use(mem_usage):
+  """Return (total kb, average private kb per child) for a list of
+  get_memory_usage() results. Shared memory is only counted once."""
+  if not mem_usage:
+    return (0, 0)
+  # we assume swap is private (there is no way to find the
+  # shared component of swap)
+  total_private_mem = sum(mem['private'] + mem['swap'] for mem in mem_usage)
+  max_shared_mem = max(mem['shared'] for mem in mem_usage)
+  return (max_shared_mem + total_private_mem,
+          total_private_mem / len(mem_usage))
+
+
 def _kill(pid, signo):
   try:
     logging.info('send kill pid: %s signo: %s', pid, signo)
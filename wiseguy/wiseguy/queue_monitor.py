@@ -0,0 +1,217 @@
+"""How long requests wait before a worker picks them up.
+
+There are two views of this:
+  backlog - connections the kernel has accepted that no worker has
+    accept()ed yet. The parent samples the listening socket every
+    check_interval, from TCP_INFO where it can, otherwise by adding up the
+    listening sockets on the port in /proc/net/tcp (with SO_REUSEPORT every
+    worker has its own). Unix domain sockets don't expose their queue.
+  queue time - per request, from the X-Request-Start header the load
+    balancer stamps on the way in to the moment a worker starts reading the
+    request. That includes the backlog as well as any queueing in the load
+    balancer itself, but also the clock skew between the two machines.
+
+Workers add their queue times to their scoreboard slot and the parent adds
+up the change in every slot each time it samples the backlog, so nothing
+extra passes between processes.
+"""
+
+import collections
+import socket
+import struct
+import threading
+import time
+
+# python2 doesn't export this, but it's been 11 on linux forever
+TCP_INFO = getattr(socket, 'TCP_INFO', 11)
+TCP_LISTEN = 10
+# the start of struct tcp_info - state, ca_state, retransmits, probes,
+# backoff, options, wscale, flags, then rto, ato, snd_mss, rcv_mss, unacked
+# and sacked. for a listening socket, unacked is the number of connections
+# waiting to be accepted and sacked is the backlog limit.
+tcp_info_struct = struct.Struct('=8B6I')
+
+proc_net_paths = ('/proc/net/tcp', '/proc/net/tcp6')
+proc_net_listen_state = '0A'
+
+
+def get_socket_backlog(sock):
+  """Return (queued, limit) for a listening tcp socket, or None."""
+  try:
+    info = tcp_info_struct.unpack(sock.getsockopt(
+      socket.IPPROTO_TCP, TCP_INFO, tcp_info_struct.size))
+  except (socket.error, struct.error):
+    return None
+  if info[0] != TCP_LISTEN:
+    return None
+  return info[12], info[13]
+
+
+def get_port_backlog(port):
+  """Return (queued, limit) summed over every socket listening on port.
+
+  limit is 0 on kernels that don't show it."""
+  suffix = ':%04X' % port
+  queued = limit = 0
+  found = False
+  for path in proc_net_paths:
+    try:
+      f = open(path)
+    except IOError:
+      continue
+    try:
+      # skip the column headings
+      f.readline()
+      for line in f:
+        fields = line.split()
+        if (len(fields) < 5 or fields[3] != proc_net_listen_state or
+            not fields[1].endswith(suffix)):
+          continue
+        found = True
+        tx_queue, rx_queue = fields[4].split(':')
+        queued += int(rx_queue, 16)
+        limit += int(tx_queue, 16)
+    finally:
+      f.close()
+  if not found:
+    return None
+  return queued, limit
+
+
+def get_backlog(sock):
+  """Return (queued, limit) for the listening socket, or None."""
+  backlog = get_socket_backlog(sock)
+  if backlog is not None:
+    return backlog
+  try:
+    address = sock.getsockname()
+  except socket.error:
+    return None
+  if sock.family not in (socket.AF_INET, socket.AF_INET6):
+    return None
+  return get_port_backlog(address[1])
+
+
+def parse_request_start(value):
+  """Return the time in an X-Request-Start header, in seconds.
+
+  nginx sends t=<seconds>.<milliseconds>, others send whole milliseconds or
+  microseconds, with or without the t=."""
+  if value.startswith('t='):
+    value = value[2:]
+  try:
+    request_start = float(value)
+  except ValueError:
+    return None
+  # anything after 2286 is in smaller units
+  while request_start > 1e10:
+    request_start /= 1000.0
+  return request_start
+
+
+def get_queue_time(header_value, start_time):
+  """Seconds between the load balancer's X-Request-Start and start_time.
+
+  Returns None if there is no usable header."""
+  if not header_value:
+    return None
+  request_start = parse_request_start(header_value)
+  if request_start is None:
+    return None
+  # clock skew can make this negative, and a bogus header can make it huge
+  queue_time = start_time - request_start
+  if queue_time > 3600:
+    return None
+  return max(0.0, queue_time)
+
+
+class QueueMonitor(object):
+  """Parent side, sample() once every check_interval."""
+  # samples kept for the status page, one per sample() call
+  history_size = 60
+
+  def __init__(self, listen_socket, timer=None):
+    """listen_socket - the socket the workers accept() from
+    timer - a request_timer.RequestTimer to send the samples to spyglass
+    """
+    self._socket = listen_socket
+    self._timer = timer
+    # (time, queued or None, requests, total queue time) for each sample
+    self._history = collections.deque(maxlen=self.history_size)
+    # the management server reads the history from another thread
+    self._lock = threading.Lock()
+    self.limit = None
+    # (slot, pid) -> (requests, total queue time) as of the last sample
+    self._slot_totals = {}
+
+  def sample(self, workers=None, now=None):
+    """workers - scoreboard.read() output, for the queue times"""
+    if now is None:
+      now = time.time()
+    backlog = get_backlog(self._socket)
+    if backlog is None:
+      queued = None
+    else:
+      queued, limit = backlog
+      if limit:
+        self.limit = limit
+    requests, queue_time = self._sample_queue_times(workers or [])
+    self._lock.acquire()
+    try:
+      self._history.append((now, queued, requests, queue_time))
+    finally:
+      self._lock.release()
+    if self._timer is not None:
+      if queued is not None:
+        # spyglass only keeps histograms of times in milliseconds, so each
+        # queued connection counts as a millisecond
+        self._timer.record_sample('listen_queue', queued / 1000.0, now)
+      self._timer.maybe_send()
+
+  def _sample_queue_times(self, workers):
+    requests = 0
+    queue_time = 0.0
+    slot_totals = {}
+    for w in workers:
+      key = (w['slot'], w['pid'])
+      totals = (w['queued_requests'], w['queue_time'])
+      slot_totals[key] = totals
+      # a new child in a slot starts from zero
+      last_requests, last_queue_time = self._slot_totals.get(key, (0, 0.0))
+      requests += totals[0] - last_requests
+      queue_time += totals[1] - last_queue_time
+    self._slot_totals = slot_totals
+    return requests, queue_time
+
+  def format_status(self, now=None):
+    if now is None:
+      now = time.time()
+    self._lock.acquire()
+    try:
+      history = list(self._history)
+    finally:
+      self._lock.release()
+    if not history:
+      return 'no samples yet.\n'
+    window = now - history[0][0]
+    depths = [queued for t, queued, r, q in history if queued is not None]
+    lines = []
+    if depths:
+      lines.append(
+        'listen backlog: %s queued (limit %s), max %s, average %.1f over '
+        '%.0fs' % (depths[-1], self.limit or '?', max(depths),
+                   float(sum(depths)) / len(depths), window))
+      lines.append('recent: %s' % ' '.join(str(x) for x in depths[-20:]))
+    else:
+      lines.append('listen backlog: not available for %s' % (
+        self._socket.family == socket.AF_UNIX and 'unix sockets' or
+        'this socket'))
+    requests = sum(r for t, queued, r, q in history)
+    queue_time = sum(q for t, queued, r, q in history)
+    if requests:
+      lines.append('queue time: %.1fms average over %s requests in %.0fs' % (
+        1000 * queue_time / requests, requests, window))
+    else:
+      lines.append('queue time: no requests with X-Request-Start in %.0fs' %
+                   window)
+    return '\n'.join(lines) + '\n'
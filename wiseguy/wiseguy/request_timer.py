@@ -0,0 +1,140 @@
+"""Per request latency, broken down by phase and exported to spyglass.
+
+Each worker times the phases of every request it serves:
+  queue - accept() to the first byte of the request, only for the first
+    request on a connection since later ones are just keep-alive idle time
+  parse - reading the request line and headers
+  app - calling the application, up to the point it returns an iterable
+  write - iterating the response and writing it to the client
+  total - all of the above
+  upstream_queue - from the load balancer's X-Request-Start header to the
+    first byte, only for requests that have one, see queue_monitor.py
+
+The times go into a spyglass EventCollector keyed by route and phase, and
+the collector is sent to the spyglass server every send_interval seconds
+from between requests, so there is no extra thread and nothing is sent while
+a request is in flight.
+
+The route is whatever the application puts in environ['wiseguy.route'],
+ideally the pattern that matched rather than the path, so the number of
+keys stays small. Requests without one are counted under 'unrouted'.
+"""
+
+import logging
+import re
+import threading
+import time
+
+try:
+  from spyglass import client as spyglass_client
+  from spyglass import event_collector
+except ImportError:
+  spyglass_client = None
+  event_collector = None
+
+route_environ_key = 'wiseguy.route'
+phases = ('queue', 'parse', 'app', 'write', 'total', 'upstream_queue')
+
+# spyglass drops keys with anything else in them
+invalid_key_pattern = re.compile('[^-_.A-Za-z0-9]+')
+
+
+def get_route_key(route):
+  if not route:
+    return 'unrouted'
+  route = invalid_key_pattern.sub('_', route.strip('/')).strip('_')
+  return route or 'root'
+
+
+class RequestTimer(object):
+  # histogram bucket size in milliseconds, spyglass defaults to 10 which
+  # hides the header parse time entirely
+  granularity = 1
+
+  def __init__(self, stats_address, key_prefix='wiseguy', send_interval=10.0):
+    """stats_address - (host, port) of the spyglass server
+    key_prefix - prepended to every key, route and phase follow
+    send_interval - seconds between sends
+    """
+    if event_collector is None:
+      raise ImportError('request timing requires spyglass')
+    self.key_prefix = key_prefix
+    self.send_interval = send_interval
+    self._client = spyglass_client.SpyglassClient(stats_address)
+    # threaded workers record from every request thread
+    self._lock = threading.Lock()
+    self._collector = self._new_collector()
+    self._last_send_time = time.time()
+    self._route_keys = {}
+
+  def _new_collector(self):
+    collector = event_collector.EventCollector()
+    collector.exec_time_map.granularity = self.granularity
+    return collector
+
+  def _get_key_prefix(self, route):
+    try:
+      return self._route_keys[route]
+    except KeyError:
+      key_prefix = '%s.%s' % (self.key_prefix, get_route_key(route))
+      if len(self._route_keys) < 1024:
+        self._route_keys[route] = key_prefix
+      return key_prefix
+
+  def record(self, route, timings, now=None):
+    """timings - a dict of phase name to elapsed seconds"""
+    if now is None:
+      now = time.time()
+    key_prefix = self._get_key_prefix(route)
+    self._lock.acquire()
+    try:
+      self._collector.increment('%s.requests' % key_prefix, now=now)
+      for phase, elapsed in timings.iteritems():
+        self._collector.log_exec_time(
+          '%s.%s' % (key_prefix, phase), elapsed, now=now)
+    finally:
+      self._lock.release()
+
+  def record_sample(self, name, elapsed, now=None):
+    """Add a time that doesn't belong to a route, like the parent's."""
+    if now is None:
+      now = time.time()
+    self._lock.acquire()
+    try:
+      self._collector.log_exec_time(
+        '%s.%s' % (self.key_prefix, name), elapsed, now=now)
+    finally:
+      self._lock.release()
+
+  def increment(self, name, now=None):
+    """Count an event that doesn't belong to a route."""
+    if now is None:
+      now = time.time()
+    self._lock.acquire()
+    try:
+      self._collector.increment('%s.%s' % (self.key_prefix, name), now=now)
+    finally:
+      self._lock.release()
+
+  def maybe_send(self):
+    """Send the timings if it's been a while, call between requests."""
+    if time.time() - self._last_send_time >= self.send_interval:
+      self.send()
+
+  def send(self):
+    now = time.time()
+    self._lock.acquire()
+    try:
+      self._last_send_time = now
+      if (not self._collector.counter_map and
+          not self._collector.exec_time_map):
+        return
+      collector = self._collector
+      self._collector = self._new_collector()
+    finally:
+      self._lock.release()
+    try:
+      self._client.send_events(collector, now)
+    except Exception, e:
+      # stats are not worth failing a request over
+      logging.warning('unable to send request timings: %s', e)
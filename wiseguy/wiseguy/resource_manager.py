@@ -1,7 +1,10 @@
 import errno
 import logging
+import os
+import resource
 import subprocess
 import sys
+import time
 
 log = logging.getLogger('wsgi')
 
@@ -68,32 +71,155 @@ def linux_get_memory_usage(pid):
   except Exception, e:
     raise MemoryException("unexpected error: %s" % e)
 
+# the kernel can sum up smaps for us since 4.14, which saves reading and
+# parsing a few lines for every mapping in the process
+have_smaps_rollup = os.path.exists('/proc/self/smaps_rollup')
+
 def get_smaps_memory(pid):
-  """Returns (shared_memory, private_memory) in kb"""
-  smaps_file = open('/proc/%s/smaps' % pid)
+  """Returns (shared_memory, private_memory, swap_memory) in kb"""
+  if have_smaps_rollup:
+    smaps_file = open('/proc/%s/smaps_rollup' % pid)
+  else:
+    smaps_file = open('/proc/%s/smaps' % pid)
   private_mem = 0
   shared_mem = 0
   swap_mem = 0
-  for line in smaps_file:
-    if line[:7] == 'Private':
-      # line =~ 'Private_Dirty:        12 kB'
-      # hope it's always 'kB'
-      _, value, unit = line.split()
-      private_mem += int(value)
-    elif line[:6] == 'Shared':
-      _, value, unit = line.split()
-      shared_mem += int(value)
-    elif line[:5] == 'Swap:':
-      _, value, unit = line.split()
-      swap_mem += int(value)
+  try:
+    for line in smaps_file:
+      if line[:7] == 'Private':
+        # line =~ 'Private_Dirty:        12 kB'
+        # hope it's always 'kB'
+        _, value, unit = line.split()
+        private_mem += int(value)
+      elif line[:6] == 'Shared':
+        _, value, unit = line.split()
+        shared_mem += int(value)
+      elif line[:5] == 'Swap:':
+        _, value, unit = line.split()
+        swap_mem += int(value)
+  finally:
+    smaps_file.close()
   return shared_mem, private_mem, swap_mem
 
+_page_size_kb = resource.getpagesize() / 1024
+
+def _read_statm(pid):
+  """Return (size, resident) in kb from /proc/<pid>/statm."""
+  f = open('/proc/%s/statm' % pid)
+  try:
+    fields = f.read().split()
+  finally:
+    f.close()
+  return int(fields[0]) * _page_size_kb, int(fields[1]) * _page_size_kb
+
+def get_statm_rss(pid):
+  """Return the resident set size in kb from /proc/<pid>/statm.
+
+  This is a single short read, cheap enough to do from a busy worker."""
+  try:
+    return _read_statm(pid)[1]
+  except (IOError, IndexError, ValueError), e:
+    raise MemoryException("unexpected error: %s" % e)
+
+class CpuException(Exception):
+  pass
+
+try:
+  _clock_ticks = os.sysconf('SC_CLK_TCK')
+except (ValueError, OSError, AttributeError):
+  _clock_ticks = 100
+
+def get_cpu_time(pid):
+  """Return the user + system cpu seconds pid has used, from
+  /proc/<pid>/stat."""
+  try:
+    f = open('/proc/%s/stat' % pid)
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    # the command name is in parentheses and can contain spaces, the fields
+    # after it start with the state, field 3
+    fields = data[data.rindex(')') + 2:].split()
+    # utime and stime are fields 14 and 15
+    return float(int(fields[11]) + int(fields[12])) / _clock_ticks
+  except (IOError, IndexError, ValueError), e:
+    raise CpuException("unexpected error: %s" % e)
+
 if sys.platform == 'linux2':
   get_memory_usage = linux_get_memory_usage
 else:
   get_memory_usage = generic_get_memory_usage
 
 
+class MemorySampler(object):
+  """Sample the memory usage of a group of processes in one go.
+
+  This is what the parent uses to keep an eye on its children. On linux
+  each process costs a read of statm and smaps_rollup, elsewhere there is
+  one ps for the whole group. The last sample is kept around so the
+  management server can show it without hitting /proc again.
+  """
+  def __init__(self, max_age=30.0):
+    self.max_age = max_age
+    self.sample_time = 0
+    self._samples = {}
+
+  def sample(self, pids):
+    """Return {pid: mem_stats} for the pids we could measure.
+
+    mem_stats always has VmRSS and VmSize, and on linux shared, private and
+    swap as well, all in kb. Processes that went away are left out."""
+    if sys.platform == 'linux2':
+      samples = self._sample_procfs(pids)
+    else:
+      samples = self._sample_ps(pids)
+    self._samples = samples
+    self.sample_time = time.time()
+    return samples
+
+  def get(self, pids):
+    """Like sample(), but reuse the last sample if it's recent enough."""
+    pids = set(pids)
+    if (time.time() - self.sample_time > self.max_age or
+        not pids.issubset(self._samples)):
+      return self.sample(pids)
+    return dict((pid, self._samples[pid]) for pid in pids)
+
+  def _sample_procfs(self, pids):
+    samples = {}
+    for pid in pids:
+      try:
+        size, rss = _read_statm(pid)
+        shared, private, swap = get_smaps_memory(pid)
+      except (IOError, IndexError, ValueError), e:
+        logging.debug('memory sample failed pid: %s %s', pid, e)
+        continue
+      samples[pid] = {'VmSize': size, 'VmRSS': rss, 'shared': shared,
+                      'private': private, 'swap': swap}
+    return samples
+
+  def _sample_ps(self, pids):
+    if not pids:
+      return {}
+    cmd = ['ps', '-orss=,vsz=,pid=']
+    for pid in pids:
+      cmd.extend(['-p', str(pid)])
+    try:
+      proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True)
+      output = proc.communicate()[0]
+    except OSError, e:
+      raise MemoryException("unexpected error: %s" % e)
+    samples = {}
+    for line in output.splitlines():
+      try:
+        rss_size_kb, vsz_kb, pid = [int(x) for x in line.split()]
+      except ValueError:
+        continue
+      samples[pid] = {'VmRSS': rss_size_kb, 'VmSize': vsz_kb}
+    return samples
+
+
 # make hotshot/profile/cProfile work the same way by selectively wrapping
 # certain classes with a proxy
 def get_profiler(profiler_module, path, bias=None):
@@ -106,6 +232,27 @@ def get_profiler(profiler_module, path, bias=None):
     prof = cpuprofile.Profile()
     return ProfileProxy(path, prof)
 
+def merge_profile_stats(paths, output_path):
+  """Add up the profiles in paths and write them to output_path.
+
+  cProfile and cpuprofile both write pstats files. Returns how many were
+  merged, missing or unreadable files are skipped."""
+  import pstats
+  stats = None
+  merged = 0
+  for path in paths:
+    try:
+      if stats is None:
+        stats = pstats.Stats(path)
+      else:
+        stats.add(path)
+      merged += 1
+    except (IOError, EOFError, ValueError, TypeError), e:
+      logging.warning('unable to merge profile %s: %s', path, e)
+  if stats is not None:
+    stats.dump_stats(output_path)
+  return merged
+
 class ProfileProxy(object):
   def __init__(self, filename, profile):
     self.filename = filename
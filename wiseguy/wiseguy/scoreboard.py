@@ -0,0 +1,224 @@
+"""A shared memory scoreboard of what each worker is doing.
+
+The parent maps an anonymous shared region before forking and hands each
+child a fixed size slot. Children overwrite their slot as they move through
+a request, the parent (and the management server thread) can read every slot
+at any time without talking to the children. This is the same idea as the
+Apache scoreboard behind mod_status.
+
+Threaded workers get a slot per request thread, so there can be several
+slots with the same pid.
+
+Writes are not atomic with respect to readers, so a reader can occasionally
+see a slot that is half updated. That's fine for a status page and for
+rough load decisions.
+"""
+
+import logging
+import mmap
+import struct
+import threading
+import time
+
+from wiseguy import resource_manager
+
+# worker states, the slot stores the index
+STATE_STARTING = 0
+STATE_IDLE = 1
+STATE_READING = 2
+STATE_APP = 3
+STATE_WRITING = 4
+state_names = ('starting', 'idle', 'reading', 'app', 'writing')
+busy_states = frozenset([STATE_READING, STATE_APP, STATE_WRITING])
+
+# pid, state, requests served, rss in kb, request start time, requests with
+# a queue time, total queue time, requests shed, request uri
+slot_struct = struct.Struct('=iBIIdIdI128s')
+max_uri_length = 128
+
+
+class ScoreboardSlot(object):
+  """The writer side of one slot, used by a single worker."""
+  # how often the worker records its own rss
+  rss_sample_interval = 10.0
+
+  def __init__(self, scoreboard_map, offset):
+    self._map = scoreboard_map
+    self._offset = offset
+    self.pid = 0
+    self.state = STATE_STARTING
+    self.requests = 0
+    self.rss = 0
+    self.request_start = 0.0
+    self.queued_requests = 0
+    self.queue_time = 0.0
+    self.shed_requests = 0
+    self.uri = ''
+    self._last_rss_sample = 0.0
+
+  def start(self, pid, state=STATE_IDLE):
+    self.pid = pid
+    self.sample_rss()
+    self.set_state(state)
+
+  def set_state(self, state, uri=None):
+    if state in busy_states and self.state not in busy_states:
+      # a new request
+      self.request_start = time.time()
+    self.state = state
+    if uri is not None:
+      self.uri = uri[:max_uri_length]
+    self._write()
+
+  def add_queue_time(self, queue_time):
+    """Count how long a request waited, written with the next state."""
+    self.queued_requests += 1
+    self.queue_time += queue_time
+
+  def add_shed(self):
+    """Count a request turned away by admission control."""
+    self.shed_requests += 1
+
+  def request_done(self):
+    self.requests += 1
+    self.state = STATE_IDLE
+    self.request_start = 0.0
+    self.uri = ''
+    if time.time() - self._last_rss_sample >= self.rss_sample_interval:
+      self.sample_rss()
+    self._write()
+
+  def sample_rss(self):
+    self._last_rss_sample = time.time()
+    try:
+      self.rss = resource_manager.get_statm_rss('self')
+    except resource_manager.MemoryException:
+      self.rss = 0
+
+  def _write(self):
+    self._map[self._offset:self._offset + slot_struct.size] = slot_struct.pack(
+      self.pid, self.state, self.requests, self.rss, self.request_start,
+      self.queued_requests, self.queue_time, self.shed_requests, self.uri)
+
+
+class Scoreboard(object):
+  """Create in the parent, before any children are forked."""
+  def __init__(self, slot_count=128):
+    self.slot_count = slot_count
+    # anonymous maps are MAP_SHARED, so the children see the same pages
+    self._map = mmap.mmap(-1, slot_struct.size * slot_count)
+    # parent only bookkeeping
+    self._lock = threading.Lock()
+    self._reserved = set()
+    self._pid_to_slots = {}
+
+  def reserve_slot(self):
+    """Return the index of an unused slot, or None if they are all taken."""
+    self._lock.acquire()
+    try:
+      for i in xrange(self.slot_count):
+        if i not in self._reserved:
+          self._reserved.add(i)
+          self._clear(i)
+          return i
+    finally:
+      self._lock.release()
+    logging.warning('scoreboard is full (%s slots)', self.slot_count)
+    return None
+
+  def assign_slot(self, index, pid):
+    """Record which child got the slot, run in the parent after fork()."""
+    self._lock.acquire()
+    try:
+      self._pid_to_slots.setdefault(pid, []).append(index)
+    finally:
+      self._lock.release()
+
+  def release_slot(self, pid):
+    self._lock.acquire()
+    try:
+      for index in self._pid_to_slots.pop(pid, []):
+        self._reserved.discard(index)
+        self._clear(index)
+    finally:
+      self._lock.release()
+
+  def get_slot(self, index):
+    """Return the writer for a slot, run in the child."""
+    return ScoreboardSlot(self._map, index * slot_struct.size)
+
+  def _clear(self, index):
+    offset = index * slot_struct.size
+    self._map[offset:offset + slot_struct.size] = '\0' * slot_struct.size
+
+  def read(self):
+    """Return a list of dicts, one for each running worker."""
+    workers = []
+    for i in xrange(self.slot_count):
+      offset = i * slot_struct.size
+      (pid, state, requests, rss, request_start, queued_requests, queue_time,
+       shed_requests, uri) = slot_struct.unpack(
+        self._map[offset:offset + slot_struct.size])
+      if not pid:
+        continue
+      workers.append({
+        'slot': i,
+        'pid': pid,
+        'state': state,
+        'state_name': state_names[state] if state < len(state_names) else '?',
+        'requests': requests,
+        'rss': rss,
+        'request_start': request_start,
+        'queued_requests': queued_requests,
+        'queue_time': queue_time,
+        'shed_requests': shed_requests,
+        'uri': uri.rstrip('\0'),
+        })
+    return workers
+
+  def busy_ratio(self, workers=None):
+    """The fraction of slots currently handling a request."""
+    if workers is None:
+      workers = self.read()
+    if not workers:
+      return 0.0
+    busy = len([w for w in workers if w['state'] in busy_states])
+    return float(busy) / len(workers)
+
+
+def group_by_pid(workers):
+  """Return a dict of pid to the read() entries for that child."""
+  pid_to_workers = {}
+  for w in workers:
+    pid_to_workers.setdefault(w['pid'], []).append(w)
+  return pid_to_workers
+
+
+def format_status(workers, now=None):
+  """Render scoreboard.read() output as a plain text table."""
+  if now is None:
+    now = time.time()
+  busy = len([w for w in workers if w['state'] in busy_states])
+  pid_to_workers = group_by_pid(workers)
+  lines = [
+    'workers: %s slots: %s busy: %s idle: %s requests: %s shed: %s '
+    'rss_kb: %s' % (
+      len(pid_to_workers), len(workers), busy, len(workers) - busy,
+      sum(w['requests'] for w in workers),
+      sum(w['shed_requests'] for w in workers),
+      # the threads of a child share its memory
+      sum(slots[0]['rss'] for slots in pid_to_workers.itervalues())),
+    '',
+    '%-7s %-8s %9s %9s %9s  %s' % (
+      'pid', 'state', 'requests', 'rss_kb', 'seconds', 'uri'),
+    ]
+  for w in sorted(workers, key=lambda x: x['pid']):
+    if w['state'] in busy_states and w['request_start']:
+      elapsed = '%.3f' % (now - w['request_start'])
+      uri = w['uri']
+    else:
+      elapsed = '-'
+      uri = ''
+    lines.append('%-7s %-8s %9s %9s %9s  %s' % (
+      w['pid'], w['state_name'], w['requests'], w['rss'], elapsed, uri))
+  return '\n'.join(lines) + '\n'
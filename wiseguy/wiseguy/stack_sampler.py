@@ -0,0 +1,214 @@
+"""A statistical profiler that is cheap enough to leave on.
+
+A SIGPROF timer interrupts the worker every interval seconds of CPU time
+and the handler records the python stack that was running. Counts are kept
+per stack, and written out now and then in the 'folded' format that
+flamegraph.pl and friends read - one line per stack, frames separated by
+';' from the outermost in, followed by a space and the sample count.
+
+Unlike cProfile, nothing happens on function calls, so timings are not
+distorted and it can run on every worker.
+
+Python only runs signal handlers in the main thread, which is no use for
+threaded workers where the main thread just waits around. For those, pass
+thread_ids and a sampling thread looks at those threads every interval
+seconds of wall clock time instead. That counts time spent waiting on other
+servers as well as cpu time.
+"""
+
+import errno
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+
+# the parent writes this to a sample directory when it clears the samples,
+# see clear_samples()
+cleared_filename = 'cleared'
+
+
+def frame_label(code):
+  return '%s:%s' % (code.co_filename, code.co_name)
+
+
+class StackSampler(object):
+  # how often the counts are written out, see maybe_dump()
+  dump_interval = 10.0
+  # how often to look for the parent clearing the samples
+  clear_check_interval = 1.0
+
+  def __init__(self, path, interval=0.01, thread_ids=None):
+    """path - where to write the folded stacks for this process
+    interval - seconds of cpu time between samples
+    thread_ids - a function returning the ids of the threads to sample,
+      which are then sampled from a thread rather than with SIGPROF
+    """
+    self.path = path
+    self.interval = interval
+    self.thread_ids = thread_ids
+    self.stack_counts = {}
+    self.sample_count = 0
+    self._last_dump_time = time.time()
+    self._last_clear_check_time = time.time()
+    self._cleared_time = get_cleared_time(os.path.dirname(path))
+    self._running = False
+
+  def start(self):
+    if self.thread_ids is not None:
+      self._running = True
+      sampling_thread = threading.Thread(target=self._sample_threads)
+      sampling_thread.setDaemon(True)
+      sampling_thread.start()
+      return
+    signal.signal(signal.SIGPROF, self._sample)
+    # restart system calls rather than having them fail with EINTR, the
+    # application never expects to see this signal
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+    self._running = True
+
+  def stop(self):
+    if self._running:
+      self._running = False
+      if self.thread_ids is None:
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+  def _sample_threads(self):
+    while self._running:
+      time.sleep(self.interval)
+      thread_ids = self.thread_ids()
+      for thread_id, frame in sys._current_frames().iteritems():
+        if thread_id in thread_ids:
+          self._add_stack(frame)
+
+  def _sample(self, signum, frame):
+    self._add_stack(frame)
+
+  def _add_stack(self, frame):
+    labels = []
+    while frame is not None:
+      labels.append(frame_label(frame.f_code))
+      frame = frame.f_back
+    labels.reverse()
+    stack = ';'.join(labels)
+    self.stack_counts[stack] = self.stack_counts.get(stack, 0) + 1
+    self.sample_count += 1
+
+  def maybe_dump(self):
+    """Write the counts if it's been a while, call between requests."""
+    now = time.time()
+    if now - self._last_clear_check_time >= self.clear_check_interval:
+      self._check_cleared(now)
+    if now - self._last_dump_time >= self.dump_interval:
+      self.dump()
+
+  def _check_cleared(self, now):
+    self._last_clear_check_time = now
+    cleared_time = get_cleared_time(os.path.dirname(self.path))
+    if cleared_time != self._cleared_time:
+      # start over, or the next dump puts back what was cleared
+      self._cleared_time = cleared_time
+      self.stack_counts = {}
+      self.sample_count = 0
+
+  def dump(self):
+    now = time.time()
+    self._check_cleared(now)
+    self._last_dump_time = now
+    # write and rename so the parent never reads a partial file
+    tmp_path = '%s.tmp' % self.path
+    try:
+      f = open(tmp_path, 'w')
+      try:
+        # copy, the sampling thread might be adding to it
+        f.write(format_folded(dict(self.stack_counts)))
+      finally:
+        f.close()
+      os.rename(tmp_path, self.path)
+    except (IOError, OSError), e:
+      logging.warning('unable to write stack samples %s: %s', self.path, e)
+
+
+def format_folded(stack_counts):
+  return ''.join('%s %s\n' % (stack, count)
+                 for stack, count in sorted(stack_counts.iteritems()))
+
+
+def read_folded(path, stack_counts=None):
+  """Add the counts in a folded stack file to stack_counts."""
+  if stack_counts is None:
+    stack_counts = {}
+  f = open(path)
+  try:
+    for line in f:
+      stack, sep, count = line.rstrip('\n').rpartition(' ')
+      if not sep:
+        continue
+      try:
+        stack_counts[stack] = stack_counts.get(stack, 0) + int(count)
+      except ValueError:
+        continue
+  finally:
+    f.close()
+  return stack_counts
+
+
+def merge_folded(directory, pids=None):
+  """Merge the stack files from every worker (or just pids) in directory."""
+  stack_counts = {}
+  try:
+    filenames = os.listdir(directory)
+  except OSError, e:
+    if e[0] == errno.ENOENT:
+      return stack_counts
+    raise
+  for filename in filenames:
+    name, ext = os.path.splitext(filename)
+    if ext != '.folded':
+      continue
+    if pids is not None and name not in [str(pid) for pid in pids]:
+      continue
+    try:
+      read_folded(os.path.join(directory, filename), stack_counts)
+    except IOError, e:
+      # probably a worker replacing its file
+      logging.debug('merge_folded %s: %s', filename, e)
+  return stack_counts
+
+
+def get_cleared_time(directory):
+  try:
+    return os.stat(os.path.join(directory, cleared_filename)).st_mtime
+  except OSError:
+    return 0.0
+
+
+def clear_samples(directory):
+  """Remove every worker's file in directory, and tell the workers to start
+  over. They notice within a clear_check_interval, so anything sampled in
+  between is thrown away as well. alloc_profiler.py clears the same way."""
+  if not os.path.isdir(directory):
+    return
+  for filename in os.listdir(directory):
+    if filename == cleared_filename:
+      continue
+    try:
+      os.remove(os.path.join(directory, filename))
+    except OSError, e:
+      logging.warning('unable to remove %s: %s', filename, e)
+  marker_path = os.path.join(directory, cleared_filename)
+  try:
+    open(marker_path, 'w').close()
+    # a clear within the filesystem's timestamp granularity of the last one
+    # still has to look different
+    os.utime(marker_path, None)
+  except (IOError, OSError), e:
+    logging.warning('unable to write %s: %s', marker_path, e)
+
+
+def get_sample_path(directory, pid):
+  return os.path.join(directory, '%s.folded' % pid)
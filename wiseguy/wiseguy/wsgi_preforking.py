@@ -13,6 +13,8 @@ class PreForkingFCGIWSGIServer(WSGIMixIn, PreForkingMixIn, FCGIServer):
   def __init__(self, app, **kargs):
     FCGIServer.__init__(self, **kargs)
     self._app = app
+    if self._threads > 1:
+      self._environ = dict(self._environ, **{'wsgi.multithread': True})
 
   def get_app(self):
     return self._app